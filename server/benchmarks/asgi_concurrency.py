@@ -0,0 +1,182 @@
+"""
+Concurrency benchmark for raw file downloads: many slow clients against the
+async view under ASGI versus the sync view under a fixed-size WSGI thread
+pool (like gunicorn's gthread worker).
+
+    python -m benchmarks.asgi_concurrency --clients 200 --size 4194304
+"""
+import argparse
+import asyncio
+import io
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .common import setup_django, create_user, access_token, create_file
+
+
+def asgi_scope(path, token):
+    return {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "https",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"mode=raw",
+        "headers": [(b"host", b"localhost"), (b"authorization", f"Bearer {token}".encode())],
+        "client": ("127.0.0.1", 0),
+        "server": ("localhost", 443),
+    }
+
+
+async def asgi_client(application, path, token, bandwidth, stats):
+    """One slow client: reads the body at a fixed bandwidth."""
+    finished = asyncio.Event()
+    sent_request = False
+
+    async def receive():
+        nonlocal sent_request
+        if not sent_request:
+            sent_request = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await finished.wait()
+        return {"type": "http.disconnect"}
+
+    received = 0
+
+    async def send(message):
+        nonlocal received
+        if message["type"] == "http.response.start":
+            stats["status"].add(message["status"])
+        elif message["type"] == "http.response.body":
+            body = message.get("body", b"")
+            received += len(body)
+            await asyncio.sleep(len(body) / bandwidth)
+
+    started = time.perf_counter()
+    await application(asgi_scope(path, token), receive, send)
+    finished.set()
+    stats["latencies"].append(time.perf_counter() - started)
+    stats["bytes"] += received
+
+
+def run_asgi(path, token, clients, bandwidth):
+    from django.core.asgi import get_asgi_application
+    application = get_asgi_application()
+    stats = {"latencies": [], "bytes": 0, "status": set()}
+
+    async def main():
+        await asyncio.gather(*(asgi_client(application, path, token, bandwidth, stats) for _ in range(clients)))
+
+    started = time.perf_counter()
+    asyncio.run(main())
+    stats["elapsed"] = time.perf_counter() - started
+    stats["threads"] = threading.active_count()
+    return stats
+
+
+def run_wsgi(path, token, clients, bandwidth, threads):
+    from django.core.wsgi import get_wsgi_application
+    application = get_wsgi_application()
+    stats = {"latencies": [], "bytes": 0, "status": set()}
+    lock = threading.Lock()
+
+    def client():
+        environ = {
+            "REQUEST_METHOD": "GET",
+            "PATH_INFO": path,
+            "QUERY_STRING": "mode=raw",
+            "SERVER_NAME": "localhost",
+            "SERVER_PORT": "443",
+            "HTTP_HOST": "localhost",
+            "HTTP_AUTHORIZATION": f"Bearer {token}",
+            "wsgi.input": io.BytesIO(b""),
+            "wsgi.errors": io.StringIO(),
+            "wsgi.url_scheme": "https",
+        }
+        started = time.perf_counter()
+        status_holder = []
+        body = application(environ, lambda status, headers: status_holder.append(status))
+        received = 0
+        try:
+            for chunk in body:
+                received += len(chunk)
+                time.sleep(len(chunk) / bandwidth)
+        finally:
+            body.close()
+        with lock:
+            stats["status"].add(int(status_holder[0].split()[0]))
+            stats["latencies"].append(time.perf_counter() - started)
+            stats["bytes"] += received
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for future in [pool.submit(client) for _ in range(clients)]:
+            future.result()
+    stats["elapsed"] = time.perf_counter() - started
+    stats["threads"] = threads
+    return stats
+
+
+def summarize(name, stats, clients):
+    latencies = sorted(stats["latencies"])
+    return {
+        "mode": name,
+        "clients": clients,
+        "status_codes": sorted(stats["status"]),
+        "elapsed_s": round(stats["elapsed"], 3),
+        "requests_per_s": round(clients / stats["elapsed"], 1),
+        "mb_per_s": round(stats["bytes"] / stats["elapsed"] / 1e6, 1),
+        "p50_s": round(latencies[len(latencies) // 2], 3),
+        "max_s": round(latencies[-1], 3),
+        "threads": stats["threads"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=200, help="Concurrent slow clients")
+    parser.add_argument("--size", type=int, default=4 * 1024 * 1024, help="File size in bytes")
+    parser.add_argument("--segment-size", type=int, default=256 * 1024, help="FILE_SEGMENT_SIZE for the run")
+    parser.add_argument("--bandwidth", type=float, default=10e6, help="Bytes per second each client reads")
+    parser.add_argument("--wsgi-threads", type=int, default=8, help="WSGI worker threads")
+    parser.add_argument("--json", help="Write results to this file")
+    args = parser.parse_args()
+
+    setup_django()
+    from files.encrypt import aes_encryption
+    aes_encryption.SEGMENT_SIZE = args.segment_size
+
+    user = create_user()
+    token = access_token(user)
+    file = create_file(user, args.size)
+
+    wsgi_path = f"/files/{file.id}/download/"
+    asgi_path = f"/files/async/{file.id}/download/"
+
+    # Warm up imports, URL resolution and the key ring outside the timings
+    run_wsgi(wsgi_path, token, 1, float("inf"), 1)
+    run_asgi(asgi_path, token, 1, float("inf"))
+
+    results = [
+        summarize("wsgi", run_wsgi(wsgi_path, token, args.clients, args.bandwidth, args.wsgi_threads), args.clients),
+        summarize("asgi", run_asgi(asgi_path, token, args.clients, args.bandwidth), args.clients),
+    ]
+
+    for result in results:
+        print(
+            f"{result['mode']:>5}: {result['clients']} clients in {result['elapsed_s']}s "
+            f"({result['requests_per_s']} req/s, {result['mb_per_s']} MB/s, "
+            f"p50 {result['p50_s']}s, max {result['max_s']}s, threads {result['threads']}, "
+            f"status {result['status_codes']})"
+        )
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
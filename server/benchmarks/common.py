@@ -0,0 +1,91 @@
+"""
+Shared setup for the in-process benchmarks. Run them from the server
+directory, e.g. ``python -m benchmarks.asgi_concurrency``.
+"""
+import os
+import tempfile
+
+
+def setup_django(workdir=None):
+    """
+    Configure Django against a throwaway SQLite database and media root so
+    benchmarks never touch real data. Returns the working directory.
+    """
+    workdir = workdir or tempfile.mkdtemp(prefix="sfs-bench-")
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "core.settings")
+
+    from django.conf import settings
+    settings.DATABASES["default"]["NAME"] = os.path.join(workdir, "bench.sqlite3")
+    settings.DATABASES["default"]["OPTIONS"] = {"timeout": 60}  # Concurrent uploads wait for the write lock
+    settings.MEDIA_ROOT = os.path.join(workdir, "media")
+    settings.ALLOWED_HOSTS = ["*"]
+    settings.DEBUG = False
+    settings.CELERY_TASK_ALWAYS_EAGER = True  # Uploads are processed inside the request
+
+    import django
+    django.setup()
+
+    from django.core.management import call_command
+    call_command("migrate", verbosity=0)
+    return workdir
+
+
+def create_user(username="bench", role="Regular User"):
+    from users.models import Users
+    user, _ = Users.objects.get_or_create(
+        username=username, defaults={"email": f"{username}@bench.local", "role": role}
+    )
+    return user
+
+
+def access_token(user):
+    from rest_framework_simplejwt.tokens import AccessToken
+    return str(AccessToken.for_user(user))
+
+
+def random_file(size, directory=None, chunk_size=1024 * 1024):
+    """Write `size` random bytes to a temporary file and return its path."""
+    handle, path = tempfile.mkstemp(prefix="sfs-bench-", dir=directory)
+    with os.fdopen(handle, "wb") as output:
+        remaining = size
+        while remaining:
+            chunk = os.urandom(min(chunk_size, remaining))
+            output.write(chunk)
+            remaining -= len(chunk)
+    return path
+
+
+def create_file(owner, size, name="bench.bin"):
+    """Store a file of `size` random bytes the way upload processing does."""
+    import hashlib
+    from files.blobs import link_blob
+    from files.encrypt import aes_encryption
+    from files.models import File
+    from files.utils import encrypt_with_public_key, key_ring
+
+    path = random_file(size)
+
+    def chunks():
+        with open(path, "rb") as content:
+            yield from iter(lambda: content.read(aes_encryption.CHUNK_SIZE), b"")
+
+    try:
+        uploaded_file = File.objects.create(
+            name=name,
+            encrypted_file=None,
+            server_key=encrypt_with_public_key(os.urandom(32), key_ring.active_key_id),
+            server_key_id=key_ring.active_key_id,
+            iv=os.urandom(12),
+            owner=owner,
+            size=size,
+        )
+        hasher = hashlib.sha256()
+        for chunk in chunks():
+            hasher.update(chunk)
+        link_blob(
+            uploaded_file, hasher.hexdigest(),
+            lambda: aes_encryption.encrypt_stream(chunks(), size), aes_encryption.active_key_id,
+        )
+    finally:
+        os.remove(path)
+    return uploaded_file
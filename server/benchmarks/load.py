@@ -0,0 +1,348 @@
+"""
+Load benchmark for the upload, download, render and listing endpoints.
+Requests go through the WSGI application in-process (no network), from a
+thread pool per concurrency level, against a throwaway database.
+
+    python -m benchmarks.load --sizes 1KB,1MB,64MB,1GB --concurrency 1,4,16
+    python -m benchmarks.load --json results.json --save-baseline baseline.json
+    python -m benchmarks.load --baseline baseline.json
+
+Scenarios:
+    upload    POST /files/upload/ (multipart, processed inline)
+    download  GET /files/<id>/download/ (base64 JSON)
+    render    GET /files/<id>/render/?mode=raw (streamed)
+    list      GET /files/ for a user with --list-files files
+
+Each (scenario, size, concurrency) cell reports throughput, p50/p95/p99
+latency, peak RSS while the cell ran and queries per request. With
+--baseline, cells whose throughput drops or whose p95 grows by more than
+--tolerance are reported and the exit status is 1.
+"""
+import argparse
+import io
+import json
+import math
+import os
+import platform
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from .common import setup_django, create_user, access_token, create_file, random_file
+
+SCENARIOS = ("upload", "download", "render", "list")
+UNITS = {"B": 1, "KB": 1024, "MB": 1024 ** 2, "GB": 1024 ** 3}
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    for unit in sorted(UNITS, key=len, reverse=True):
+        if text.endswith(unit):
+            return int(float(text[:-len(unit)]) * UNITS[unit])
+    return int(text)
+
+
+def format_size(size):
+    for unit in ("GB", "MB", "KB"):
+        if size >= UNITS[unit] and size % UNITS[unit] == 0:
+            return f"{size // UNITS[unit]}{unit}"
+    return f"{size}B"
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    index = max(0, min(len(sorted_values) - 1, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def current_rss():
+    """Resident set size of this process in bytes."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class RSSMonitor:
+    """Sample RSS on a background thread and keep the peak."""
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = current_rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+
+class MultipartUpload:
+    """
+    A multipart/form-data body for FileUploadView, written to disk once per
+    size so large uploads are streamed into the request, not held in memory.
+    """
+    def __init__(self, size, directory):
+        self.boundary = uuid.uuid4().hex
+        content_path = random_file(size, directory)
+        self.path = content_path + ".multipart"
+        with open(self.path, "wb") as body, open(content_path, "rb") as content:
+            for field, value in (("encrypted_key", os.urandom(32).hex()), ("iv", os.urandom(12).hex())):
+                body.write(
+                    f'--{self.boundary}\r\nContent-Disposition: form-data; name="{field}"\r\n\r\n{value}\r\n'.encode()
+                )
+            body.write(
+                f'--{self.boundary}\r\nContent-Disposition: form-data; name="file"; filename="bench.bin"\r\n'
+                f"Content-Type: application/octet-stream\r\n\r\n".encode()
+            )
+            for chunk in iter(lambda: content.read(1024 * 1024), b""):
+                body.write(chunk)
+            body.write(f"\r\n--{self.boundary}--\r\n".encode())
+        os.remove(content_path)
+        self.length = os.path.getsize(self.path)
+        self.content_type = f"multipart/form-data; boundary={self.boundary}"
+
+    def remove(self):
+        os.remove(self.path)
+
+
+def wsgi_request(application, method, path, token, query="", body_path=None, content_type=None):
+    """
+    Run one request through the WSGI application and drain the response.
+    Returns (status, response bytes, queries).
+    """
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    body = open(body_path, "rb") if body_path else io.BytesIO(b"")
+    environ = {
+        "REQUEST_METHOD": method,
+        "PATH_INFO": path,
+        "QUERY_STRING": query,
+        "SERVER_NAME": "localhost",
+        "SERVER_PORT": "443",
+        "HTTP_HOST": "localhost",
+        "HTTP_AUTHORIZATION": f"Bearer {token}",
+        "wsgi.input": body,
+        "wsgi.errors": io.StringIO(),
+        "wsgi.url_scheme": "https",
+    }
+    if body_path:
+        environ["CONTENT_LENGTH"] = str(os.path.getsize(body_path))
+        environ["CONTENT_TYPE"] = content_type
+
+    status_holder = []
+    received = 0
+    try:
+        with CaptureQueriesContext(connection) as queries:
+            response = application(environ, lambda status, headers: status_holder.append(status))
+            try:
+                for chunk in response:
+                    received += len(chunk)
+            finally:
+                response.close()
+    finally:
+        body.close()
+    return int(status_holder[0].split()[0]), received, len(queries)
+
+
+def run_cell(scenario, size, concurrency, requests, make_request):
+    """Issue `requests` calls of make_request() from `concurrency` threads."""
+    latencies, query_counts, statuses = [], [], {}
+    lock = threading.Lock()
+    transferred = 0
+
+    def one():
+        nonlocal transferred
+        started = time.perf_counter()
+        status, received, queries = make_request()
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            query_counts.append(queries)
+            statuses[status] = statuses.get(status, 0) + 1
+            transferred += received
+
+    with RSSMonitor() as rss:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for future in [pool.submit(one) for _ in range(requests)]:
+                future.result()
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    payload = size * requests if size is not None else transferred
+    return {
+        "scenario": scenario,
+        "size": size,
+        "concurrency": concurrency,
+        "requests": requests,
+        "status_codes": {str(code): count for code, count in sorted(statuses.items())},
+        "elapsed_s": round(elapsed, 4),
+        "requests_per_s": round(requests / elapsed, 2),
+        "mb_per_s": round(payload / elapsed / 1e6, 2),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "peak_rss_mb": round(rss.peak / 1e6, 1),
+        "queries_per_request": round(sum(query_counts) / len(query_counts), 2),
+        "max_queries": max(query_counts),
+    }
+
+
+def cell_key(result):
+    return (result["scenario"], result["size"], result["concurrency"])
+
+
+def compare(results, baseline, tolerance):
+    """Return a line per regressed cell relative to the baseline results."""
+    previous = {cell_key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        before = previous.get(cell_key(result))
+        if before is None:
+            continue
+        label = f"{result['scenario']} {format_size(result['size']) if result['size'] else '-'} x{result['concurrency']}"
+        if result["requests_per_s"] < before["requests_per_s"] * (1 - tolerance):
+            regressions.append(f"{label}: throughput {before['requests_per_s']} -> {result['requests_per_s']} req/s")
+        if result["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{label}: p95 {before['p95_ms']} -> {result['p95_ms']} ms")
+        if result["queries_per_request"] > before["queries_per_request"]:
+            regressions.append(
+                f"{label}: queries/request {before['queries_per_request']} -> {result['queries_per_request']}"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="Comma-separated scenarios to run")
+    parser.add_argument("--sizes", default="1KB,1MB,16MB", help="Comma-separated file sizes, e.g. 1KB,64MB,1GB")
+    parser.add_argument("--concurrency", default="1,4,16", help="Comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=32, help="Requests per cell")
+    parser.add_argument("--byte-budget", type=parse_size, default=parse_size("2GB"),
+                        help="Cap on bytes moved per cell; large sizes run fewer requests")
+    parser.add_argument("--list-files", type=int, default=1000, help="Files owned by the listing user")
+    parser.add_argument("--json", help="Write results to this file")
+    parser.add_argument("--baseline", help="Compare against results saved with --save-baseline")
+    parser.add_argument("--save-baseline", help="Write these results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Allowed relative regression")
+    args = parser.parse_args()
+
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    sizes = [parse_size(size) for size in args.sizes.split(",")]
+    levels = [int(level) for level in args.concurrency.split(",")]
+
+    workdir = setup_django()
+    from django.conf import settings
+    from django.core.wsgi import get_wsgi_application
+    from files.models import File, ShareableLink
+
+    application = get_wsgi_application()
+    user = create_user()
+    token = access_token(user)
+
+    # Warm up imports, URL resolution and the key ring outside the timings
+    warm_file = create_file(user, 1024)
+    wsgi_request(application, "GET", f"/files/{warm_file.id}/download/", token)
+
+    results = []
+
+    def report(result):
+        results.append(result)
+        size = format_size(result["size"]) if result["size"] is not None else "-"
+        print(
+            f"{result['scenario']:>8} {size:>6} x{result['concurrency']:<3} "
+            f"{result['requests_per_s']:>9} req/s {result['mb_per_s']:>9} MB/s  "
+            f"p50 {result['p50_ms']}ms p95 {result['p95_ms']}ms p99 {result['p99_ms']}ms  "
+            f"rss {result['peak_rss_mb']}MB  queries {result['queries_per_request']}  "
+            f"status {result['status_codes']}",
+            flush=True,
+        )
+
+    for size in sizes:
+        requests = max(1, min(args.requests, args.byte_budget // max(size, 1)))
+        if "upload" in scenarios:
+            upload = MultipartUpload(size, workdir)
+            try:
+                for level in levels:
+                    report(run_cell("upload", size, level, requests, lambda: wsgi_request(
+                        application, "POST", "/files/upload/", token,
+                        body_path=upload.path, content_type=upload.content_type,
+                    )))
+            finally:
+                upload.remove()
+        if "download" in scenarios or "render" in scenarios:
+            file = create_file(user, size)
+            for scenario, path, query in (
+                ("download", f"/files/{file.id}/download/", ""),
+                ("render", f"/files/{file.id}/render/", "mode=raw"),
+            ):
+                if scenario in scenarios:
+                    for level in levels:
+                        report(run_cell(scenario, size, level, requests, lambda: wsgi_request(
+                            application, "GET", path, token, query=query,
+                        )))
+
+    if "list" in scenarios:
+        lister = create_user("bench-list")
+        File.objects.bulk_create(
+            File(name=f"file-{index}.bin", encrypted_file="", server_key=b"", iv=b"", owner=lister, size=index)
+            for index in range(args.list_files)
+        )
+        expires_at = datetime.now(timezone.utc) + settings.UPLOAD_SESSION_TTL
+        ShareableLink.objects.bulk_create(
+            ShareableLink(file=file, expires_at=expires_at)
+            for file in File.objects.filter(owner=lister)[:args.list_files // 2]
+        )
+        list_token = access_token(lister)
+        for level in levels:
+            report(run_cell("list", None, level, args.requests, lambda: wsgi_request(
+                application, "GET", "/files/", list_token,
+            )))
+
+    output = {
+        "meta": {
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "segment_size": settings.FILE_SEGMENT_SIZE,
+            "crypto_workers": settings.FILE_CRYPTO_WORKERS,
+            "list_files": args.list_files,
+        },
+        "results": results,
+    }
+    for path in (args.json, args.save_baseline):
+        if path:
+            with open(path, "w") as destination:
+                json.dump(output, destination, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as source:
+            regressions = compare(results, json.load(source), args.tolerance)
+        if regressions:
+            print("\nRegressions against baseline:")
+            for line in regressions:
+                print(f"  {line}")
+            raise SystemExit(1)
+        print("\nNo regressions against baseline.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""
+Multi-process check that server keys provisioned from one source let any
+node serve any blob. Every node is a separate Python process started in
+strict key-provisioning mode from the same environment-provided keys and
+KEY_FINGERPRINT, over a shared database and storage:
+
+    python -m benchmarks.multinode --nodes 4 --files 3 --size 256KB
+
+1. Each node uploads --files files concurrently with the others.
+2. Each node then downloads every file uploaded by every node and checks
+   the client-encrypted bytes and the unwrapped client key.
+3. A node started with a different AES key must refuse to start.
+
+Set FILE_STORAGE_BACKEND and the S3_* variables to run the nodes over an
+S3-compatible bucket instead of a shared local directory. Exits with
+status 1 if any check fails.
+"""
+import argparse
+import base64
+import glob
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from .load import parse_size
+
+FINGERPRINT_MISMATCH = "do not match KEY_FINGERPRINT"
+
+
+def provision_keys():
+    """Fresh server keys as the environment of a strict-mode node."""
+    from Crypto.PublicKey import RSA
+    from files.keys import STRICT, fingerprint
+
+    aes_key = os.urandom(32)
+    rsa_key = RSA.generate(2048)
+    return {
+        "KEY_PROVISIONING": STRICT,
+        "SERVER_AES_KEY": base64.b64encode(aes_key).decode(),
+        "SERVER_RSA_PRIVATE_KEY": rsa_key.export_key().decode(),
+        "KEY_FINGERPRINT": fingerprint({"v1": aes_key}, {"v1": rsa_key.publickey()}),
+    }
+
+
+def start_node(role, index, args, env):
+    command = [
+        sys.executable, "-m", "benchmarks.multinode", "--role", role, "--index", str(index),
+        "--workdir", args.workdir, "--files", str(args.files), "--size", str(args.size),
+    ]
+    return subprocess.Popen(
+        command, env=env, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+    )
+
+
+def run_nodes(role, args, env):
+    """Run args.nodes nodes concurrently; returns [(returncode, stdout, stderr)]."""
+    nodes = [start_node(role, index, args, env) for index in range(args.nodes)]
+    outputs = [node.communicate() for node in nodes]
+    return [(node.returncode, stdout, stderr) for node, (stdout, stderr) in zip(nodes, outputs)]
+
+
+def node_client():
+    from django.test import Client
+    from .common import access_token, create_user
+    return Client(HTTP_AUTHORIZATION=f"Bearer {access_token(create_user('multinode'))}")
+
+
+def upload_files(args):
+    """Upload this node's files; record their hash and client key for the verify round."""
+    from django.core.files.uploadedfile import SimpleUploadedFile
+
+    client = node_client()
+    uploaded = {}
+    for number in range(args.files):
+        content, client_key = os.urandom(args.size), os.urandom(32)
+        response = client.post("/files/upload/", {
+            "file": SimpleUploadedFile(f"node{args.index}-{number}.bin", content),
+            "encrypted_key": client_key.hex(),
+            "iv": os.urandom(12).hex(),
+        }, secure=True)
+        if response.status_code != 202:
+            raise RuntimeError(f"Upload failed with {response.status_code}: {response.content[:200]!r}")
+        uploaded[response.json()["file_id"]] = {
+            "sha256": hashlib.sha256(content).hexdigest(), "client_key": client_key.hex(),
+        }
+    with open(os.path.join(args.workdir, f"uploads-{args.index}.json"), "w") as output:
+        json.dump(uploaded, output)
+    return {"node": args.index, "uploaded": len(uploaded)}
+
+
+def verify_files(args):
+    """Download every node's files and compare them with what was uploaded."""
+    client = node_client()
+    failures, checked = [], 0
+    for path in sorted(glob.glob(os.path.join(args.workdir, "uploads-*.json"))):
+        with open(path) as source:
+            uploaded = json.load(source)
+        for file_id, expected in uploaded.items():
+            response = client.get(f"/files/{file_id}/render/", {"mode": "raw"}, secure=True)
+            checked += 1
+            if response.status_code != 200:
+                failures.append(f"file {file_id}: status {response.status_code}")
+                continue
+            content = b"".join(response.streaming_content)
+            client_key = base64.b64decode(response["X-Client-Key"]).hex()
+            if hashlib.sha256(content).hexdigest() != expected["sha256"]:
+                failures.append(f"file {file_id}: content differs")
+            if client_key != expected["client_key"]:
+                failures.append(f"file {file_id}: client key differs")
+    return {"node": args.index, "checked": checked, "failures": failures}
+
+
+def run_node(args):
+    from .common import setup_django
+    setup_django(args.workdir)
+    result = upload_files(args) if args.role == "upload" else verify_files(args)
+    print(json.dumps(result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--nodes", type=int, default=4, help="Node processes per round")
+    parser.add_argument("--files", type=int, default=3, help="Files uploaded by each node")
+    parser.add_argument("--size", type=parse_size, default=256 * 1024, help="Size of each file, e.g. 256KB")
+    parser.add_argument("--workdir", help="Shared database and media directory (default: a new temp dir)")
+    parser.add_argument("--role", choices=("upload", "verify", "migrate"), help=argparse.SUPPRESS)
+    parser.add_argument("--index", type=int, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.role in ("upload", "verify"):
+        return run_node(args)
+    if args.role == "migrate":
+        from .common import create_user, setup_django
+        setup_django(args.workdir)
+        create_user("multinode")
+        return
+
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "core.settings")
+    args.workdir = args.workdir or tempfile.mkdtemp(prefix="sfs-multinode-")
+    env = {**os.environ, **provision_keys()}
+    print(f"{args.nodes} nodes, shared keys {env['KEY_FINGERPRINT']}, workdir {args.workdir}", flush=True)
+
+    migrate = start_node("migrate", 0, args, env)
+    _, stderr = migrate.communicate()
+    if migrate.returncode:
+        print(f"Setting up the shared database failed:\n{stderr.strip()}")
+        sys.exit(1)
+
+    ok = True
+    for role in ("upload", "verify"):
+        for index, (returncode, stdout, stderr) in enumerate(run_nodes(role, args, env)):
+            if returncode:
+                ok = False
+                print(f"{role} node {index} exited with {returncode}:\n{stderr.strip()}")
+                continue
+            result = json.loads(stdout.strip().splitlines()[-1])
+            ok = ok and not result.get("failures")
+            print(f"{role:>7} node {index}: {result}")
+
+    # A node whose keys differ from the fleet's must not start at all
+    stray = start_node("verify", args.nodes, args, {**env, "SERVER_AES_KEY": base64.b64encode(os.urandom(32)).decode()})
+    _, stderr = stray.communicate()
+    refused = stray.returncode != 0 and FINGERPRINT_MISMATCH in stderr
+    ok = ok and refused
+    print(f"node with a different AES key {'refused to start' if refused else 'STARTED'}")
+
+    print("PASS" if ok else "FAIL")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
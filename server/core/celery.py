@@ -1,19 +1,14 @@
-# from __future__ import absolute_import, unicode_literals
-# import os
-# from celery import Celery
+import os
+from celery import Celery
 
-# # Set the default Django settings module for the 'celery' program.
-# os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'EliteAide.settings')
+# Set the default Django settings module for the 'celery' program.
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
 
-# app = Celery('EliteAide')
+app = Celery('core')
 
-# # Using a string here means the worker doesn't have to serialize
-# # the configuration object to child processes.
-# app.config_from_object('django.conf:settings', namespace='CELERY')
+# Using a string here means the worker doesn't have to serialize
+# the configuration object to child processes.
+app.config_from_object('django.conf:settings', namespace='CELERY')
 
-# # Load task modules from all registered Django app configs.
-# app.autodiscover_tasks()
-
-# @app.task(bind=True)
-# def debug_task(self):
-#     print(f'Request: {self.request!r}')
+# Load task modules from all registered Django app configs.
+app.autodiscover_tasks()
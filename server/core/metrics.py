@@ -0,0 +1,167 @@
+"""
+In-process metrics exposed in the Prometheus text format at /metrics/.
+
+Counters and histograms are plain Python objects guarded by a lock each;
+observing a value is a dict lookup, a bisect and two additions. Values are
+per process, so scrape every worker (or run one process per target).
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89, 144)
+
+registry = []  # Every Counter and Histogram, in creation order
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def collect(self):
+        with self._lock:
+            values = dict(self._values)
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        for key, value in sorted(values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 3)
+            series[index] += 1  # index == len(buckets) is the +Inf bucket
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def collect(self):
+        with self._lock:
+            series = {key: list(values) for key, values in self._series.items()}
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        for key, values in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), values):
+                cumulative += count
+                le = bound if bound == "+Inf" else _format_value(float(bound))
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, key, ('le', le))} {cumulative}"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {_format_value(float(values[-2]))}"
+            yield f"{self.name}_count{labels} {values[-1]}"
+
+
+class CallbackMetric:
+    """A counter or gauge whose value is read from callback() when scraped."""
+    def __init__(self, name, documentation, kind, callback):
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self.callback = callback
+        registry.append(self)
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.kind}"
+        yield f"{self.name} {_format_value(self.callback())}"
+
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in registry:
+        lines.extend(metric.collect())
+    return "\n".join(lines) + "\n"
+
+
+REQUEST_SECONDS = Histogram(
+    "sfs_http_request_duration_seconds",
+    "Time from request to response (first byte for streamed responses), by view.",
+    ("view", "method", "status"),
+)
+REQUEST_QUERIES = Histogram(
+    "sfs_db_queries_per_request",
+    "Database queries issued while handling a request, by view.",
+    ("view",),
+    buckets=COUNT_BUCKETS,
+)
+RSA_SECONDS = Histogram(
+    "sfs_rsa_seconds",
+    "Time spent wrapping (encrypt) and unwrapping (decrypt) client keys with RSA-OAEP.",
+    ("operation",),
+)
+AES_SECONDS = Histogram(
+    "sfs_aes_seconds",
+    "Time spent in server-side AES per call (one segment or CBC chunk).",
+    ("operation",),
+)
+AES_BYTES = Counter(
+    "sfs_aes_bytes_total",
+    "Input bytes passed to server-side AES encryption and decryption.",
+    ("operation",),
+)
+STORAGE_SECONDS = Histogram(
+    "sfs_storage_seconds",
+    "Time spent reading encrypted blobs and saving files to storage (saves include producing the content).",
+    ("operation",),
+)
+STORAGE_BYTES = Counter(
+    "sfs_storage_bytes_total",
+    "Bytes read from and written to storage.",
+    ("operation",),
+)
+BLOB_UPLOADS = Counter(
+    "sfs_blob_uploads_total",
+    "Processed uploads, by whether their content was already stored (deduplicated) or written (stored).",
+    ("outcome",),
+)
@@ -0,0 +1,129 @@
+import time
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.db import connection
+from users.enums import RoleChoices
+from .metrics import REQUEST_QUERIES, REQUEST_SECONDS
+from .profiling import RequestProfile, profiling_available
+
+
+def view_label(request):
+    match = getattr(request, "resolver_match", None)
+    return match.view_name if match is not None else "unmatched"
+
+
+class MetricsMiddleware:
+    """
+    Record latency per view and, for sync requests, the number of database
+    queries issued. Works natively for both sync and async views so the
+    async transfer endpoints are not pushed onto a thread.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        queries = 0
+
+        def count_query(execute, sql, params, many, context):
+            nonlocal queries
+            queries += 1
+            return execute(sql, params, many, context)
+
+        started = time.perf_counter()
+        with connection.execute_wrapper(count_query):
+            response = self.get_response(request)
+        self.observe(request, response, started)
+        REQUEST_QUERIES.observe(queries, view=view_label(request))
+        return response
+
+    async def __acall__(self, request):
+        # ORM calls run on other threads here, so queries are not counted
+        started = time.perf_counter()
+        response = await self.get_response(request)
+        self.observe(request, response, started)
+        return response
+
+    def observe(self, request, response, started):
+        REQUEST_SECONDS.observe(
+            time.perf_counter() - started,
+            view=view_label(request),
+            method=request.method,
+            status=str(response.status_code),
+        )
+
+
+def profile_requested(request):
+    if request.META.get("HTTP_X_PROFILE") == "1":
+        return True
+    # Substring test first so unflagged requests never parse the query string
+    return "profile=1" in request.META.get("QUERY_STRING", "") and request.GET.get("profile") == "1"
+
+
+def profiling_admin(request):
+    """The Admin making a JWT-authenticated request, or None."""
+    from rest_framework.exceptions import AuthenticationFailed
+    from rest_framework_simplejwt.authentication import JWTAuthentication
+    try:
+        result = JWTAuthentication().authenticate(request)
+    except AuthenticationFailed:
+        return None
+    if result is None or result[0].role != RoleChoices.ADMIN.value:
+        return None
+    return result[0]
+
+
+class ProfilerMiddleware:
+    """
+    Profile requests an Admin flags with X-Profile: 1 or ?profile=1 and
+    return the stored profile's ID in X-Profile-Id. Streamed bodies are
+    profiled chunk by chunk and the profile is saved once they finish.
+    Only sync requests are profiled, only with a shared cache to keep the
+    profiles in, and only one at a time per process.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.get_response(request)
+        if not profile_requested(request) or not profiling_available():
+            return self.get_response(request)
+        user = profiling_admin(request)
+        if user is None:
+            return self.get_response(request)
+
+        profile = RequestProfile(request, user)
+        with profile.active() as profiled:
+            response = self.get_response(request)
+        if not profiled:
+            return response
+        response["X-Profile-Id"] = profile.id
+
+        if response.streaming:
+            response.streaming_content = self.profiled_stream(profile, iter(response.streaming_content), response.status_code)
+        else:
+            profile.save(response.status_code)
+        return response
+
+    def profiled_stream(self, profile, chunks, status_code):
+        try:
+            while True:
+                with profile.active():  # Marks the profile incomplete when busy
+                    chunk = next(chunks, None)
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            profile.save(status_code)
@@ -0,0 +1,155 @@
+"""
+Per-request profiles for admins. ProfilerMiddleware starts a RequestProfile
+only for requests flagged with X-Profile: 1 (or ?profile=1) by an Admin;
+everything else pays one header lookup.
+
+A profile collects a cProfile of the request thread, every SQL query with
+its duration, and the time and bytes of each crypto and storage stage
+reported through record_stage(). Finished profiles are kept in the shared
+Django cache for PROFILER_RESULT_TTL seconds and served at /profiles/; with
+a per-process cache (the locmem default) nothing is profiled, since another
+worker would answer the lookup.
+
+cProfile cannot run two profiles at once (Python 3.12 raises ValueError) and
+from 3.12 on it sees calls made on every thread, so only one thread of the
+process profiles at a time. A flagged request arriving while the profiler is
+busy is served unprofiled.
+"""
+import cProfile
+import io
+import pstats
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.utils.timezone import now
+from files.cache import shared_cache_configured
+
+_local = threading.local()
+_profiler_lock = threading.Lock()
+SEQUENCE_KEY = "request-profiles:sequence"
+
+
+def profiling_available():
+    """Whether finished profiles can be stored where every worker sees them."""
+    return shared_cache_configured()
+
+
+def current_profile():
+    """The profile of the request running on this thread, if it is flagged."""
+    return getattr(_local, "profile", None)
+
+
+def record_stage(profile, stage, seconds, nbytes=0):
+    """Add one timed call to a profile; a no-op when profile is None."""
+    if profile is not None:
+        profile.record(stage, seconds, nbytes)
+
+
+class RequestProfile:
+    def __init__(self, request, user):
+        self.id = uuid.uuid4().hex
+        self.method = request.method
+        self.path = request.get_full_path()
+        self.user = user.username
+        self.started_at = now()
+        self.wall_seconds = 0.0
+        self.queries = []
+        self.stages = {}
+        self.complete = True
+        self._profiler = cProfile.Profile()
+        self._lock = threading.Lock()  # Stages are also recorded from segment-crypto threads
+
+    def record(self, stage, seconds, nbytes=0):
+        with self._lock:
+            totals = self.stages.setdefault(stage, {"calls": 0, "seconds": 0.0, "bytes": 0})
+            totals["calls"] += 1
+            totals["seconds"] += seconds
+            totals["bytes"] += nbytes
+
+    def _capture_query(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append({"sql": sql, "ms": round((time.perf_counter() - started) * 1000, 3)})
+
+    @contextmanager
+    def active(self):
+        """
+        Profile the code run inside the block on this thread. Yields False,
+        and runs the block unprofiled, while another thread is profiling.
+        """
+        if not _profiler_lock.acquire(blocking=False):
+            self.complete = False
+            yield False
+            return
+        started = time.perf_counter()
+        try:
+            _local.profile = self
+            connection.execute_wrappers.append(self._capture_query)
+            self._profiler.enable()
+            yield True
+        finally:
+            self._profiler.disable()
+            self.wall_seconds += time.perf_counter() - started
+            if self._capture_query in connection.execute_wrappers:
+                connection.execute_wrappers.remove(self._capture_query)
+            _local.profile = None
+            _profiler_lock.release()
+
+    def save(self, status_code):
+        """Store the finished profile for PROFILER_RESULT_TTL seconds."""
+        output = io.StringIO()
+        stats = pstats.Stats(self._profiler, stream=output)
+        stats.sort_stats("cumulative").print_stats(settings.PROFILER_TOP_FUNCTIONS)
+        result = {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "status": status_code,
+            "user": self.user,
+            "started_at": self.started_at.isoformat(),
+            "complete": self.complete,
+            "wall_ms": round(self.wall_seconds * 1000, 3),
+            "query_count": len(self.queries),
+            "query_ms": round(sum(query["ms"] for query in self.queries), 3),
+            "queries": self.queries,
+            "stages": {
+                stage: {**totals, "seconds": round(totals["seconds"], 6)}
+                for stage, totals in sorted(self.stages.items())
+            },
+            "python_profile": output.getvalue(),
+        }
+        if not profiling_available():
+            return
+        ttl = settings.PROFILER_RESULT_TTL
+        cache.set(f"request-profile:{self.id}", result, ttl)
+        # Each summary gets its own slot from an atomic counter, so profiles
+        # saved at the same time by different workers never overwrite a
+        # shared index
+        cache.add(SEQUENCE_KEY, 0, None)
+        sequence = cache.incr(SEQUENCE_KEY)
+        summary = {key: result[key] for key in ("id", "method", "path", "status", "user", "started_at", "complete", "wall_ms")}
+        cache.set(_summary_key(sequence), summary, ttl)
+
+
+def _summary_key(sequence):
+    return f"request-profiles:{sequence}"
+
+
+def get_profile(profile_id):
+    return cache.get(f"request-profile:{profile_id}")
+
+
+def recent_profiles():
+    """Summaries of the last PROFILER_MAX_RESULTS profiles, newest first."""
+    latest = cache.get(SEQUENCE_KEY)
+    if not latest:
+        return []
+    keys = [_summary_key(sequence) for sequence in range(latest, max(latest - settings.PROFILER_MAX_RESULTS, 0), -1)]
+    found = cache.get_many(keys)
+    return [found[key] for key in keys if key in found]
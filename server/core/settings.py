@@ -60,6 +60,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.middleware.MetricsMiddleware',
+    'core.middleware.ProfilerMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -101,6 +103,13 @@ DATABASES = {
     }
 }
 
+# Shared cache (permission decisions, share links). These are only cached
+# once CACHE_URL names a Redis or Memcached backend that every process shares,
+# since invalidations could not reach the other processes otherwise.
+CACHES = {
+    'default': env.cache('CACHE_URL', default='locmemcache://'),
+}
+
 
 
 
@@ -140,6 +149,30 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 
+# Admin request profiles (X-Profile: 1): how long they are kept, how many are
+# listed, and how many functions of the cProfile output are stored
+PROFILER_RESULT_TTL = 60 * 60
+PROFILER_MAX_RESULTS = 100
+PROFILER_TOP_FUNCTIONS = 40
+
+# Bearer token required to scrape /metrics/ (only served without one when DEBUG)
+METRICS_TOKEN = env('METRICS_TOKEN', default='')
+
+# Where blobs, staged uploads and upload-session chunks live. Set
+# FILE_STORAGE_BACKEND=files.storage.MeteredS3Storage and the S3_* variables to
+# share an S3-compatible bucket between several app nodes and workers.
+STORAGES = {
+    'default': {'BACKEND': env('FILE_STORAGE_BACKEND', default='files.storage.MeteredFileSystemStorage')},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+}
+S3_ENDPOINT_URL = env('S3_ENDPOINT_URL', default='https://s3.amazonaws.com')  # Path-style, e.g. http://minio:9000
+S3_BUCKET = env('S3_BUCKET', default='')
+S3_ACCESS_KEY_ID = env('S3_ACCESS_KEY_ID', default='')
+S3_SECRET_ACCESS_KEY = env('S3_SECRET_ACCESS_KEY', default='')
+S3_REGION = env('S3_REGION', default='us-east-1')
+S3_PART_SIZE = env.int('S3_PART_SIZE', default=8 * 1024 * 1024)  # Multipart upload part size (S3 minimum 5 MiB)
+S3_READ_BUFFER = env.int('S3_READ_BUFFER', default=256 * 1024)  # Bytes fetched per ranged GET for small reads
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
@@ -150,6 +183,9 @@ CORS_ALLOW_CREDENTIALS = True
 
 CORS_ALLOW_HEADERS = [
     "accept",
+    "range",
+    "if-none-match",
+    "x-profile",
     "authorization",
     "content-type",
     "origin",
@@ -159,6 +195,17 @@ CORS_ALLOW_HEADERS = [
     "access-control-request-headers",
     "access-control-request-method",
 ]
+CORS_EXPOSE_HEADERS = [
+    "accept-ranges",
+    "content-length",
+    "content-range",
+    "etag",
+    "x-file-iv",
+    "x-client-key",
+    "x-file-name",
+    "x-media-type",
+    "x-profile-id",
+]
 CORS_ALLOW_METHODS = [
     "GET",
     "POST",
@@ -235,13 +282,128 @@ SECURE_HSTS_PRELOAD = True
 # EMAIL_HOST_PASSWORD = env('EMAIL_HOST_PASSWORD')
 # DEFAULT_FROM_EMAIL = env('DEFAULT_FROM_EMAIL')
 
-# CELERY_BROKER_URL = env('REDIS_URL')
+# Background jobs (Celery). The default filesystem broker needs no external
+# service; point CELERY_BROKER_URL at Redis/RabbitMQ in production, or set
+# CELERY_TASK_ALWAYS_EAGER to run jobs inline (tests, single-process dev).
+CELERY_BROKER_URL = env('CELERY_BROKER_URL', default='filesystem://')
+CELERY_BROKER_DIR = os.path.join(BASE_DIR, 'celery_broker')
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    'data_folder_in': CELERY_BROKER_DIR,
+    'data_folder_out': CELERY_BROKER_DIR,
+    'control_folder': os.path.join(CELERY_BROKER_DIR, 'control'),
+}
+if CELERY_BROKER_URL.startswith('filesystem://'):
+    os.makedirs(CELERY_BROKER_DIR, exist_ok=True)
+CELERY_TASK_ALWAYS_EAGER = env.bool('CELERY_TASK_ALWAYS_EAGER', default=False)
+CELERY_TASK_ACKS_LATE = True
+CELERY_BEAT_SCHEDULE = {
+    'purge-upload-sessions': {
+        'task': 'files.tasks.purge_upload_sessions',
+        'schedule': 60 * 60,
+    },
+}
+
+# Attempts made by the upload processing task before a file is marked Failed
+FILE_PROCESSING_MAX_RETRIES = 3
 
 # Media Files
 MEDIA_URL = '/media/'  # URL for accessing media files (served during development)
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media/')  # Directory for storing uploaded files
 
+# Server-side file encryption: plaintext bytes per segment and the number of
+# threads used to encrypt/decrypt segments in parallel
+FILE_SEGMENT_SIZE = env.int('FILE_SEGMENT_SIZE', default=1024 * 1024)
+FILE_CRYPTO_WORKERS = env.int('FILE_CRYPTO_WORKERS', default=os.cpu_count() or 1)
+# Threads that run blocking file I/O and crypto for the async (ASGI) views
+ASYNC_TRANSFER_WORKERS = env.int('ASYNC_TRANSFER_WORKERS', default=32)
+
+# Resumable upload sessions expire this long after their last received chunk
+UPLOAD_SESSION_TTL = timedelta(hours=24)
+
+# Page size of the cursor-paginated file listing (?scope=owned|shared)
+FILE_LIST_PAGE_SIZE = 50
+FILE_LIST_MAX_PAGE_SIZE = 500
+
+# Seconds a view/download permission decision stays in the shared cache.
+# Changes to File and FileAccess invalidate it immediately. Decisions are
+# not cached at all while CACHE_URL is a per-process (locmem) backend.
+FILE_ACCESS_CACHE_TTL = env.int('FILE_ACCESS_CACHE_TTL', default=300)
+
+# Seconds a resolved share link stays in the shared cache (never past its
+# expiry). Deleting or regenerating the link invalidates it immediately.
+SHARE_LINK_CACHE_TTL = env.int('SHARE_LINK_CACHE_TTL', default=300)
+
+# Largest number of files in one streamed ZIP download
+FILE_ARCHIVE_MAX_FILES = 1000
+
+# Largest number of file/user pairs one bulk grant/revoke request may touch
+BULK_ACCESS_MAX_ITEMS = 20000
+
+# Server keys (see files/keys.py). "generate" creates missing key files on
+# first start, for a single development node. "strict" requires every key
+# to be provisioned from the paths or environment variables below and
+# refuses to start unless they match KEY_FINGERPRINT, which every node of a
+# deployment shares (print it with `manage.py key_fingerprint`).
+KEY_PROVISIONING = env('KEY_PROVISIONING', default='generate')
+KEY_FINGERPRINT = env('KEY_FINGERPRINT', default='')
+SERVER_AES_KEY = env('SERVER_AES_KEY', default='')  # Base64 of the 32-byte key; overrides SERVER_AES_KEY_PATH
+SERVER_AES_KEY_PATH = env('SERVER_AES_KEY_PATH', default=os.path.join(BASE_DIR, 'server_aes.key'))
+
+# Server AES keys by key ID. Blobs record the ID of the key they are
+# encrypted with and new blobs use the active key; rotate_blob_key moves
+# older blobs onto it. SERVER_AES_KEY / SERVER_AES_KEY_PATH give key v1,
+# which also reads blobs written before key IDs were recorded. Further keys
+# are read from files, e.g. AES_KEY_PATHS=v2=/run/secrets/server_aes_v2.key.
+# Keys listed in AES_RETIRED_KEY_IDS are not loaded at all.
+AES_ACTIVE_KEY_ID = env('AES_ACTIVE_KEY_ID', default='v1')
+AES_LEGACY_KEY_ID = 'v1'
+AES_RETIRED_KEY_IDS = env.list('AES_RETIRED_KEY_IDS', default=[])
+AES_KEYS = {
+    key_id: source for key_id, source in {
+        AES_LEGACY_KEY_ID: {"key": SERVER_AES_KEY} if SERVER_AES_KEY else {"path": SERVER_AES_KEY_PATH},
+        **{key_id: {"path": path} for key_id, path in env.dict('AES_KEY_PATHS', default={}).items()},
+    }.items() if key_id not in AES_RETIRED_KEY_IDS
+}
 
 # Paths for private and public key files
-PRIVATE_KEY_PATH = os.path.join(BASE_DIR, 'private_key.pem')
-PUBLIC_KEY_PATH = os.path.join(BASE_DIR, 'public_key.pem')
+PRIVATE_KEY_PATH = env('PRIVATE_KEY_PATH', default=os.path.join(BASE_DIR, 'private_key.pem'))
+PUBLIC_KEY_PATH = env('PUBLIC_KEY_PATH', default=os.path.join(BASE_DIR, 'public_key.pem'))
+SERVER_RSA_PRIVATE_KEY = env('SERVER_RSA_PRIVATE_KEY', default='').replace('\\n', '\n')  # PEM; overrides the paths
+
+# RSA key pairs by key ID. New uploads are wrapped with the active key; every
+# listed pair can still unwrap the files wrapped with it. v1 is the pair above;
+# further pairs are given as private,public paths separated by ";", e.g.
+# RSA_KEY_PATHS=v2=/run/secrets/v2_private.pem,/run/secrets/v2_public.pem
+RSA_ACTIVE_KEY_ID = env('RSA_ACTIVE_KEY_ID', default='v1')
+RSA_KEYS = {
+    'v1': (
+        {"pem": SERVER_RSA_PRIVATE_KEY} if SERVER_RSA_PRIVATE_KEY
+        else {"private": PRIVATE_KEY_PATH, "public": PUBLIC_KEY_PATH}
+    ),
+    **{
+        key_id: {"private": private, "public": public}
+        for key_id, (private, public) in env.dict('RSA_KEY_PATHS', cast={'value': list}, default={}).items()
+    },
+}
+RSA_KEY_RELOAD_INTERVAL = 5  # Seconds between checks for changed PEM files
+
+# Optional in-memory cache of unwrapped client keys, keyed by file ID. Saves
+# an RSA private-key operation when a file is re-opened within TTL seconds.
+CLIENT_KEY_CACHE = {
+    "ENABLED": env.bool('CLIENT_KEY_CACHE_ENABLED', default=False),
+    "TTL": env.int('CLIENT_KEY_CACHE_TTL', default=60),
+    "MAX_ENTRIES": env.int('CLIENT_KEY_CACHE_MAX_ENTRIES', default=1024),
+}
+
+# Optional in-memory cache of server-decrypted payloads (still encrypted with
+# the client key) for hot files. MAX_BYTES bounds the whole cache per process;
+# files larger than MAX_ITEM_BYTES are always streamed from storage.
+PAYLOAD_CACHE = {
+    "ENABLED": env.bool('PAYLOAD_CACHE_ENABLED', default=False),
+    "MAX_BYTES": env.int('PAYLOAD_CACHE_MAX_BYTES', default=256 * 1024 * 1024),
+    "MAX_ITEM_BYTES": env.int('PAYLOAD_CACHE_MAX_ITEM_BYTES', default=16 * 1024 * 1024),
+}
+
+# Seconds a request waits for an identical in-flight key unwrap or payload
+# load started by another request before giving up
+SINGLE_FLIGHT_TIMEOUT = 60
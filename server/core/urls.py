@@ -14,11 +14,14 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+import hmac
 from django.contrib import admin
 from django.urls import path, include
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse
 from django.conf import settings
 from django.conf.urls.static import static
+from . import metrics as metrics_registry
+from .views import ProfileDetailView, ProfileListView
 
 
 def home(request):
@@ -27,9 +30,27 @@ def home(request):
 
     return JsonResponse({"name": "keshav"})
 
+
+def metrics(request):
+    """
+    Prometheus scrape endpoint; requires METRICS_TOKEN as a bearer token.
+    Without a token it is only served while DEBUG is on.
+    """
+    if not settings.METRICS_TOKEN:
+        if not settings.DEBUG:
+            return JsonResponse({"error": "Metrics are disabled; set METRICS_TOKEN"}, status=404)
+    elif not hmac.compare_digest(
+        request.headers.get("Authorization", "").encode(), f"Bearer {settings.METRICS_TOKEN}".encode()
+    ):
+        return JsonResponse({"error": "Unauthorized"}, status=401)
+    return HttpResponse(metrics_registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('home/', home),  
+    path('metrics/', metrics, name='metrics'),
+    path('profiles/', ProfileListView.as_view(), name='profile-list'),  # Admin request profiles
+    path('profiles/<str:profile_id>/', ProfileDetailView.as_view(), name='profile-detail'),
     path('users/', include('users.urls')),
     path('files/', include('files.urls')),
 ]
@@ -0,0 +1,23 @@
+from django.http import JsonResponse
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.views import APIView
+from users.permissions import IsAdmin
+from .profiling import get_profile, recent_profiles
+
+
+class ProfileListView(APIView):
+    permission_classes = [IsAuthenticated, IsAdmin]
+
+    def get(self, request):
+        """Summaries of the stored request profiles, newest first."""
+        return JsonResponse({"profiles": recent_profiles()}, status=200)
+
+
+class ProfileDetailView(APIView):
+    permission_classes = [IsAuthenticated, IsAdmin]
+
+    def get(self, request, profile_id):
+        profile = get_profile(profile_id)
+        if profile is None:
+            return JsonResponse({"error": "Profile not found or expired"}, status=404)
+        return JsonResponse(profile, status=200)
@@ -0,0 +1,85 @@
+"""
+Single place that decides whether a user may view or download a file.
+
+Decisions are memoised on the request and kept in the shared Django cache.
+Cache keys carry a per-file version that files/signals.py bumps whenever
+the file or one of its FileAccess rows changes, so a stale decision is
+never served once the change is committed. A per-process cache (the
+locmem default) could not see bumps made by other workers, so decisions
+are only cached when CACHE_URL points at a shared backend.
+"""
+import uuid
+from typing import NamedTuple
+from django.conf import settings
+from django.core.cache import cache
+from .cache import shared_cache_configured
+from .models import FileAccess
+
+
+class AccessDecision(NamedTuple):
+    is_owner: bool
+    can_view: bool
+    can_download: bool
+
+
+NO_ACCESS = AccessDecision(False, False, False)
+OWNER_ACCESS = AccessDecision(True, True, True)
+
+
+def _version_key(file_id):
+    return f"file-access:{file_id}:version"
+
+
+def _file_version(file_id):
+    version = cache.get(_version_key(file_id))
+    if version is None:
+        version = uuid.uuid4().hex
+        if not cache.add(_version_key(file_id), version, None):
+            version = cache.get(_version_key(file_id), version)
+    return version
+
+
+def invalidate_file_access(file_id):
+    """Drop every cached decision for a file."""
+    cache.set(_version_key(file_id), uuid.uuid4().hex, None)
+
+
+def _lookup(user_id, file):
+    if file.owner_id == user_id:
+        return OWNER_ACCESS
+
+    shared = shared_cache_configured()
+    if shared:
+        key = f"file-access:{file.id}:{_file_version(file.id)}:{user_id}"
+        cached = cache.get(key)
+        if cached is not None:
+            return AccessDecision(*cached)
+
+    access = FileAccess.objects.filter(file_id=file.id, user_id=user_id).values_list(
+        "can_view", "can_download"
+    ).first()
+    decision = AccessDecision(False, *access) if access else NO_ACCESS
+    if shared:
+        cache.set(key, tuple(decision), settings.FILE_ACCESS_CACHE_TTL)
+    return decision
+
+
+def resolve_access(request, file):
+    """
+    AccessDecision of request.user for file. Repeated checks within a
+    request are answered from a memo on the request.
+    """
+    memo = getattr(request, "_file_access_memo", None)
+    if memo is None:
+        memo = request._file_access_memo = {}
+    if file.id not in memo:
+        memo[file.id] = _lookup(request.user.id, file)
+    return memo[file.id]
+
+
+def can_view(request, file):
+    return resolve_access(request, file).can_view
+
+
+def can_download(request, file):
+    return resolve_access(request, file).can_download
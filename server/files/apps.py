@@ -1,6 +1,5 @@
 from django.apps import AppConfig
-from .utils import generate_rsa_keys
-from django.conf import settings
+from .keys import check_keys
 
 class FilesConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
@@ -8,5 +7,6 @@ class FilesConfig(AppConfig):
 
 
     def ready(self):
-        generate_rsa_keys(settings.PRIVATE_KEY_PATH, settings.PUBLIC_KEY_PATH)
+        check_keys()  # Fails startup if the server keys are missing or differ from the other nodes'
+        from . import signals  # noqa: F401  Connects access-cache invalidation
 
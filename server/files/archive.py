@@ -0,0 +1,45 @@
+import time
+import zipfile
+
+
+class _ZipSink:
+    """
+    Write-only target for ZipFile. It has no tell/seek, so ZipFile streams
+    entries with data descriptors, and stream_zip drains it after each write.
+    """
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def stream_zip(entries):
+    """
+    Yield a ZIP archive of entries, an iterable of (name, chunks) pairs,
+    without buffering more than one chunk. Entries are stored uncompressed
+    and chunks are only pulled when the archive reaches that entry.
+    """
+    sink = _ZipSink()
+    with zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_STORED) as archive:
+        for name, chunks in entries:
+            info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+            with archive.open(info, mode="w", force_zip64=True) as entry:
+                for chunk in chunks:
+                    entry.write(chunk)
+                    data = sink.drain()
+                    if data:
+                        yield data
+            data = sink.drain()
+            if data:
+                yield data
+    yield sink.drain()  # Central directory
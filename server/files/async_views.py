@@ -0,0 +1,171 @@
+"""
+Async versions of the upload, download and render endpoints, for use under
+ASGI (core.asgi:application). The event loop only coordinates: blocking
+file I/O and CPU-bound crypto run on a bounded transfer executor, and ORM
+calls go through sync_to_async. A slow client therefore holds a coroutine,
+not a worker thread.
+"""
+import asyncio
+import base64
+import functools
+import mimetypes
+from concurrent.futures import ThreadPoolExecutor
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from .models import File
+from .access import can_download, can_view
+from .enums import FileStatusChoices
+from .utils import unwrap_client_key
+from .views import (
+    client_encrypted_payload, conditional_response, file_etag, record_upload, set_cache_headers, stage_upload,
+    stream_file_response,
+)
+
+
+transfer_executor = ThreadPoolExecutor(
+    max_workers=settings.ASYNC_TRANSFER_WORKERS, thread_name_prefix="file-transfer"
+)
+
+
+async def run_blocking(fn, *args):
+    """Run a blocking call on the transfer executor."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(transfer_executor, functools.partial(fn, *args))
+
+
+async def iterate_blocking(iterator):
+    """Drive a blocking iterator from the event loop, one chunk per executor call."""
+    done = object()
+    while True:
+        chunk = await run_blocking(next, iterator, done)
+        if chunk is done:
+            return
+        yield chunk
+
+
+def authenticate_request(request):
+    """Resolve the JWT bearer token the same way the DRF views do."""
+    try:
+        result = JWTAuthentication().authenticate(request)
+    except AuthenticationFailed:
+        return None
+    return result[0] if result else None
+
+
+def get_accessible_file(request, file_id, require_download):
+    """
+    Load a file the user may read, or None. Same checks as FileDownloadView
+    (download permission) and FileRenderView (view permission).
+    """
+    file = File.objects.get(id=file_id)
+    allowed = can_download if require_download else can_view
+    return file if allowed(request, file) else None
+
+
+class AsyncAPIView(View):
+    """
+    Small async counterpart of APIView: JWT authentication and the role
+    check happen before the handler runs, and views are CSRF exempt.
+    """
+    require_regular_user = False
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        return csrf_exempt(super().as_view(**initkwargs))
+
+    async def dispatch(self, request, *args, **kwargs):
+        user = await sync_to_async(authenticate_request)(request)
+        if user is None:
+            return JsonResponse({"detail": "Authentication credentials were not provided."}, status=401)
+        if self.require_regular_user and user.role not in ("Regular User", "Admin"):
+            return JsonResponse({"detail": "You do not have permission to perform this action."}, status=403)
+        request.user = user
+        return await super().dispatch(request, *args, **kwargs)
+
+
+class AsyncFileUploadView(AsyncAPIView):
+    require_regular_user = True
+
+    async def post(self, request):
+        try:
+            # Multipart parsing reads the spooled request body
+            files, data = await run_blocking(lambda: (request.FILES, request.POST))
+            file = files["file"]
+            encrypted_key = data["encrypted_key"]
+            iv = data["iv"]
+
+            if not file or not encrypted_key or not iv:
+                return JsonResponse({"error": "Missing required fields"}, status=400)
+
+            # Stage the bytes and wrap the key on the transfer executor; only
+            # the ORM write and the enqueue need the thread-sensitive wrapper
+            staged = await run_blocking(stage_upload, file, encrypted_key)
+            uploaded_file = await sync_to_async(record_upload)(request.user, file, iv, staged)
+
+            return JsonResponse(
+                {"message": "File uploaded successfully", "file_id": uploaded_file.id, "status": uploaded_file.status},
+                status=202,
+            )
+        except KeyError:
+            return JsonResponse({"error": "Invalid request format"}, status=400)
+        except Exception as e:
+            return JsonResponse({"error": str(e)}, status=400)
+
+
+class AsyncFileDownloadView(AsyncAPIView):
+    require_download = True
+
+    async def get(self, request, file_id):
+        try:
+            file = await sync_to_async(get_accessible_file)(request, file_id, self.require_download)
+            if file is None:
+                return JsonResponse({"error": "Access denied"}, status=403)
+
+            if file.status != FileStatusChoices.READY.value:
+                return JsonResponse({"error": "File is still being processed", "status": file.status}, status=409)
+
+            # Answer revalidations before any RSA or AES work
+            raw = request.GET.get("mode") == "raw"
+            etag = file_etag(file, "raw" if raw else "json")
+            not_modified = conditional_response(request, etag)
+            if not_modified is not None:
+                return not_modified
+
+            # Decrypt server key
+            decrypted_key = await run_blocking(unwrap_client_key, file)
+
+            # ?mode=raw streams the bytes instead of base64 JSON
+            if raw:
+                response = await run_blocking(stream_file_response, request, file, decrypted_key)
+                if response.streaming:
+                    response.streaming_content = iterate_blocking(iter(response.streaming_content))
+                return set_cache_headers(response, etag)
+
+            client_encrypted_data = await run_blocking(client_encrypted_payload, file)
+            encoded_file = await run_blocking(base64.b64encode, client_encrypted_data)
+
+            content_type, _ = mimetypes.guess_type(file.name)
+            if not content_type:
+                content_type = 'application/octet-stream'
+
+            response_data = {
+                "encrypted_file": encoded_file.decode("utf-8"),
+                "iv": base64.b64encode(file.iv).decode("utf-8"),
+                "client_key": base64.b64encode(decrypted_key).decode("utf-8"),
+                "original_name": file.name,
+                "media_type": content_type,
+            }
+            return set_cache_headers(JsonResponse(response_data, status=200), etag)
+        except File.DoesNotExist:
+            return JsonResponse({"error": "File not found"}, status=404)
+        except Exception as e:
+            return JsonResponse({"error": str(e)}, status=400)
+
+
+class AsyncFileRenderView(AsyncFileDownloadView):
+    require_download = False
@@ -0,0 +1,117 @@
+"""
+Content-addressed blob store. A Blob holds the server-encrypted content for
+one SHA-256 of client-encrypted bytes and counts the File rows pointing at
+it, so identical uploads share one stored copy.
+
+References are taken and released in the same transaction that links or
+deletes the File, and the stored bytes are removed once the transaction
+that drops the last reference commits.
+"""
+import os
+import shutil
+import uuid
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from core.metrics import BLOB_UPLOADS
+from .encrypt import EncryptedChunks
+from .models import Blob
+
+LINKED_FIELDS = ["blob", "encrypted_file", "sha256", "status", "processing_error"]
+
+# Blobs are sharded two levels deep by hash prefix (blobs/ab/cd/abcd...),
+# keeping every directory small however many files are stored
+SHARDED_NAME = r"^blobs/[0-9a-f]{2}/[0-9a-f]{2}/"
+
+
+def blob_name(sha256, suffix=None):
+    # Each write gets its own suffix, so a failed or losing write can be
+    # removed without touching a concurrent writer's copy
+    suffix = suffix or uuid.uuid4().hex[:8]
+    return f"blobs/{sha256[:2]}/{sha256[2:4]}/{sha256}_{suffix}"
+
+
+def copy_content(source, target):
+    """
+    Store the content of source under target as well, hard-linking when
+    storage is on the local filesystem. Any copy left at target by an
+    interrupted earlier attempt is replaced.
+    """
+    default_storage.delete(target)
+    try:
+        source_path, target_path = default_storage.path(source), default_storage.path(target)
+    except NotImplementedError:
+        with default_storage.open(source, "rb") as content:
+            default_storage.save(target, content)
+        return
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    try:
+        os.link(source_path, target_path)
+    except OSError:
+        shutil.copyfile(source_path, target_path)  # Different filesystem, or no hard links
+
+
+def write_blob(sha256, encrypted_chunks):
+    """Save the chunks under a fresh name and return it."""
+    name = blob_name(sha256)
+    try:
+        return default_storage.save(name, EncryptedChunks(encrypted_chunks, name))
+    except BaseException:
+        default_storage.delete(name)
+        raise
+
+
+def _link(file, blob):
+    file.blob = blob
+    file.encrypted_file.name = blob.encrypted_file.name
+    file.sha256 = blob.sha256
+    file.save(update_fields=LINKED_FIELDS)
+
+
+def link_blob(file, sha256, encrypted_chunks, aes_key_id):
+    """
+    Point file at the blob for sha256 and save it with a reference taken.
+    encrypted_chunks() is only called, and the content only written, when
+    no blob for sha256 exists yet; aes_key_id names the server key it is
+    encrypted with. Returns True if the upload was a duplicate.
+    """
+    while True:
+        with transaction.atomic():
+            if Blob.objects.filter(sha256=sha256).update(ref_count=F("ref_count") + 1):
+                _link(file, Blob.objects.get(sha256=sha256))
+                BLOB_UPLOADS.inc(outcome="deduplicated")
+                return True
+
+        name = write_blob(sha256, encrypted_chunks())
+        try:
+            with transaction.atomic():
+                blob = Blob.objects.create(
+                    sha256=sha256, encrypted_file=name, size=default_storage.size(name), ref_count=1,
+                    aes_key_id=aes_key_id,
+                )
+                _link(file, blob)
+        except IntegrityError:
+            # Another upload of the same content stored it first; use theirs
+            default_storage.delete(name)
+            continue
+        except BaseException:
+            default_storage.delete(name)
+            raise
+        BLOB_UPLOADS.inc(outcome="stored")
+        return False
+
+
+def release_blob(blob_id):
+    """
+    Drop one reference to a blob, deleting the row and, once the
+    transaction commits, its stored content when it was the last one.
+    """
+    with transaction.atomic():
+        Blob.objects.filter(id=blob_id).update(ref_count=F("ref_count") - 1)
+        blob = Blob.objects.filter(id=blob_id, ref_count=0).first()
+        if blob is None:
+            return False
+        blob.delete()
+        name = blob.encrypted_file.name
+        transaction.on_commit(lambda: default_storage.delete(name))
+        return True
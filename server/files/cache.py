@@ -0,0 +1,151 @@
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+
+# Django cache backends private to one process
+LOCAL_CACHE_BACKENDS = (
+    "django.core.cache.backends.locmem.LocMemCache",
+    "django.core.cache.backends.dummy.DummyCache",
+)
+
+
+def shared_cache_configured():
+    """
+    Whether the default Django cache is shared between processes. Entries
+    that every process must see invalidated are only cached in a shared one.
+    """
+    return settings.CACHES["default"]["BACKEND"] not in LOCAL_CACHE_BACKENDS
+
+
+class TTLCache:
+    """
+    Thread-safe in-process cache with a per-entry time to live and LRU
+    eviction once max_entries is reached.
+    """
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            if entry[0] <= time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SegmentedLRUCache:
+    """
+    Thread-safe cache of byte strings bounded by their total size. Entries
+    start in a probationary segment and move to the protected segment
+    (max protected_ratio of the budget) when hit again, so one scan over
+    many cold files cannot flush the hot ones. Eviction takes the least
+    recently used probationary entry first. Values larger than
+    max_item_bytes are never stored.
+    """
+    def __init__(self, max_bytes, max_item_bytes, protected_ratio=0.8):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = min(max_item_bytes, max_bytes)
+        self.max_protected_bytes = int(max_bytes * protected_ratio)
+        self._probation = OrderedDict()
+        self._protected = OrderedDict()
+        self._probation_bytes = 0
+        self._protected_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def size_bytes(self):
+        return self._probation_bytes + self._protected_bytes
+
+    def get(self, key):
+        with self._lock:
+            value = self._protected.get(key)
+            if value is not None:
+                self._protected.move_to_end(key)
+                self.hits += 1
+                return value
+
+            value = self._probation.pop(key, None)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._probation_bytes -= len(value)
+            self._protected[key] = value
+            self._protected_bytes += len(value)
+            # Demote the coldest protected entries back to probation
+            while self._protected_bytes > self.max_protected_bytes and len(self._protected) > 1:
+                demoted_key, demoted = self._protected.popitem(last=False)
+                self._protected_bytes -= len(demoted)
+                self._probation[demoted_key] = demoted
+                self._probation_bytes += len(demoted)
+            self._evict()
+            return value
+
+    def set(self, key, value):
+        if len(value) > self.max_item_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._probation[key] = value
+            self._probation_bytes += len(value)
+            self._evict()
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._probation.clear()
+            self._protected.clear()
+            self._probation_bytes = self._protected_bytes = 0
+
+    def _remove(self, key):
+        value = self._probation.pop(key, None)
+        if value is not None:
+            self._probation_bytes -= len(value)
+        value = self._protected.pop(key, None)
+        if value is not None:
+            self._protected_bytes -= len(value)
+
+    def _evict(self):
+        while self.size_bytes > self.max_bytes:
+            segment = self._probation if self._probation else self._protected
+            _, value = segment.popitem(last=False)
+            if segment is self._probation:
+                self._probation_bytes -= len(value)
+            else:
+                self._protected_bytes -= len(value)
+            self.evictions += 1
+
+    def __len__(self):
+        return len(self._probation) + len(self._protected)
@@ -1,27 +1,145 @@
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.primitives import padding
 from cryptography.hazmat.backends import default_backend
 from django.conf import settings
+from django.core.files import File
 import os
 import base64
 import struct
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from core.metrics import AES_BYTES, AES_SECONDS, STORAGE_BYTES, STORAGE_SECONDS
+from core.profiling import current_profile, record_stage
+from .keys import AES_KEY_ID_SIZE, load_aes_keys
+
+# Segmented at-rest container (version 2):
+#   header:  magic + version + flags + segment_size + data_size + segment_count
+#            + ID of the server AES key, NUL-padded
+#   table:   one (offset, length, nonce) entry per segment
+#   body:    AES-256 GCM ciphertext + tag of each segment, in order
+# Version 1 headers have no key ID; they were all written with
+# AES_LEGACY_KEY_ID. Blobs written before the container existed are a single
+# AES-256 CBC stream (iv + encrypted_data + data_size) under that key too, and
+# are still read through LegacyBlobReader.
+SEGMENT_MAGIC = b'SFSSEG'
+SEGMENT_VERSION = 2
+SEGMENT_HEADER = struct.Struct('<6sBBIQI')
+SEGMENT_KEY_ID = struct.Struct(f'<{AES_KEY_ID_SIZE}s')
+SEGMENT_ENTRY = struct.Struct('<QI12s')
+SEGMENT_TAG_SIZE = 16
+
+
+def segment_header_size(version):
+    return SEGMENT_HEADER.size + (SEGMENT_KEY_ID.size if version >= 2 else 0)
+
+
+def unpack_segment_header(header):
+    """(version, segment_size, data_size, segment_count, key_id) of a container header"""
+    _, version, _, segment_size, data_size, segment_count = SEGMENT_HEADER.unpack_from(header)
+    key_id = settings.AES_LEGACY_KEY_ID
+    if version >= 2:
+        raw_key_id = SEGMENT_KEY_ID.unpack_from(header, SEGMENT_HEADER.size)[0]
+        key_id = raw_key_id.rstrip(b'\0').decode('ascii', errors='replace')
+    return version, segment_size, data_size, segment_count, key_id
+
+
+def metered_aes(fn, operation):
+    """
+    Wrap an AESGCM encrypt/decrypt call to record its time and bytes. The
+    request profile is looked up here because calls may run on pool threads.
+    """
+    profile = current_profile()
+
+    def call(nonce, data, aad):
+        started = time.perf_counter()
+        result = fn(nonce, data, aad)
+        elapsed = time.perf_counter() - started
+        AES_SECONDS.observe(elapsed, operation=operation)
+        AES_BYTES.inc(len(data), operation=operation)
+        record_stage(profile, f"aes.{operation}", elapsed, len(data))
+        return result
+    return call
+
+
+def metered_read(encrypted_file, offset, length):
+    """Read length bytes at offset of an encrypted blob, recording the I/O"""
+    started = time.perf_counter()
+    if offset is not None:
+        encrypted_file.seek(offset)
+    data = encrypted_file.read(length)
+    elapsed = time.perf_counter() - started
+    STORAGE_SECONDS.observe(elapsed, operation="read")
+    STORAGE_BYTES.inc(len(data), operation="read")
+    record_stage(current_profile(), "storage.read", elapsed, len(data))
+    return data
+
+
+class SegmentPool:
+    """
+    Bounded thread pool for segment encryption and decryption. Segments are
+    independent, and the AES-GCM calls run outside the GIL, so they spread
+    across cores. Results are yielded in submission order and at most two
+    segments per worker are in flight, which keeps memory bounded.
+    """
+    def __init__(self, workers):
+        self.workers = max(workers, 1)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix='segment-crypto'
+                )
+            return self._executor
+
+    def map(self, fn, items):
+        """Apply fn to each argument tuple in items, yielding results in order"""
+        if self.workers == 1:
+            for args in items:
+                yield fn(*args)
+            return
+
+        executor = self._get_executor()
+        pending = deque()
+        try:
+            for args in items:
+                pending.append(executor.submit(fn, *args))
+                if len(pending) >= self.workers * 2:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # The consumer stopped early (e.g. client disconnected)
+            for future in pending:
+                future.cancel()
+
 
 class AESFileEncryption:
     def __init__(self):
-        self.key = self._get_or_create_key()
+        self.keys = self._get_or_create_keys()
+        self.active_key_id = settings.AES_ACTIVE_KEY_ID  # Key for everything encrypted from now on
         self.backend = default_backend()
         self.BLOCK_SIZE = 16  # AES block size in bytes
-        
-    def _get_or_create_key(self):
-        key_path = os.path.join(settings.BASE_DIR, 'server_aes.key')
-        if os.path.exists(key_path):
-            with open(key_path, 'rb') as key_file:
-                return key_file.read()
-        else:
-            key = os.urandom(32)  # 256 bits
-            with open(key_path, 'wb') as key_file:
-                key_file.write(key)
-            return key
+        self.CHUNK_SIZE = 64 * 1024  # Read size for streaming encryption
+        self.SEGMENT_SIZE = settings.FILE_SEGMENT_SIZE  # Plaintext bytes per independently encrypted segment
+        self.pool = SegmentPool(settings.FILE_CRYPTO_WORKERS)
+
+    def _get_or_create_keys(self):
+        # Read from the configured sources; only created when KEY_PROVISIONING is "generate"
+        return load_aes_keys()
+
+    def key_for(self, key_id):
+        """The server AES key with this ID"""
+        try:
+            return self.keys[key_id]
+        except KeyError:
+            raise ValueError(f"Server AES key {key_id!r} is not configured")
 
     def _pad(self, data):
         """Add PKCS#7 padding"""
@@ -35,72 +153,314 @@ class AESFileEncryption:
         data = unpadder.update(padded_data) + unpadder.finalize()
         return data
 
+    def _segment_aad(self, header, index):
+        """Bind a segment to its file header and position"""
+        return header + struct.pack('<I', index)
+
+    def _split_segments(self, chunks, segment_size):
+        """Regroup an iterable of byte chunks into segment_size pieces"""
+        buffer = bytearray()
+        for chunk in chunks:
+            buffer += chunk
+            while len(buffer) >= segment_size:
+                yield bytes(buffer[:segment_size])
+                del buffer[:segment_size]
+        if buffer:
+            yield bytes(buffer)
+
     def encrypt_file(self, file_content):
         """
-        Encrypt file content using AES-256 CBC
-        Returns: iv + encrypted_data + data_size
+        Encrypt file content using AES-256 GCM segments
+        Returns: header + segment table + encrypted segments
+        """
+        return b''.join(self.encrypt_stream([file_content], len(file_content)))
+
+    def segment_header(self, data_size, segment_size=None, key_id=None, version=SEGMENT_VERSION):
+        """
+        Fixed-size container header for data_size bytes split into segments
+        and encrypted with key_id (the active key by default)
+        """
+        segment_size = segment_size or self.SEGMENT_SIZE
+        segment_count = -(-data_size // segment_size)
+        header = SEGMENT_HEADER.pack(
+            SEGMENT_MAGIC, version, 0, segment_size, data_size, segment_count
+        )
+        if version >= 2:
+            header += SEGMENT_KEY_ID.pack((key_id or self.active_key_id).encode('ascii'))
+        return header
+
+    def session_header(self, session):
+        """
+        Container header of an upload session, under the key its chunks are
+        encrypted with. Sessions started before key IDs existed keep the
+        version 1 header their chunks were authenticated against.
+        """
+        if session.aes_key_id is None:
+            return self.segment_header(session.size, session.chunk_size, version=1)
+        return self.segment_header(session.size, session.chunk_size, session.aes_key_id)
+
+    def segment_table(self, header, nonces):
+        """
+        Segment table for a header; offsets and lengths follow from the sizes
+        """
+        _, segment_size, data_size, segment_count, _ = unpack_segment_header(header)
+        offset = len(header) + SEGMENT_ENTRY.size * segment_count
+        table = []
+        for index, nonce in enumerate(nonces):
+            length = min(segment_size, data_size - index * segment_size) + SEGMENT_TAG_SIZE
+            table.append(SEGMENT_ENTRY.pack(offset, length, nonce))
+            offset += length
+        return b''.join(table)
+
+    def encrypt_segment(self, header, index, segment):
+        """
+        Encrypt one segment on its own, e.g. as an upload chunk arrives
+        Returns: (nonce, encrypted_segment)
+        """
+        nonce = os.urandom(12)
+        key = self.key_for(unpack_segment_header(header)[4])
+        encrypt = metered_aes(AESGCM(key).encrypt, "encrypt")
+        return nonce, encrypt(nonce, segment, self._segment_aad(header, index))
+
+    def decrypt_segment(self, header, index, nonce, encrypted_segment):
+        """
+        Decrypt and authenticate one segment produced by encrypt_segment
+        """
+        key = self.key_for(unpack_segment_header(header)[4])
+        decrypt = metered_aes(AESGCM(key).decrypt, "decrypt")
+        return decrypt(nonce, encrypted_segment, self._segment_aad(header, index))
+
+    def encrypt_stream(self, chunks, data_size, key_id=None):
+        """
+        Encrypt an iterable of byte chunks into the segmented container, with
+        key_id or the active key. data_size must be known up front so the
+        header and segment table can be written first; only one segment is
+        held in memory at a time.
         """
         try:
-            # Generate IV
-            iv = os.urandom(self.BLOCK_SIZE)
-            
-            # Pad the data
-            padded_data = self._pad(file_content)
-            
-            # Create cipher
-            cipher = Cipher(
-                algorithms.AES(self.key),
-                modes.CBC(iv),
-                backend=self.backend
-            )
-            
-            # Encrypt
-            encryptor = cipher.encryptor()
-            encrypted_data = encryptor.update(padded_data) + encryptor.finalize()
-            
-            # Store original data size
-            original_size = len(file_content)
-            size_bytes = struct.pack('<Q', original_size)
-            
-            # Combine IV + encrypted data + original size
-            return iv + encrypted_data + size_bytes
-            
+            segment_size = self.SEGMENT_SIZE
+            key_id = key_id or self.active_key_id
+            aesgcm = AESGCM(self.key_for(key_id))
+            header = self.segment_header(data_size, segment_size, key_id)
+            segment_count = unpack_segment_header(header)[3]
+            nonces = [os.urandom(12) for _ in range(segment_count)]
+
+            yield header + self.segment_table(header, nonces)
+
+            encrypted_size = 0
+
+            def plaintext_segments():
+                nonlocal encrypted_size
+                for index, segment in enumerate(self._split_segments(chunks, segment_size)):
+                    if index >= segment_count:
+                        raise ValueError("More data than the declared size")
+                    encrypted_size += len(segment)
+                    yield nonces[index], segment, self._segment_aad(header, index)
+
+            yield from self.pool.map(metered_aes(aesgcm.encrypt, "encrypt"), plaintext_segments())
+
+            if encrypted_size != data_size:
+                raise ValueError("Data size does not match the declared size")
+
         except Exception as e:
             raise Exception(f"Encryption failed: {str(e)}")
 
     def decrypt_file(self, encrypted_content):
         """
-        Decrypt file content using AES-256 CBC
-        Input format: iv + encrypted_data + data_size
+        Decrypt file content stored in either at-rest format
         """
         try:
+            if encrypted_content.startswith(SEGMENT_MAGIC):
+                reader = self.open_reader(BytesIO(encrypted_content))
+                if isinstance(reader, SegmentedBlobReader):
+                    return b''.join(reader.iter_range())
+
             # Extract IV (first 16 bytes) and size (last 8 bytes)
             iv = encrypted_content[:self.BLOCK_SIZE]
             size_bytes = encrypted_content[-8:]
             encrypted_data = encrypted_content[self.BLOCK_SIZE:-8]
-            
+
             # Get original file size
             original_size = struct.unpack('<Q', size_bytes)[0]
-            
+
             # Create cipher
             cipher = Cipher(
-                algorithms.AES(self.key),
+                algorithms.AES(self.key_for(settings.AES_LEGACY_KEY_ID)),
                 modes.CBC(iv),
                 backend=self.backend
             )
-            
+
             # Decrypt
+            started = time.perf_counter()
             decryptor = cipher.decryptor()
             padded_data = decryptor.update(encrypted_data) + decryptor.finalize()
-            
+            elapsed = time.perf_counter() - started
+            AES_SECONDS.observe(elapsed, operation="decrypt")
+            AES_BYTES.inc(len(encrypted_data), operation="decrypt")
+            record_stage(current_profile(), "aes.decrypt", elapsed, len(encrypted_data))
+
             # Remove padding
             decrypted_data = self._unpad(padded_data)
-            
+
             # Verify and return original size
             return decrypted_data[:original_size]
-            
+
         except Exception as e:
             raise Exception(f"Decryption failed: {str(e)}")
 
+    def open_reader(self, encrypted_file):
+        """
+        Return a random-access reader for an open encrypted file, picking the
+        segmented or legacy format from the header.
+        """
+        encrypted_file.seek(0, os.SEEK_END)
+        blob_size = encrypted_file.tell()
+        encrypted_file.seek(0)
+        prefix = encrypted_file.read(SEGMENT_HEADER.size)
+
+        if len(prefix) == SEGMENT_HEADER.size and prefix.startswith(SEGMENT_MAGIC):
+            reader = SegmentedBlobReader.from_header(self, encrypted_file, prefix, blob_size)
+            if reader is not None:
+                return reader
+        return LegacyBlobReader(self, encrypted_file, blob_size)
+
+    def decrypted_size(self, encrypted_file):
+        """
+        Original data size of an open encrypted file
+        """
+        return self.open_reader(encrypted_file).size
+
+    def decrypt_stream(self, encrypted_file, start=0, end=None):
+        """
+        Decrypt bytes [start, end) of an open encrypted file chunk by chunk
+        instead of loading the whole file into memory.
+        """
+        return self.open_reader(encrypted_file).iter_range(start, end)
+
+
+class SegmentedBlobReader:
+    """
+    Reads a segmented container, decrypting only the segments a range touches.
+    """
+    def __init__(self, encryption, encrypted_file, header, segment_size, size, table):
+        self.encryption = encryption
+        self.encrypted_file = encrypted_file
+        self.header = header
+        self.key_id = unpack_segment_header(header)[4]
+        self.segment_size = segment_size
+        self.size = size
+        self.table = table
+
+    @classmethod
+    def from_header(cls, encryption, encrypted_file, prefix, blob_size):
+        """
+        Parse the header starting with prefix and the segment table, or
+        return None if they do not describe this blob
+        """
+        magic, version, _, segment_size, size, segment_count = SEGMENT_HEADER.unpack(prefix)
+        if version not in (1, SEGMENT_VERSION) or not segment_size or segment_count != -(-size // segment_size):
+            return None
+
+        header = prefix + encrypted_file.read(segment_header_size(version) - len(prefix))
+        table_size = SEGMENT_ENTRY.size * segment_count
+        if len(header) != segment_header_size(version) or len(header) + table_size > blob_size:
+            return None
+        raw_table = encrypted_file.read(table_size)
+        table = list(SEGMENT_ENTRY.iter_unpack(raw_table))
+
+        expected_end = table[-1][0] + table[-1][1] if table else len(header)
+        if expected_end != blob_size:
+            return None
+        return cls(encryption, encrypted_file, header, segment_size, size, table)
+
+    def read_segments(self, indexes):
+        """Read encrypted segments in order, as decryption arguments"""
+        for index in indexes:
+            offset, length, nonce = self.table[index]
+            encrypted_segment = metered_read(self.encrypted_file, offset, length)
+            yield nonce, encrypted_segment, self.encryption._segment_aad(self.header, index)
+
+    def iter_range(self, start=0, end=None):
+        end = self.size if end is None else min(end, self.size)
+        if start >= end:
+            return
+        try:
+            indexes = range(start // self.segment_size, (end - 1) // self.segment_size + 1)
+            aesgcm = AESGCM(self.encryption.key_for(self.key_id))
+            segments = self.encryption.pool.map(metered_aes(aesgcm.decrypt, "decrypt"), self.read_segments(indexes))
+            for index, data in zip(indexes, segments):
+                segment_start = index * self.segment_size
+                yield data[max(start - segment_start, 0):end - segment_start]
+        except Exception as e:
+            raise Exception(f"Decryption failed: {str(e)}")
+
+
+class LegacyBlobReader:
+    """
+    Reads the original single-stream AES-256 CBC format. CBC decryption of a
+    block only needs the previous ciphertext block, so ranges can still be
+    served without decrypting from the start of the file.
+    """
+    def __init__(self, encryption, encrypted_file, blob_size):
+        self.encryption = encryption
+        self.encrypted_file = encrypted_file
+        self.blob_size = blob_size
+        self.key_id = settings.AES_LEGACY_KEY_ID
+        encrypted_file.seek(blob_size - 8)
+        self.size = struct.unpack('<Q', encrypted_file.read(8))[0]
+
+    def iter_range(self, start=0, end=None):
+        end = self.size if end is None else min(end, self.size)
+        if start >= end:
+            return
+        try:
+            block_size = self.encryption.BLOCK_SIZE
+            first_block = start // block_size
+            last_block = (end - 1) // block_size
+
+            # The block before first_block (or the IV) seeds the CBC chain
+            iv = metered_read(self.encrypted_file, first_block * block_size, block_size)
+            decryptor = Cipher(
+                algorithms.AES(self.encryption.key_for(self.key_id)),
+                modes.CBC(iv),
+                backend=self.encryption.backend
+            ).decryptor()
+
+            remaining = (last_block - first_block + 1) * block_size
+            skip = start - first_block * block_size
+            wanted = end - start
+            while remaining > 0:
+                encrypted_chunk = metered_read(self.encrypted_file, None, min(self.encryption.CHUNK_SIZE, remaining))
+                if not encrypted_chunk:
+                    raise ValueError("Unexpected end of encrypted data")
+                remaining -= len(encrypted_chunk)
+
+                started = time.perf_counter()
+                data = decryptor.update(encrypted_chunk)[skip:wanted + skip]
+                elapsed = time.perf_counter() - started
+                AES_SECONDS.observe(elapsed, operation="decrypt")
+                AES_BYTES.inc(len(encrypted_chunk), operation="decrypt")
+                record_stage(current_profile(), "aes.decrypt", elapsed, len(encrypted_chunk))
+                skip = 0
+                wanted -= len(data)
+                if data:
+                    yield data
+        except Exception as e:
+            raise Exception(f"Decryption failed: {str(e)}")
+
+
+class EncryptedChunks(File):
+    """
+    Present an iterable of already-encrypted chunks as a File so they can be
+    handed to FieldFile.save, e.g. when assembling an upload session.
+    """
+    def __init__(self, chunks, name):
+        super().__init__(None, name=name)
+        self._chunks = chunks
+
+    def chunks(self, chunk_size=None):
+        return iter(self._chunks)
+
+
 # Create global encryption instance
-aes_encryption = AESFileEncryption()
\ No newline at end of file
+aes_encryption = AESFileEncryption()
@@ -0,0 +1,11 @@
+from enum import Enum
+
+class FileStatusChoices(Enum):
+    PENDING = "Pending"
+    PROCESSING = "Processing"
+    READY = "Ready"
+    FAILED = "Failed"
+
+    @classmethod
+    def choices(cls):
+        return [(choice.value, choice.value) for choice in cls]
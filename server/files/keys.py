@@ -0,0 +1,185 @@
+"""
+Provisioning of the server keys: the AES keys that encrypt blobs at rest
+and the RSA pairs that wrap client keys.
+
+KEY_PROVISIONING selects how missing keys are handled:
+
+- "generate": a missing key file is created on first start. Creation is
+  atomic, so processes sharing a disk that race still end up with one key.
+  Meant for a single development node.
+- "strict": every key must come from its configured source (the key file
+  paths, or SERVER_AES_KEY / SERVER_RSA_PRIVATE_KEY in the environment),
+  and the process refuses to start unless the keys it loaded match
+  KEY_FINGERPRINT. Every node and worker configured with the same
+  fingerprint is therefore guaranteed to be able to read every blob.
+
+check_keys() runs from FilesConfig.ready(), so a misconfigured node fails
+at startup instead of on its first request.
+"""
+import base64
+import hashlib
+import os
+import re
+import tempfile
+from Crypto.PublicKey import RSA
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+GENERATE = "generate"
+STRICT = "strict"
+AES_KEY_SIZE = 32
+AES_KEY_ID_SIZE = 16
+AES_KEY_ID = re.compile(rf"[A-Za-z0-9._-]{{1,{AES_KEY_ID_SIZE}}}")
+
+
+def provisioning_mode():
+    mode = settings.KEY_PROVISIONING
+    if mode not in (GENERATE, STRICT):
+        raise ImproperlyConfigured(f"KEY_PROVISIONING must be {GENERATE!r} or {STRICT!r}, not {mode!r}")
+    return mode
+
+
+def create_exclusive(path, data):
+    """
+    Write data to path unless it already exists. The content is written to
+    a temporary file and linked into place, so a concurrent reader never
+    sees a partial key and only one of several racing writers wins.
+    """
+    directory = os.path.dirname(path) or "."
+    handle, temp_path = tempfile.mkstemp(dir=directory, prefix=".key-")
+    try:
+        with os.fdopen(handle, "wb") as temp_file:
+            temp_file.write(data)
+        os.chmod(temp_path, 0o600)
+        try:
+            os.link(temp_path, path)
+        except FileExistsError:
+            pass  # Another process created it first; use theirs
+    finally:
+        os.remove(temp_path)
+
+
+def load_aes_key(key_id, source):
+    """One AES_KEYS entry: base64 in the environment ("key") or a key file ("path")."""
+    if "key" in source:
+        try:
+            key = base64.b64decode(source["key"], validate=True)
+        except ValueError:
+            raise ImproperlyConfigured(f"Server AES key {key_id!r} is not valid base64")
+        origin = "the environment"
+    else:
+        path = source["path"]
+        if not os.path.exists(path):
+            if provisioning_mode() == STRICT:
+                raise ImproperlyConfigured(f"Server AES key {key_id!r} not found at {path}")
+            create_exclusive(path, os.urandom(AES_KEY_SIZE))
+        with open(path, "rb") as key_file:
+            key = key_file.read()
+        origin = path
+    if len(key) != AES_KEY_SIZE:
+        raise ImproperlyConfigured(
+            f"Server AES key {key_id!r} from {origin} must be {AES_KEY_SIZE} bytes, not {len(key)}"
+        )
+    return key
+
+
+def load_aes_keys():
+    """
+    Every configured server AES key by key ID. Key IDs are stored in blob
+    headers, so they are limited to AES_KEY_ID_SIZE ASCII characters.
+    """
+    keys = {}
+    for key_id, source in settings.AES_KEYS.items():
+        if not AES_KEY_ID.fullmatch(key_id):
+            raise ImproperlyConfigured(
+                f"AES key ID {key_id!r} must be 1 to {AES_KEY_ID_SIZE} letters, digits, '.', '_' or '-'"
+            )
+        keys[key_id] = load_aes_key(key_id, source)
+    if settings.AES_ACTIVE_KEY_ID not in keys:
+        raise ImproperlyConfigured(f"AES_ACTIVE_KEY_ID {settings.AES_ACTIVE_KEY_ID!r} is not one of AES_KEYS")
+    return keys
+
+
+def generate_rsa_keys(private_key_path, public_key_path):
+    """
+    Generate RSA public and private keys if they do not exist. Safe to race:
+    the public key is always derived from whichever private key won.
+    """
+    if not os.path.exists(private_key_path):
+        create_exclusive(private_key_path, RSA.generate(2048).export_key())
+    if not os.path.exists(public_key_path):
+        with open(private_key_path, "rb") as priv_file:
+            private_key = RSA.import_key(priv_file.read())
+        create_exclusive(public_key_path, private_key.publickey().export_key())
+
+
+def ensure_rsa_keys():
+    """
+    Make sure every configured RSA pair file exists. Missing pairs are
+    generated in "generate" mode and are an error in "strict" mode. Pairs
+    given as PEM in the environment need no files.
+    """
+    if settings.RSA_ACTIVE_KEY_ID not in settings.RSA_KEYS:
+        raise ImproperlyConfigured(f"RSA_ACTIVE_KEY_ID {settings.RSA_ACTIVE_KEY_ID!r} is not one of RSA_KEYS")
+    for key_id, source in settings.RSA_KEYS.items():
+        if "pem" in source:
+            continue
+        missing = [path for path in (source["private"], source["public"]) if not os.path.exists(path)]
+        if not missing:
+            continue
+        if provisioning_mode() == STRICT:
+            raise ImproperlyConfigured(f"RSA key pair {key_id!r} not found: {', '.join(missing)}")
+        generate_rsa_keys(source["private"], source["public"])
+
+
+def load_rsa_pair(source):
+    """(private_key, public_key) for one RSA_KEYS entry."""
+    if "pem" in source:
+        private_key = RSA.import_key(source["pem"])
+        return private_key, private_key.publickey()
+    with open(source["private"], "rb") as priv_file:
+        private_key = RSA.import_key(priv_file.read())
+    with open(source["public"], "rb") as pub_file:
+        public_key = RSA.import_key(pub_file.read())
+    if public_key != private_key.publickey():
+        raise ImproperlyConfigured(f"{source['public']} is not the public half of {source['private']}")
+    return private_key, public_key
+
+
+def fingerprint(aes_keys, public_keys):
+    """
+    Short, non-secret identifier of a key set: a hash of each AES key and
+    of each RSA public key by key ID. Equal fingerprints mean equal keys.
+    """
+    digest = hashlib.sha256(b"sfs-keys-v1")
+    for key_id in sorted(aes_keys):
+        digest.update(f"\0aes\0{key_id}\0".encode("utf-8"))
+        digest.update(hashlib.sha256(aes_keys[key_id]).digest())
+    for key_id in sorted(public_keys):
+        digest.update(f"\0rsa\0{key_id}\0".encode("utf-8"))
+        digest.update(hashlib.sha256(public_keys[key_id].export_key(format="DER")).digest())
+    return digest.hexdigest()[:16]
+
+
+def local_fingerprint():
+    """Fingerprint of the keys this process is configured with."""
+    public_keys = {key_id: load_rsa_pair(source)[1] for key_id, source in settings.RSA_KEYS.items()}
+    return fingerprint(load_aes_keys(), public_keys)
+
+
+def check_keys():
+    """Provision (or require) the server keys and verify KEY_FINGERPRINT."""
+    mode = provisioning_mode()
+    ensure_rsa_keys()
+    actual = local_fingerprint()
+    expected = settings.KEY_FINGERPRINT
+    if mode == STRICT and not expected:
+        raise ImproperlyConfigured(
+            f"KEY_PROVISIONING is strict but KEY_FINGERPRINT is not set; these keys have fingerprint {actual}"
+        )
+    if expected and expected != actual:
+        raise ImproperlyConfigured(
+            f"Server keys do not match KEY_FINGERPRINT (expected {expected}, loaded {actual}); "
+            "this node would not be able to read blobs written by the others"
+        )
+    return actual
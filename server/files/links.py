@@ -0,0 +1,64 @@
+"""
+Share-link resolution, cached by token for up to SHARE_LINK_CACHE_TTL
+seconds and never past the link's expiry.
+
+The cached entry is a snapshot of the link, its file and the owner's
+username, so a warm link needs no queries. Entries are dropped when the
+link is deleted (files/signals.py), which also covers regeneration and
+file deletion. Like access decisions, links are only cached in a cache
+shared by every process, where that deletion reaches all of them.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.timezone import now
+from .cache import shared_cache_configured
+from .models import ShareableLink
+
+
+def _link_key(token):
+    return f"share-link:{token}"
+
+
+def resolve_shared_link(token):
+    """
+    Snapshot dict of the link with this token, or None if there is no such
+    link. Expired links are returned (and not cached) so callers can tell
+    them apart from unknown tokens.
+    """
+    key = _link_key(token)
+    shared = shared_cache_configured()
+    snapshot = cache.get(key) if shared else None
+    if snapshot is not None:
+        return snapshot
+
+    link = (
+        ShareableLink.objects.select_related("file__owner")
+        .filter(token=token)
+        .only(
+            "token", "expires_at",
+            "file__id", "file__name", "file__size", "file__uploaded_at",
+            "file__owner__id", "file__owner__username",
+        )
+        .first()
+    )
+    if link is None:
+        return None
+
+    snapshot = {
+        "token": link.token,
+        "expires_at": link.expires_at,
+        "file_id": link.file.id,
+        "name": link.file.name,
+        "size": link.file.size,
+        "uploaded_at": link.file.uploaded_at,
+        "owner_id": link.file.owner.id,
+        "owner_username": link.file.owner.username,
+    }
+    ttl = min((link.expires_at - now()).total_seconds(), settings.SHARE_LINK_CACHE_TTL)
+    if shared and ttl > 0:
+        cache.set(key, snapshot, ttl)
+    return snapshot
+
+
+def invalidate_shared_link(token):
+    cache.delete(_link_key(token))
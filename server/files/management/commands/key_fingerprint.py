@@ -0,0 +1,9 @@
+from django.core.management.base import BaseCommand
+from files.keys import local_fingerprint
+
+
+class Command(BaseCommand):
+    help = "Print the fingerprint of this node's server keys, for KEY_FINGERPRINT."
+
+    def handle(self, *args, **options):
+        self.stdout.write(local_fingerprint())
@@ -0,0 +1,185 @@
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from files.blobs import SHARDED_NAME, blob_name, copy_content
+from files.encrypt import aes_encryption
+from files.enums import FileStatusChoices
+from files.models import Blob, File
+
+
+class StaleRow(Exception):
+    """The row changed (or went away) while its content was being copied."""
+
+
+def pending_blobs():
+    """Blobs stored before the sharded layout."""
+    return Blob.objects.exclude(encrypted_file__regex=SHARDED_NAME)
+
+
+def pending_files():
+    """Ready files stored in the flat encrypted_files/ layout, before blobs existed."""
+    return File.objects.filter(blob__isnull=True, status=FileStatusChoices.READY.value).exclude(encrypted_file="")
+
+
+def client_encrypted_sha256(name):
+    hasher = hashlib.sha256()
+    with default_storage.open(name, "rb") as encrypted_file:
+        for chunk in aes_encryption.decrypt_stream(encrypted_file):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class DeferredDeleteMixin:
+    """
+    Delete superseded copies delete_delay seconds after the transaction that
+    replaced them commits, so downloads that already opened them can finish.
+    The command sets delete_delay and an empty obsolete list before its first
+    batch.
+    """
+    def defer_delete(self, names):
+        delete_after = time.monotonic() + self.delete_delay
+        self.obsolete.extend((delete_after, name) for name in names)
+
+    def delete_obsolete(self, wait=False):
+        """Delete superseded copies whose delay has passed, or all of them once it has if wait."""
+        if wait and self.obsolete:
+            time.sleep(max(self.obsolete[-1][0] - time.monotonic(), 0))
+        now = time.monotonic()
+        while self.obsolete and self.obsolete[0][0] <= now:
+            default_storage.delete(self.obsolete.pop(0)[1])
+
+
+class Command(DeferredDeleteMixin, BaseCommand):
+    help = (
+        "Move stored content into the hash-sharded blob layout: flat blobs are "
+        "moved, and files stored before blobs existed become blobs (sharing one "
+        "with identical content). Safe to interrupt and re-run; the site stays up."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=200, help="Rows updated per transaction.")
+        parser.add_argument("--workers", type=int, default=4, help="Threads copying content in parallel.")
+        parser.add_argument(
+            "--delete-delay", type=int, default=60,
+            help="Seconds superseded copies are kept for downloads that already opened them.",
+        )
+
+    def handle(self, *args, **options):
+        batch_size, workers = options["batch_size"], options["workers"]
+        self.delete_delay = options["delete_delay"]
+        totals = {"moved": 0, "skipped": 0, "failed": 0}
+        self.obsolete = []  # (delete after, name) of superseded copies
+        try:
+            with ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix="blob-layout") as pool:
+                for queryset, prepare, apply in (
+                    (pending_blobs(), self.prepare_blob, self.apply_blob),
+                    (pending_files(), self.prepare_file, self.apply_file),
+                ):
+                    # Keyset over id, so rows that fail are retried on the next run
+                    # rather than picked up again by this one
+                    last_id = 0
+                    while True:
+                        batch = list(queryset.filter(id__gt=last_id).order_by("id")[:batch_size])
+                        if not batch:
+                            break
+                        last_id = batch[-1].id
+                        counts = self.run_batch(pool, batch, prepare, apply)
+                        for outcome, count in counts.items():
+                            totals[outcome] += count
+                        self.stdout.write(
+                            f"{queryset.model.__name__} batch up to id {last_id}: "
+                            + ", ".join(f"{count} {outcome}" for outcome, count in counts.items())
+                        )
+                        self.delete_obsolete()
+        finally:
+            self.delete_obsolete(wait=True)
+
+        summary = ", ".join(f"{count} {outcome}" for outcome, count in totals.items())
+        style = self.style.WARNING if totals["failed"] else self.style.SUCCESS
+        self.stdout.write(style(f"Blob layout migration finished: {summary}"))
+
+    def run_batch(self, pool, batch, prepare, apply):
+        """
+        Copy each row's content to its sharded name in parallel, then update
+        the rows in one transaction and schedule the superseded copies for
+        deletion once it commits. Each row is updated only if it still names the content that
+        was copied, so concurrent uploads and deletes are never overwritten.
+        """
+        counts = {"moved": 0, "skipped": 0, "failed": 0}
+        prepared = []
+        for row, result in zip(batch, pool.map(lambda row: self.prepare_safely(prepare, row), batch)):
+            if isinstance(result, Exception):
+                self.stderr.write(f"{type(row).__name__} {row.id}: {result}")
+                counts["failed"] += 1
+            else:
+                prepared.append((row, result))
+
+        superseded = []
+        with transaction.atomic():
+            for row, result in prepared:
+                try:
+                    with transaction.atomic():
+                        superseded.extend(apply(row, *result))
+                    counts["moved"] += 1
+                except StaleRow:
+                    superseded.append(result[-1])  # Our copy is not referenced by anything
+                    counts["skipped"] += 1
+
+        self.defer_delete(superseded)
+        return counts
+
+    def prepare_safely(self, prepare, row):
+        try:
+            return prepare(row)
+        except Exception as e:
+            return e
+
+    def prepare_blob(self, blob):
+        old_name = blob.encrypted_file.name
+        # Named after the row, so a re-run after an interruption reuses the same target
+        new_name = blob_name(blob.sha256, f"b{blob.id}")
+        copy_content(old_name, new_name)
+        return old_name, new_name
+
+    def apply_blob(self, blob, old_name, new_name):
+        """Point the blob and every file referencing it at new_name; returns the names to delete."""
+        if not Blob.objects.filter(id=blob.id, encrypted_file=old_name).update(encrypted_file=new_name):
+            raise StaleRow()
+        File.objects.filter(blob_id=blob.id).update(encrypted_file=new_name)
+        return [old_name]
+
+    def prepare_file(self, file):
+        old_name = file.encrypted_file.name
+        sha256 = file.sha256 or client_encrypted_sha256(old_name)
+        new_name = blob_name(sha256, f"f{file.id}")
+        copy_content(old_name, new_name)
+        return sha256, old_name, new_name
+
+    def apply_file(self, file, sha256, old_name, new_name):
+        """
+        Link a legacy file to the blob for its content, creating the blob from
+        the copy at new_name unless one already exists. Returns the names to delete.
+        """
+        blob = Blob.objects.select_for_update().filter(sha256=sha256).first()
+        if blob is None:
+            try:
+                blob = Blob.objects.create(
+                    sha256=sha256, encrypted_file=new_name, size=default_storage.size(new_name), ref_count=0
+                )
+            except IntegrityError:
+                raise StaleRow()  # Uploaded concurrently; linked on the next run
+            obsolete = [old_name]
+        else:
+            obsolete = [old_name, new_name]  # Identical content is already stored
+
+        linked = File.objects.filter(id=file.id, blob__isnull=True, encrypted_file=old_name).update(
+            blob=blob, encrypted_file=blob.encrypted_file.name, sha256=sha256
+        )
+        if not linked:
+            raise StaleRow()
+        Blob.objects.filter(id=blob.id).update(ref_count=F("ref_count") + 1)
+        return obsolete
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from django.utils.timezone import now
+from files.enums import FileStatusChoices
+from files.models import UploadSession
+
+# Finalized sessions whose assembly task is still queued or retrying keep
+# their staged chunks until the file is Ready or Failed
+ASSEMBLING = [FileStatusChoices.PENDING.value, FileStatusChoices.PROCESSING.value]
+
+
+class Command(BaseCommand):
+    help = "Delete expired resumable upload sessions and their staged chunks."
+
+    def handle(self, *args, **options):
+        expired = UploadSession.objects.filter(expires_at__lte=now()).exclude(file__status__in=ASSEMBLING)
+        count = 0
+        for session in expired.iterator():
+            session.discard()
+            count += 1
+        self.stdout.write(self.style.SUCCESS(f"Purged {count} expired upload session(s)"))
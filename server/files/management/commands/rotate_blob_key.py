@@ -0,0 +1,223 @@
+import hashlib
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+import django
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Sum
+from files.blobs import blob_name
+from files.encrypt import EncryptedChunks, aes_encryption
+from files.management.commands.migrate_blob_layout import DeferredDeleteMixin, StaleRow, pending_files
+from files.models import Blob, File, UploadSession
+
+_throttle = None  # Shared by every blob a worker process re-encrypts
+
+
+class Throttle:
+    """Keep the bytes read by one process under bytes_per_second (0: unlimited)."""
+
+    def __init__(self, bytes_per_second):
+        self.rate = bytes_per_second
+        self.started = time.monotonic()
+        self.consumed = 0
+
+    def consume(self, count):
+        if not self.rate:
+            return
+        self.consumed += count
+        ahead = self.consumed / self.rate - (time.monotonic() - self.started)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+def process_throttle(bytes_per_second):
+    global _throttle
+    if _throttle is None:
+        _throttle = Throttle(bytes_per_second)
+    return _throttle
+
+
+def pending_blobs(key_id):
+    """Blobs whose content is not encrypted with key_id yet."""
+    return Blob.objects.exclude(aes_key_id=key_id)
+
+
+def reencrypt(sha256, old_name, key_id, bytes_per_second):
+    """
+    Decrypt the blob stored at old_name and store it encrypted with key_id
+    under a name of its own, reading at most bytes_per_second. Runs in a
+    worker process and never touches the database. Returns (new_name, size).
+    """
+    throttle = process_throttle(bytes_per_second)
+    # Named after the target key, so a re-run after an interruption replaces its own partial copy
+    new_name = blob_name(sha256, key_id)
+    default_storage.delete(new_name)
+    hasher = hashlib.sha256()
+    with default_storage.open(old_name, "rb") as encrypted_file:
+        reader = aes_encryption.open_reader(encrypted_file)
+
+        def content():
+            for chunk in reader.iter_range():
+                throttle.consume(len(chunk))
+                hasher.update(chunk)
+                yield chunk
+
+        chunks = aes_encryption.encrypt_stream(content(), reader.size, key_id)
+        try:
+            new_name = default_storage.save(new_name, EncryptedChunks(chunks, new_name))
+        except BaseException:
+            default_storage.delete(new_name)
+            raise
+    if hasher.hexdigest() != sha256:
+        default_storage.delete(new_name)
+        raise ValueError("Decrypted content does not match the blob's SHA-256")
+    return new_name, default_storage.size(new_name)
+
+
+def format_bytes(count):
+    return f"{count / 2**30:.2f} GiB"
+
+
+class Command(DeferredDeleteMixin, BaseCommand):
+    help = (
+        "Re-encrypt stored blobs with the active server AES key (AES_ACTIVE_KEY_ID) "
+        "in parallel worker processes. Reads keep working with either key while it "
+        "runs; safe to interrupt and re-run, which resumes where it stopped."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--processes", type=int, default=4, help="Worker processes re-encrypting in parallel.")
+        parser.add_argument("--batch-size", type=int, default=100, help="Blobs updated per transaction.")
+        parser.add_argument(
+            "--max-rate", type=float, default=0,
+            help="Combined read rate limit of all workers in MiB/s (0: unlimited).",
+        )
+        parser.add_argument(
+            "--time-limit", type=int, default=0,
+            help="Stop starting new batches after this many seconds (0: none); re-run to continue.",
+        )
+        parser.add_argument(
+            "--delete-delay", type=int, default=60,
+            help="Seconds superseded copies are kept for downloads that already opened them.",
+        )
+
+    def handle(self, *args, **options):
+        key_id = aes_encryption.active_key_id
+        processes = max(options["processes"], 1)
+        batch_size, time_limit = options["batch_size"], options["time_limit"]
+        self.delete_delay = options["delete_delay"]
+        self.bytes_per_second = options["max_rate"] * 2**20 / processes
+
+        pending = pending_blobs(key_id)
+        self.stdout.write(
+            f"Rotating to key {key_id!r}: {pending.count()} blobs, "
+            f"{format_bytes(pending.aggregate(total=Sum('size'))['total'] or 0)} pending"
+        )
+
+        totals = {"rotated": 0, "skipped": 0, "failed": 0}
+        started, rotated_bytes, stopped = time.monotonic(), 0, False
+        self.obsolete = []  # (delete after, name) of superseded copies
+        # Workers are spawned rather than forked, so none inherits this
+        # process's database or storage connections
+        pool = ProcessPoolExecutor(
+            max_workers=processes, mp_context=multiprocessing.get_context("spawn"), initializer=django.setup
+        )
+        try:
+            # Keyset over id, so blobs that fail are retried on the next run
+            # rather than picked up again by this one
+            last_id = 0
+            while True:
+                if time_limit and time.monotonic() - started >= time_limit:
+                    stopped = True
+                    break
+                batch = list(pending.filter(id__gt=last_id).order_by("id")[:batch_size])
+                if not batch:
+                    break
+                last_id = batch[-1].id
+                counts, batch_bytes = self.run_batch(pool, batch, key_id)
+                for outcome, count in counts.items():
+                    totals[outcome] += count
+                rotated_bytes += batch_bytes
+                elapsed = time.monotonic() - started
+                self.stdout.write(
+                    f"Batch up to id {last_id}: "
+                    + ", ".join(f"{count} {outcome}" for outcome, count in counts.items())
+                    + f" ({format_bytes(rotated_bytes)} at {rotated_bytes / 2**20 / elapsed:.1f} MiB/s)"
+                )
+                self.delete_obsolete()
+        finally:
+            pool.shutdown(cancel_futures=True)
+            self.delete_obsolete(wait=True)
+
+        summary = ", ".join(f"{count} {outcome}" for outcome, count in totals.items())
+        style = self.style.WARNING if totals["failed"] or stopped else self.style.SUCCESS
+        self.stdout.write(style(
+            f"Key rotation {'stopped at the time limit' if stopped else 'finished'}: {summary}"
+        ))
+        self.report_remaining(key_id)
+
+    def run_batch(self, pool, batch, key_id):
+        """
+        Re-encrypt each blob of the batch in the worker processes, then point
+        the blobs and their files at the new copies in one transaction. A
+        blob is only updated if it still names the content that was
+        re-encrypted, so concurrent uploads and deletes are never overwritten.
+        """
+        counts = {"rotated": 0, "skipped": 0, "failed": 0}
+        futures = [
+            (blob, pool.submit(reencrypt, blob.sha256, blob.encrypted_file.name, key_id, self.bytes_per_second))
+            for blob in batch
+        ]
+        prepared = []
+        for blob, future in futures:
+            try:
+                prepared.append((blob, *future.result()))
+            except Exception as e:
+                self.stderr.write(f"Blob {blob.id}: {e}")
+                counts["failed"] += 1
+
+        rotated_bytes, superseded = 0, []
+        with transaction.atomic():
+            for blob, new_name, size in prepared:
+                try:
+                    with transaction.atomic():
+                        superseded.append(self.apply(blob, new_name, size, key_id))
+                    counts["rotated"] += 1
+                    rotated_bytes += blob.size
+                except StaleRow:
+                    superseded.append(new_name)  # Our copy is not referenced by anything
+                    counts["skipped"] += 1
+
+        self.defer_delete(superseded)
+        return counts, rotated_bytes
+
+    def apply(self, blob, new_name, size, key_id):
+        """Point the blob and every file referencing it at new_name; returns the name to delete."""
+        old_name = blob.encrypted_file.name
+        updated = Blob.objects.filter(id=blob.id, encrypted_file=old_name, aes_key_id=blob.aes_key_id).update(
+            encrypted_file=new_name, size=size, aes_key_id=key_id
+        )
+        if not updated:
+            raise StaleRow()
+        File.objects.filter(blob_id=blob.id).update(encrypted_file=new_name)
+        return old_name
+
+    def report_remaining(self, key_id):
+        """Say what still depends on other keys, i.e. whether they can be retired yet."""
+        remaining = {
+            "blobs": pending_blobs(key_id).count(),
+            "files stored before blobs (run migrate_blob_layout)": pending_files().count(),
+            "unfinished upload sessions": UploadSession.objects.filter(file__isnull=True).exclude(
+                aes_key_id=key_id
+            ).count(),
+        }
+        if not any(remaining.values()):
+            self.stdout.write(f"Everything stored is encrypted with key {key_id!r}; older keys can be retired.")
+            return
+        self.stdout.write(
+            "Still on older keys: "
+            + ", ".join(f"{count} {what}" for what, count in remaining.items() if count)
+            + ". Re-run once they are done."
+        )
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.4 on 2026-10-18 19:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0002_upload_sessions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='file',
+            name='server_key_id',
+            field=models.CharField(default='v1', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='uploadsession',
+            name='server_key_id',
+            field=models.CharField(default='v1', max_length=64),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.1.4 on 2026-10-18 19:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0003_server_key_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='file',
+            name='processing_error',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='file',
+            name='sha256',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='file',
+            name='status',
+            field=models.CharField(choices=[('Pending', 'Pending'), ('Processing', 'Processing'), ('Ready', 'Ready'), ('Failed', 'Failed')], default='Ready', max_length=20),
+        ),
+    ]
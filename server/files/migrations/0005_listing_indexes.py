@@ -0,0 +1,35 @@
+# Generated by Django 5.1.4 on 2026-10-18 19:41
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0004_file_status'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='file',
+            index=models.Index(fields=['owner', 'uploaded_at', 'id'], name='file_owner_uploaded_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='file',
+            index=models.Index(fields=['owner', 'name', 'id'], name='file_owner_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='file',
+            index=models.Index(fields=['owner', 'size', 'id'], name='file_owner_size_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='fileaccess',
+            index=models.Index(fields=['user', 'can_view', 'file'], name='fileaccess_user_view_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='shareablelink',
+            index=models.Index(fields=['file', 'expires_at'], name='link_file_expires_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.4 on 2026-10-18 20:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0006_blobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blob',
+            name='aes_key_id',
+            field=models.CharField(db_index=True, default='v1', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='uploadsession',
+            name='aes_key_id',
+            field=models.CharField(blank=True, max_length=16, null=True),
+        ),
+    ]
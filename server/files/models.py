@@ -1,17 +1,51 @@
 from django.db import models
 from django.conf import settings
+from django.core.files.storage import default_storage
+import os
 import uuid
 from datetime import timedelta
 from django.utils.timezone import now
+from .enums import FileStatusChoices
+
+class Blob(models.Model):
+    sha256 = models.CharField(max_length=64, unique=True)  # SHA-256 of the client-encrypted content
+    encrypted_file = models.FileField(upload_to="blobs/")  # Server-encrypted content, shared by every referencing File
+    size = models.PositiveBigIntegerField()  # Stored size in bytes
+    ref_count = models.PositiveIntegerField(default=0)  # Files pointing at this blob
+    aes_key_id = models.CharField(max_length=16, default="v1", db_index=True)  # Server AES key of the stored content
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Blob {self.sha256} ({self.ref_count} refs)"
+
 
 class File(models.Model):
     name = models.CharField(max_length=255)
     encrypted_file = models.FileField(upload_to="encrypted_files/")  # FileField to store the encrypted file
+    blob = models.ForeignKey(
+        Blob, null=True, blank=True, on_delete=models.PROTECT, related_name="files"
+    )  # Set once processed; encrypted_file then names the blob's content
     server_key = models.BinaryField()  # Store the server-side AES key securely
+    server_key_id = models.CharField(max_length=64, default="v1")  # RSA key pair that wrapped server_key
     iv = models.BinaryField()  # Initialization vector for encryption
     owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     size = models.PositiveBigIntegerField()  # File size in bytes
     uploaded_at = models.DateTimeField(auto_now_add=True)
+    status = models.CharField(
+        max_length=20,
+        choices=FileStatusChoices.choices(),
+        default=FileStatusChoices.READY.value
+    )  # Uploads stay Pending until the background job has encrypted them
+    sha256 = models.CharField(max_length=64, blank=True)  # SHA-256 of the client-encrypted content
+    processing_error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [
+            # Keyset pagination of a user's files by each sortable column
+            models.Index(fields=["owner", "uploaded_at", "id"], name="file_owner_uploaded_idx"),
+            models.Index(fields=["owner", "name", "id"], name="file_owner_name_idx"),
+            models.Index(fields=["owner", "size", "id"], name="file_owner_size_idx"),
+        ]
 
     def __str__(self):
         return self.name
@@ -26,6 +60,9 @@ class FileAccess(models.Model):
 
     class Meta:
         unique_together = ("file", "user")  # Each user can have only one access record per file.
+        indexes = [
+            models.Index(fields=["user", "can_view", "file"], name="fileaccess_user_view_idx"),  # Files shared with a user
+        ]
 
     def __str__(self):
         return f"Access for {self.user.username} to {self.file.name}"
@@ -37,8 +74,79 @@ class ShareableLink(models.Model):
     expires_at = models.DateTimeField()  # Expiration timestamp for the link.
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["file", "expires_at"], name="link_file_expires_idx"),  # Active link lookup
+        ]
+
     def is_valid(self):
         return now() < self.expires_at  # Check if the link is still valid.
 
     def __str__(self):
         return f"Shareable link for {self.file.name} (Expires: {self.expires_at})"
+
+
+class UploadSession(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    name = models.CharField(max_length=255)
+    size = models.PositiveBigIntegerField()  # Total size of the client-encrypted file
+    chunk_size = models.PositiveIntegerField()  # Every chunk but the last is exactly this size
+    server_key = models.BinaryField()  # Client key wrapped with the server public key
+    server_key_id = models.CharField(max_length=64, default="v1")
+    aes_key_id = models.CharField(max_length=16, null=True, blank=True)  # Server AES key of the staged chunks; null before key IDs
+    iv = models.BinaryField()
+    idempotency_key = models.CharField(max_length=255, null=True, blank=True)
+    file = models.OneToOneField(File, null=True, blank=True, on_delete=models.SET_NULL)  # Set once finalized
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField()  # Pushed back on every received chunk
+
+    class Meta:
+        unique_together = ("owner", "idempotency_key")  # Retried creates return the same session
+
+    @property
+    def total_chunks(self):
+        return -(-self.size // self.chunk_size)
+
+    def chunk_length(self, index):
+        """Expected size of chunk `index`; only the last chunk may be short."""
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+
+    def is_expired(self):
+        return now() >= self.expires_at
+
+    def chunk_path(self, index):
+        """Storage name of the server-encrypted segment staged for chunk `index`."""
+        return f"upload_sessions/{self.id}/{index}.part"
+
+    def is_assembling(self):
+        """Finalized, with the assembly task for its file still queued or retrying."""
+        return self.file_id is not None and self.file.status in (
+            FileStatusChoices.PENDING.value, FileStatusChoices.PROCESSING.value
+        )
+
+    def discard(self):
+        """Delete the staged chunks and the session itself."""
+        for index in self.chunks.values_list("index", flat=True):
+            default_storage.delete(self.chunk_path(index))
+        try:
+            os.rmdir(default_storage.path(f"upload_sessions/{self.id}"))
+        except (NotImplementedError, OSError):
+            pass
+        self.delete()
+
+    def __str__(self):
+        return f"Upload session for {self.name} ({self.owner})"
+
+
+class UploadChunk(models.Model):
+    session = models.ForeignKey(UploadSession, on_delete=models.CASCADE, related_name="chunks")
+    index = models.PositiveIntegerField()
+    nonce = models.BinaryField()  # Nonce of the server-encrypted segment stored for this chunk
+    received_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ("session", "index")
+
+    def __str__(self):
+        return f"Chunk {self.index} of {self.session_id}"
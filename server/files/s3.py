@@ -0,0 +1,178 @@
+"""
+Minimal client for S3-compatible object stores (AWS S3, MinIO, Ceph RGW):
+just the object calls S3Storage needs, signed with AWS Signature Version 4
+and sent with path-style addressing over one keep-alive connection per
+thread.
+"""
+import hashlib
+import hmac
+import http.client
+import threading
+import xml.etree.ElementTree as ElementTree
+from datetime import datetime, timezone
+from urllib.parse import quote, urlsplit
+
+EMPTY_SHA256 = hashlib.sha256(b"").hexdigest()
+
+
+def _sign(key, message):
+    return hmac.new(key, message.encode("utf-8"), hashlib.sha256).digest()
+
+
+def signing_key(secret_key, date, region, service="s3"):
+    key = _sign(("AWS4" + secret_key).encode("utf-8"), date)
+    for part in (region, service, "aws4_request"):
+        key = _sign(key, part)
+    return key
+
+
+def canonical_query(params):
+    return "&".join(
+        f"{quote(str(name), safe='-_.~')}={quote(str(value), safe='-_.~')}"
+        for name, value in sorted(params.items())
+    )
+
+
+def authorization_header(method, path, params, headers, payload_hash, access_key, secret_key, region, service="s3"):
+    """
+    SigV4 Authorization header for a request. headers must already hold
+    host and x-amz-date; every header passed in is signed.
+    """
+    amz_date = headers["x-amz-date"]
+    scope = f"{amz_date[:8]}/{region}/{service}/aws4_request"
+    signed = sorted(name.lower() for name in headers)
+    lowered = {name.lower(): " ".join(str(value).split()) for name, value in headers.items()}
+    canonical_request = "\n".join([
+        method,
+        path,
+        canonical_query(params),
+        "".join(f"{name}:{lowered[name]}\n" for name in signed),
+        ";".join(signed),
+        payload_hash,
+    ])
+    string_to_sign = "\n".join([
+        "AWS4-HMAC-SHA256",
+        amz_date,
+        scope,
+        hashlib.sha256(canonical_request.encode("utf-8")).hexdigest(),
+    ])
+    signature = hmac.new(
+        signing_key(secret_key, amz_date[:8], region, service), string_to_sign.encode("utf-8"), hashlib.sha256
+    ).hexdigest()
+    return f"AWS4-HMAC-SHA256 Credential={access_key}/{scope}, SignedHeaders={';'.join(signed)}, Signature={signature}"
+
+
+class S3Error(OSError):
+    def __init__(self, method, key, status, body):
+        super().__init__(f"S3 {method} {key!r} failed with {status}: {body[:200]!r}")
+        self.status = status
+
+
+class S3Client:
+    def __init__(self, endpoint_url, bucket, access_key, secret_key, region="us-east-1", timeout=60):
+        endpoint = urlsplit(endpoint_url)
+        self.secure = endpoint.scheme == "https"
+        self.host = endpoint.netloc
+        self.prefix = endpoint.path.rstrip("/")
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self, fresh=False):
+        connection = getattr(self._local, "connection", None)
+        if connection is None or fresh:
+            if connection is not None:
+                connection.close()
+            connection_class = http.client.HTTPSConnection if self.secure else http.client.HTTPConnection
+            connection = self._local.connection = connection_class(self.host, timeout=self.timeout)
+        return connection
+
+    def request(self, method, key, params=None, headers=None, body=b"", expect=(200,)):
+        """
+        Send one signed request and return (status, headers, body). Statuses
+        outside expect raise S3Error, or FileNotFoundError for a 404.
+        """
+        params = params or {}
+        path = quote(f"{self.prefix}/{self.bucket}/{key}", safe="/-_.~")
+        payload_hash = hashlib.sha256(body).hexdigest() if body else EMPTY_SHA256
+        headers = {
+            **(headers or {}),
+            "host": self.host,
+            "x-amz-date": datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ"),
+            "x-amz-content-sha256": payload_hash,
+        }
+        headers["Authorization"] = authorization_header(
+            method, path, params, headers, payload_hash, self.access_key, self.secret_key, self.region
+        )
+        url = f"{path}?{canonical_query(params)}" if params else path
+
+        # A kept-alive connection may have been closed by the server; retry once on a fresh one
+        for fresh in (False, True):
+            connection = self._connection(fresh)
+            try:
+                connection.request(method, url, body=body or None, headers=headers)
+                response = connection.getresponse()
+                data = response.read()
+                break
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                if fresh:
+                    raise
+        if response.status == 404 and 404 not in expect:
+            raise FileNotFoundError(f"S3 object {key!r} not found")
+        if response.status not in expect:
+            raise S3Error(method, key, response.status, data)
+        return response.status, response.headers, data
+
+    def head_object(self, key):
+        """Object headers, or None if it does not exist."""
+        status, headers, _ = self.request("HEAD", key, expect=(200, 404))
+        return headers if status == 200 else None
+
+    def get_range(self, key, start, length):
+        """
+        Up to length bytes of an object starting at start. An endpoint that
+        ignores Range answers 200 with the whole object, which is refused
+        rather than read as the requested bytes.
+        """
+        _, _, data = self.request(
+            "GET", key, headers={"Range": f"bytes={start}-{start + length - 1}"}, expect=(206,)
+        )
+        return data
+
+    def put_object(self, key, body):
+        self.request("PUT", key, body=body)
+
+    def delete_object(self, key):
+        self.request("DELETE", key, expect=(200, 204, 404))
+
+    def create_multipart_upload(self, key):
+        _, _, data = self.request("POST", key, params={"uploads": ""})
+        return _find_text(data, "UploadId")
+
+    def upload_part(self, key, upload_id, number, body):
+        _, headers, _ = self.request("PUT", key, params={"partNumber": number, "uploadId": upload_id}, body=body)
+        return headers["ETag"]
+
+    def complete_multipart_upload(self, key, upload_id, etags):
+        parts = "".join(
+            f"<Part><PartNumber>{number}</PartNumber><ETag>{etag}</ETag></Part>"
+            for number, etag in enumerate(etags, start=1)
+        )
+        body = f"<CompleteMultipartUpload>{parts}</CompleteMultipartUpload>".encode("utf-8")
+        _, _, data = self.request("POST", key, params={"uploadId": upload_id}, body=body)
+        if b"<Error>" in data:  # S3 can report a failed completion inside a 200
+            raise S3Error("POST", key, 200, data)
+
+    def abort_multipart_upload(self, key, upload_id):
+        self.request("DELETE", key, params={"uploadId": upload_id}, expect=(200, 204, 404))
+
+
+def _find_text(xml, tag):
+    for element in ElementTree.fromstring(xml).iter():
+        if element.tag.rsplit("}", 1)[-1] == tag:
+            return element.text
+    raise ValueError(f"No {tag} in S3 response")
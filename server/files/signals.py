@@ -0,0 +1,42 @@
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from .access import invalidate_file_access
+from .blobs import release_blob
+from .links import invalidate_shared_link
+from .models import File, FileAccess, ShareableLink
+from .utils import invalidate_payload
+
+
+def _invalidate_on_commit(file_id):
+    # Invalidate again after commit so a concurrent reader cannot re-cache
+    # the pre-change row between our write and the commit
+    invalidate_file_access(file_id)
+    transaction.on_commit(lambda: invalidate_file_access(file_id))
+
+
+@receiver([post_save, post_delete], sender=File)
+def file_changed(sender, instance, **kwargs):
+    _invalidate_on_commit(instance.id)
+
+
+@receiver(post_delete, sender=File)
+def file_deleted(sender, instance, **kwargs):
+    invalidate_payload(instance)
+    if instance.blob_id:
+        release_blob(instance.blob_id)
+    elif instance.encrypted_file.name:
+        # Files stored before blobs existed own their content outright
+        name = instance.encrypted_file.name
+        transaction.on_commit(lambda: default_storage.delete(name))
+
+
+@receiver([post_save, post_delete], sender=FileAccess)
+def file_access_changed(sender, instance, **kwargs):
+    _invalidate_on_commit(instance.file_id)
+
+
+@receiver(post_delete, sender=ShareableLink)
+def shareable_link_deleted(sender, instance, **kwargs):
+    invalidate_shared_link(instance.token)
@@ -0,0 +1,109 @@
+import hashlib
+from celery import shared_task
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from .blobs import link_blob
+from .encrypt import aes_encryption
+from .enums import FileStatusChoices
+from .models import File, UploadSession
+
+
+def process_file(task, file_id, digest, encrypted_chunks, aes_key_id):
+    """
+    Link a Pending file to the blob for its content and record the outcome
+    on the File row. digest(file) returns the SHA-256 of the
+    client-encrypted content; encrypted_chunks(file) produces the blob,
+    encrypted with server key aes_key_id, and is only consumed when that
+    content is not stored yet. Failures are
+    retried up to FILE_PROCESSING_MAX_RETRIES times before the file is
+    marked Failed. Returns True once the file is Ready.
+    """
+    file = File.objects.filter(id=file_id).first()
+    if file is None:
+        return False  # Deleted before processing finished
+    if file.status == FileStatusChoices.READY.value:
+        return True  # Redelivered after it already succeeded
+
+    File.objects.filter(id=file_id).update(status=FileStatusChoices.PROCESSING.value)
+    file.status = FileStatusChoices.READY.value
+    file.processing_error = ""
+    try:
+        link_blob(file, digest(file), lambda: encrypted_chunks(file), aes_key_id)
+    except Exception as exc:
+        if task.request.retries < task.max_retries:
+            File.objects.filter(id=file_id).update(status=FileStatusChoices.PENDING.value)
+            raise task.retry(exc=exc)
+        File.objects.filter(id=file_id).update(
+            status=FileStatusChoices.FAILED.value, processing_error=str(exc)
+        )
+        return False
+    return True
+
+
+@shared_task(bind=True, max_retries=settings.FILE_PROCESSING_MAX_RETRIES, default_retry_delay=10)
+def process_upload(self, file_id, staged_name):
+    """
+    Hash a staged upload and, unless the same content is already stored,
+    encrypt it into a new blob. Then remove the staged copy.
+    """
+    def staged_chunks():
+        with default_storage.open(staged_name, "rb") as staged:
+            yield from iter(lambda: staged.read(aes_encryption.CHUNK_SIZE), b"")
+
+    def digest(file):
+        hasher = hashlib.sha256()
+        for chunk in staged_chunks():
+            hasher.update(chunk)
+        return hasher.hexdigest()
+
+    def encrypted_chunks(file):
+        return aes_encryption.encrypt_stream(staged_chunks(), file.size)
+
+    process_file(self, file_id, digest, encrypted_chunks, aes_encryption.active_key_id)
+    default_storage.delete(staged_name)
+
+
+@shared_task(bind=True, max_retries=settings.FILE_PROCESSING_MAX_RETRIES, default_retry_delay=10)
+def assemble_upload_session(self, file_id, session_id):
+    """
+    Join the segments staged by a resumable upload session into the final
+    blob. Each segment is authenticated and hashed first; unless the same
+    content is already stored, they are then copied, not re-encrypted.
+    Staged chunks are removed once the file is Ready.
+    """
+    session = UploadSession.objects.filter(id=session_id).first()
+    if session is None:
+        # Discarded before assembly; its staged chunks are gone
+        File.objects.filter(id=file_id).exclude(status=FileStatusChoices.READY.value).update(
+            status=FileStatusChoices.FAILED.value, processing_error="Upload session no longer exists"
+        )
+        return
+    nonces = [bytes(nonce) for nonce in session.chunks.order_by("index").values_list("nonce", flat=True)]
+    header = aes_encryption.session_header(session)
+
+    def staged_segment(index):
+        with default_storage.open(session.chunk_path(index), "rb") as staged:
+            return staged.read()
+
+    def digest(file):
+        hasher = hashlib.sha256()
+        for index, nonce in enumerate(nonces):
+            hasher.update(aes_encryption.decrypt_segment(header, index, nonce, staged_segment(index)))
+        return hasher.hexdigest()
+
+    def encrypted_chunks(file):
+        yield header + aes_encryption.segment_table(header, nonces)
+        for index in range(len(nonces)):
+            yield staged_segment(index)
+
+    aes_key_id = session.aes_key_id or settings.AES_LEGACY_KEY_ID
+    if process_file(self, file_id, digest, encrypted_chunks, aes_key_id):
+        for index in range(len(nonces)):
+            default_storage.delete(session.chunk_path(index))
+        session.chunks.all().delete()
+
+
+@shared_task
+def purge_upload_sessions():
+    call_command("purge_upload_sessions")
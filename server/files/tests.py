@@ -1,3 +1,1698 @@
-from django.test import TestCase
+import base64
+import hashlib
+import hmac
+import io
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qsl, unquote, urlsplit
+from asgiref.sync import async_to_sync
+from benchmarks import load
+from core import metrics, profiling
+from Crypto.PublicKey import RSA
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.utils.timezone import now
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import RefreshToken
+from users.models import Users
+from .cache import SegmentedLRUCache, TTLCache
+from .encrypt import SEGMENT_HEADER, SEGMENT_MAGIC, SegmentPool, aes_encryption, unpack_segment_header
+from .keys import GENERATE, STRICT, check_keys, create_exclusive, ensure_rsa_keys, fingerprint
+from .models import Blob, File, FileAccess, ShareableLink, UploadSession
+from .s3 import S3Error, authorization_header
+from .singleflight import SingleFlight
+from .storage import S3Storage
+from .utils import (
+    RSAKeyRing, client_key_cache, decrypt_with_private_key, encrypt_with_public_key, key_ring, payload_cache,
+)
+from . import views
+from .views import encode_cursor, parse_range_header
 
-# Create your tests here.
+
+def decrypt_blob(blob, start=0, end=None):
+    return b"".join(aes_encryption.open_reader(io.BytesIO(blob)).iter_range(start, end))
+
+
+def legacy_cbc_blob(data):
+    """A blob in the original AES-256 CBC format: IV, ciphertext, original size."""
+    iv = os.urandom(16)
+    padder = padding.PKCS7(128).padder()
+    encryptor = Cipher(algorithms.AES(aes_encryption.key_for("v1")), modes.CBC(iv)).encryptor()
+    padded = padder.update(data) + padder.finalize()
+    return iv + encryptor.update(padded) + encryptor.finalize() + struct.pack("<Q", len(data))
+
+
+def write_rsa_pair(directory, key_id, key):
+    """Write key as a PEM pair under directory; returns its RSA_KEYS entry."""
+    paths = {
+        "private": os.path.join(directory, f"{key_id}_private.pem"),
+        "public": os.path.join(directory, f"{key_id}_public.pem"),
+    }
+    for path, pem in ((paths["private"], key.export_key()), (paths["public"], key.publickey().export_key())):
+        with open(path, "wb") as pem_file:
+            pem_file.write(pem)
+    return paths
+
+
+class FileAPITestCase(TestCase):
+    """Runs the API with stored files under a temporary MEDIA_ROOT."""
+    @classmethod
+    def setUpClass(cls):
+        media_root = tempfile.mkdtemp()
+        cls.addClassCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = override_settings(
+            MEDIA_ROOT=media_root,
+            SECURE_SSL_REDIRECT=False,
+            CELERY_TASK_ALWAYS_EAGER=True,
+            PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"],
+        )
+        settings_override.enable()
+        cls.addClassCleanup(settings_override.disable)
+        super().setUpClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = Users.objects.create_user("alice", email="alice@example.com", password="password")
+        cls.bob = Users.objects.create_user("bob", email="bob@example.com", password="password")
+
+    def setUp(self):
+        self.client = self.client_for(self.alice)
+
+    def client_for(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client
+
+    def upload(self, data, name="document.pdf", client=None):
+        """Upload data and run its processing; returns the File."""
+        with self.captureOnCommitCallbacks(execute=True):
+            response = (client or self.client).post("/files/upload/", {
+                "file": SimpleUploadedFile(name, data),
+                "encrypted_key": os.urandom(32).hex(),
+                "iv": os.urandom(12).hex(),
+            }, format="multipart")
+        self.assertEqual(response.status_code, 202, response.content)
+        return File.objects.get(id=response.json()["file_id"])
+
+    def download(self, file, client=None):
+        response = (client or self.client).get(f"/files/{file.id}/download/")
+        self.assertEqual(response.status_code, 200, response.content)
+        return base64.b64decode(response.json()["encrypted_file"])
+
+    def render_raw(self, file, client=None, **headers):
+        return (client or self.client).get(f"/files/{file.id}/render/?mode=raw", headers=headers)
+
+
+class UploadTests(FileAPITestCase):
+    def test_round_trip(self):
+        for size in (0, 1, 15, 16, 17, 64 * 1024, 200_000):
+            data = os.urandom(size)
+            file = self.upload(data)
+            self.assertEqual(file.size, size)
+            self.assertEqual(self.download(file), data)
+
+    def test_stored_content_is_encrypted(self):
+        data = b"client-encrypted bytes " * 1000
+        file = self.upload(data)
+        with open(file.encrypted_file.path, "rb") as stored:
+            content = stored.read()
+        self.assertTrue(content.startswith(SEGMENT_MAGIC))
+        self.assertNotIn(data[:64], content)
+
+    def test_missing_fields(self):
+        response = self.client.post("/files/upload/", {"file": SimpleUploadedFile("a.pdf", b"data")}, format="multipart")
+        self.assertEqual(response.status_code, 400)
+
+
+class RawDownloadTests(FileAPITestCase):
+    def test_raw_mode_streams_the_payload(self):
+        data = os.urandom(200_000)
+        file = self.upload(data, name="photo.png")
+        for endpoint in ("download", "render"):
+            response = self.client.get(f"/files/{file.id}/{endpoint}/?mode=raw")
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.streaming)
+            self.assertEqual(response["Content-Type"], "application/octet-stream")
+            self.assertEqual(response["Content-Length"], str(len(data)))
+            self.assertEqual(b"".join(response.streaming_content), data)
+            self.assertEqual(base64.b64decode(response["X-File-IV"]), bytes(file.iv))
+            self.assertEqual(response["X-File-Name"], "photo.png")
+            self.assertEqual(response["X-Media-Type"], "image/png")
+
+    def test_raw_mode_checks_access(self):
+        file = self.upload(os.urandom(100))
+        self.assertEqual(self.render_raw(file, client=self.client_for(self.bob)).status_code, 403)
+
+
+class TTLCacheTests(SimpleTestCase):
+    def test_entries_expire(self):
+        cache = TTLCache(ttl=10, max_entries=10)
+        with mock.patch("files.cache.time.monotonic", return_value=100):
+            cache.set("key", "value")
+        with mock.patch("files.cache.time.monotonic", return_value=109):
+            self.assertEqual(cache.get("key"), "value")
+        with mock.patch("files.cache.time.monotonic", return_value=110):
+            self.assertIsNone(cache.get("key"))
+        self.assertEqual(len(cache), 0)
+
+    def test_least_recently_used_is_evicted(self):
+        cache = TTLCache(ttl=60, max_entries=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual((cache.get("a"), cache.get("b"), cache.get("c")), (1, None, 3))
+        cache.delete("a")
+        self.assertEqual(cache.get("a", "missing"), "missing")
+
+
+class SegmentContainerTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(aes_encryption, "SEGMENT_SIZE", 64)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_round_trip(self):
+        for size in (0, 1, 63, 64, 65, 64 * 5 + 7):
+            data = os.urandom(size)
+            blob = aes_encryption.encrypt_file(data)
+            self.assertEqual(aes_encryption.decrypt_file(blob), data)
+            self.assertEqual(decrypt_blob(blob), data)
+
+    def test_ranges_decrypt_only_what_was_asked(self):
+        data = os.urandom(64 * 4 + 10)
+        blob = aes_encryption.encrypt_file(data)
+        for start, end in ((0, 1), (63, 65), (64, 128), (100, 300), (265, 266), (200, 10_000)):
+            self.assertEqual(decrypt_blob(blob, start, end), data[start:end])
+
+    def test_tampered_segment_is_rejected(self):
+        data = os.urandom(200)
+        blob = bytearray(aes_encryption.encrypt_file(data))
+        blob[-1] ^= 1
+        with self.assertRaisesMessage(Exception, "Decryption failed"):
+            decrypt_blob(bytes(blob))
+        # Segments before the tampered one are still readable on their own
+        self.assertEqual(decrypt_blob(bytes(blob), 0, 64), data[:64])
+
+    def test_reordered_segments_are_rejected(self):
+        blob = aes_encryption.encrypt_file(os.urandom(128))
+        header_size = len(blob) - 2 * (64 + 16)
+        first, second = blob[header_size:header_size + 80], blob[header_size + 80:]
+        with self.assertRaisesMessage(Exception, "Decryption failed"):
+            decrypt_blob(blob[:header_size] + second + first)
+
+    def test_legacy_cbc_ranges(self):
+        data = os.urandom(1000)
+        blob = legacy_cbc_blob(data)
+        self.assertEqual(aes_encryption.decrypt_file(blob), data)
+        for start, end in ((0, 1000), (0, 16), (15, 17), (16, 32), (500, 999), (999, 1000), (990, 5000)):
+            self.assertEqual(decrypt_blob(blob, start, end), data[start:end])
+
+    def test_key_id_is_authenticated(self):
+        data = os.urandom(200)
+        with mock.patch.object(aes_encryption, "keys", {**aes_encryption.keys, "v2": os.urandom(32)}):
+            blob = bytearray(b"".join(aes_encryption.encrypt_stream([data], len(data), "v2")))
+            self.assertEqual(unpack_segment_header(blob)[4], "v2")
+            self.assertEqual(decrypt_blob(bytes(blob)), data)
+            blob[SEGMENT_HEADER.size + 1] = ord("1")  # Claim key "v1"
+            with self.assertRaisesMessage(Exception, "Decryption failed"):
+                decrypt_blob(bytes(blob))
+
+    def test_version_1_headers_use_the_legacy_key(self):
+        data = os.urandom(100)
+        header = aes_encryption.segment_header(len(data), version=1)
+        self.assertEqual(unpack_segment_header(header)[::4], (1, "v1"))
+        segments = [aes_encryption.encrypt_segment(header, index, data[index * 64:(index + 1) * 64]) for index in range(2)]
+        blob = header + aes_encryption.segment_table(header, [nonce for nonce, _ in segments])
+        blob += b"".join(encrypted for _, encrypted in segments)
+        self.assertEqual(decrypt_blob(blob), data)
+
+
+class SegmentPoolTests(SimpleTestCase):
+    def test_results_keep_their_order(self):
+        def work(index):
+            time.sleep((index % 3) * 0.002)
+            return index
+
+        pool = SegmentPool(4)
+        self.assertEqual(list(pool.map(work, ((index,) for index in range(50)))), list(range(50)))
+
+    def test_in_flight_segments_are_bounded(self):
+        pool, submitted, consumed = SegmentPool(2), [], []
+
+        def items():
+            for index in range(20):
+                submitted.append(index)
+                self.assertLessEqual(len(submitted) - len(consumed), 2 * 2 + 1)
+                yield (index,)
+
+        for result in pool.map(lambda index: index, items()):
+            consumed.append(result)
+        self.assertEqual(consumed, list(range(20)))
+
+    def test_single_worker_runs_inline(self):
+        threads = list(SegmentPool(1).map(lambda: threading.current_thread(), [()] * 3))
+        self.assertEqual(threads, [threading.current_thread()] * 3)
+
+    def test_parallel_container_round_trip(self):
+        data = os.urandom(64 * 40 + 3)
+        with mock.patch.object(aes_encryption, "SEGMENT_SIZE", 64), mock.patch.object(aes_encryption, "pool", SegmentPool(4)):
+            blob = aes_encryption.encrypt_file(data)
+            self.assertEqual(decrypt_blob(blob), data)
+            self.assertEqual(decrypt_blob(blob, 100, 2000), data[100:2000])
+
+
+class ParseRangeHeaderTests(SimpleTestCase):
+    def test_ranges(self):
+        self.assertEqual(parse_range_header("bytes=0-99", 1000), (0, 100))
+        self.assertEqual(parse_range_header("bytes=900-", 1000), (900, 1000))
+        self.assertEqual(parse_range_header("bytes=900-5000", 1000), (900, 1000))
+        self.assertEqual(parse_range_header("bytes=-100", 1000), (900, 1000))
+        self.assertEqual(parse_range_header("bytes=-5000", 1000), (0, 1000))
+
+    def test_whole_payload(self):
+        for header in (None, "", "items=0-1", "bytes=0-1,5-6", "bytes=a-b", "bytes=-", "bytes=5-2"):
+            self.assertIsNone(parse_range_header(header, 1000), header)
+
+    def test_unsatisfiable(self):
+        for header, size in (("bytes=1000-", 1000), ("bytes=-0", 1000), ("bytes=0-", 0), ("bytes=-10", 0)):
+            with self.assertRaises(ValueError, msg=header):
+                parse_range_header(header, size)
+
+
+class RangeResponseTests(FileAPITestCase):
+    def test_range_requests(self):
+        data = os.urandom(3000)
+        file = self.upload(data)
+        response = self.render_raw(file, Range="bytes=1000-1999")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response["Content-Range"], "bytes 1000-1999/3000")
+        self.assertEqual(response["Content-Length"], "1000")
+        self.assertEqual(b"".join(response.streaming_content), data[1000:2000])
+
+        response = self.render_raw(file)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+
+        response = self.render_raw(file, Range="bytes=3000-")
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response["Content-Range"], "bytes */3000")
+
+        response = self.render_raw(self.upload(b""), Range="bytes=-10")
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response["Content-Range"], "bytes */0")
+
+    def test_legacy_files_are_still_served(self):
+        data = os.urandom(1000)
+        file = self.upload(b"")
+        with open(file.encrypted_file.path, "wb") as stored:
+            stored.write(legacy_cbc_blob(data))
+        self.assertEqual(self.download(file), data)
+        response = self.render_raw(file, Range="bytes=100-199")
+        self.assertEqual(b"".join(response.streaming_content), data[100:200])
+
+
+class UploadProcessingTests(FileAPITestCase):
+    def test_upload_is_pending_until_processed(self):
+        data = os.urandom(3000)
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post("/files/upload/", {
+                "file": SimpleUploadedFile("document.pdf", data),
+                "encrypted_key": os.urandom(32).hex(),
+                "iv": os.urandom(12).hex(),
+            }, format="multipart")
+        self.assertEqual(response.status_code, 202)
+        file_id = response.json()["file_id"]
+        self.assertEqual(self.client.get(f"/files/{file_id}/status/").json()["status"], "Pending")
+        self.assertEqual(self.client.get(f"/files/{file_id}/download/").status_code, 409)
+        self.assertEqual(self.client.get(f"/files/{file_id}/render/").status_code, 409)
+
+        for callback in callbacks:
+            callback()
+        self.assertEqual(self.client.get(f"/files/{file_id}/status/").json()["status"], "Ready")
+        self.assertEqual(File.objects.get(id=file_id).sha256, hashlib.sha256(data).hexdigest())
+        self.assertEqual(self.download(File.objects.get(id=file_id)), data)
+
+    def test_failed_processing_is_recorded(self):
+        with mock.patch("files.tasks.link_blob", side_effect=OSError("Storage unavailable")) as link_blob:
+            file = self.upload(os.urandom(100))
+        self.assertEqual(link_blob.call_count, settings.FILE_PROCESSING_MAX_RETRIES + 1)
+        self.assertEqual((file.status, file.processing_error), ("Failed", "Storage unavailable"))
+        self.assertEqual(self.client.get(f"/files/{file.id}/status/").json()["status"], "Failed")
+
+    def test_status_checks_access(self):
+        file = self.upload(os.urandom(100))
+        self.assertEqual(self.client_for(self.bob).get(f"/files/{file.id}/status/").status_code, 403)
+        self.assertEqual(self.client.get("/files/999/status/").status_code, 404)
+
+
+class UploadSessionTests(FileAPITestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(aes_encryption, "SEGMENT_SIZE", 64)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def start_session(self, data, chunks=None, **headers):
+        """Start a session for data and send the given chunks (all by default)."""
+        response = self.client.post("/files/uploads/", {
+            "name": "large.bin", "size": len(data), "encrypted_key": os.urandom(32).hex(), "iv": os.urandom(12).hex(),
+        }, format="json", headers=headers)
+        self.assertIn(response.status_code, (200, 201), response.content)
+        session_id = response.json()["session_id"]
+        for index in range(response.json()["total_chunks"]) if chunks is None else chunks:
+            response = self.send_chunk(session_id, index, data[index * 64:(index + 1) * 64])
+            self.assertEqual(response.status_code, 200, response.content)
+        return UploadSession.objects.get(id=session_id)
+
+    def send_chunk(self, session_id, index, chunk):
+        return self.client.put(
+            f"/files/uploads/{session_id}/chunks/{index}/", chunk, content_type="application/octet-stream"
+        )
+
+    def finalize(self, session):
+        """Finalize a complete session and run its assembly; returns the File."""
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(f"/files/uploads/{session.id}/finalize/")
+        self.assertEqual(response.status_code, 202, response.content)
+        return File.objects.get(id=response.json()["file_id"])
+
+    def finalize_later(self, session):
+        """Finalize a complete session; returns the File and its unrun assembly callbacks."""
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post(f"/files/uploads/{session.id}/finalize/")
+        self.assertEqual(response.status_code, 202, response.content)
+        return File.objects.get(id=response.json()["file_id"]), callbacks
+
+    def test_chunks_are_assembled(self):
+        data = os.urandom(64 * 3 + 5)
+        session = self.start_session(data)
+        chunk_paths = [session.chunk_path(index) for index in range(4)]
+        file = self.finalize(session)
+        self.assertEqual(file.status, "Ready")
+        self.assertEqual(b"".join(self.render_raw(file).streaming_content), data)
+        self.assertEqual(self.download(file), data)
+        self.assertFalse(any(default_storage.exists(path) for path in chunk_paths))
+
+        # Finalizing again returns the same file
+        response = self.client.post(f"/files/uploads/{session.id}/finalize/")
+        self.assertEqual((response.status_code, response.json()["file_id"]), (200, file.id))
+
+    def test_missing_chunks_are_reported(self):
+        data = os.urandom(64 * 3 + 5)
+        session = self.start_session(data, chunks=[0, 2])
+        details = self.client.get(f"/files/uploads/{session.id}/").json()
+        self.assertEqual((details["received_chunks"], details["missing_chunks"]), ([0, 2], [1, 3]))
+        self.assertEqual(self.client.post(f"/files/uploads/{session.id}/finalize/").status_code, 409)
+
+        # Re-sending a chunk replaces it
+        self.assertEqual(self.send_chunk(session.id, 0, os.urandom(64)).status_code, 200)
+        for index in (0, 1, 3):
+            self.send_chunk(session.id, index, data[index * 64:(index + 1) * 64])
+        self.assertEqual(self.download(self.finalize(session)), data)
+
+    def test_invalid_chunks_are_rejected(self):
+        session = self.start_session(os.urandom(100), chunks=[])
+        self.assertEqual(self.send_chunk(session.id, 0, os.urandom(63)).status_code, 400)
+        self.assertEqual(self.send_chunk(session.id, 1, os.urandom(36)).status_code, 200)
+        self.assertEqual(self.send_chunk(session.id, 2, os.urandom(1)).status_code, 400)
+        other = self.client_for(self.bob).put(
+            f"/files/uploads/{session.id}/chunks/0/", os.urandom(64), content_type="application/octet-stream"
+        )
+        self.assertEqual(other.status_code, 404)
+
+    def test_idempotency_key_returns_the_same_session(self):
+        first = self.start_session(os.urandom(100), chunks=[0], **{"Idempotency-Key": "retry-1"})
+        second = self.start_session(os.urandom(100), chunks=[], **{"Idempotency-Key": "retry-1"})
+        self.assertEqual(first.id, second.id)
+
+    def test_discarded_sessions_lose_their_chunks(self):
+        session = self.start_session(os.urandom(100))
+        response = self.client.delete(f"/files/uploads/{session.id}/")
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(default_storage.exists(session.chunk_path(0)))
+
+        expired = self.start_session(os.urandom(100))
+        live = self.start_session(os.urandom(100))
+        UploadSession.objects.filter(id=expired.id).update(expires_at=now() - timedelta(seconds=1))
+        self.assertEqual(self.send_chunk(expired.id, 0, os.urandom(64)).status_code, 410)
+        call_command("purge_upload_sessions", stdout=io.StringIO())
+        self.assertEqual(list(UploadSession.objects.values_list("id", flat=True)), [live.id])
+        self.assertFalse(default_storage.exists(expired.chunk_path(0)))
+        self.assertTrue(default_storage.exists(live.chunk_path(0)))
+
+    def test_purge_keeps_sessions_being_assembled(self):
+        session = self.start_session(os.urandom(100))
+        file, callbacks = self.finalize_later(session)
+        UploadSession.objects.filter(id=session.id).update(expires_at=now() - timedelta(days=1))
+
+        call_command("purge_upload_sessions", stdout=io.StringIO())
+        self.assertTrue(UploadSession.objects.filter(id=session.id).exists())
+        self.assertEqual(self.client.delete(f"/files/uploads/{session.id}/").status_code, 409)
+
+        for callback in callbacks:
+            callback()
+        file.refresh_from_db()
+        self.assertEqual(file.status, "Ready")
+        call_command("purge_upload_sessions", stdout=io.StringIO())
+        self.assertFalse(UploadSession.objects.filter(id=session.id).exists())
+
+    def test_idempotency_key_keeps_sessions_being_assembled(self):
+        session = self.start_session(os.urandom(100), **{"Idempotency-Key": "retry-1"})
+        file, callbacks = self.finalize_later(session)
+        UploadSession.objects.filter(id=session.id).update(expires_at=now() - timedelta(days=1))
+
+        response = self.client.post("/files/uploads/", {
+            "name": "large.bin", "size": 100, "encrypted_key": os.urandom(32).hex(), "iv": os.urandom(12).hex(),
+        }, format="json", headers={"Idempotency-Key": "retry-1"})
+        self.assertEqual(response.status_code, 409)
+        self.assertTrue(UploadSession.objects.filter(id=session.id).exists())
+
+        for callback in callbacks:
+            callback()
+        file.refresh_from_db()
+        self.assertEqual(file.status, "Ready")
+
+    def test_missing_session_fails_the_file(self):
+        session = self.start_session(os.urandom(100))
+        file, callbacks = self.finalize_later(session)
+        session.discard()
+        for callback in callbacks:
+            callback()
+        file.refresh_from_db()
+        self.assertEqual((file.status, file.processing_error), ("Failed", "Upload session no longer exists"))
+
+
+class RSAKeyRingTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.first_key, cls.second_key = RSA.generate(2048), RSA.generate(2048)
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+
+    def test_changed_pem_files_are_reloaded(self):
+        ring, paths = RSAKeyRing(), write_rsa_pair(self.directory, "v1", self.first_key)
+        with override_settings(RSA_KEYS={"v1": paths}, RSA_ACTIVE_KEY_ID="v1", RSA_KEY_RELOAD_INTERVAL=3600):
+            self.assertEqual(ring.public_key(), self.first_key.publickey())
+            wrapped = ring.encrypt(b"client key")
+            write_rsa_pair(self.directory, "v1", self.second_key)
+            for path in paths.values():
+                stat = os.stat(path)
+                os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+            # Not checked again before the reload interval has passed
+            self.assertEqual(ring.public_key(), self.first_key.publickey())
+            self.assertEqual(ring.decrypt(wrapped), b"client key")
+
+        with override_settings(RSA_KEYS={"v1": paths}, RSA_ACTIVE_KEY_ID="v1", RSA_KEY_RELOAD_INTERVAL=0):
+            self.assertEqual(ring.public_key(), self.second_key.publickey())
+            self.assertEqual(ring.decrypt(ring.encrypt(b"client key")), b"client key")
+
+    def test_unchanged_pairs_stay_cached(self):
+        ring, paths = RSAKeyRing(), write_rsa_pair(self.directory, "v1", self.first_key)
+        with override_settings(RSA_KEYS={"v1": paths}, RSA_ACTIVE_KEY_ID="v1", RSA_KEY_RELOAD_INTERVAL=0):
+            private_key = ring.private_key()
+            with mock.patch("files.utils.RSA.import_key") as import_key:
+                self.assertIs(ring.private_key(), private_key)
+            import_key.assert_not_called()
+
+    def test_older_pairs_still_unwrap(self):
+        ring = RSAKeyRing()
+        rsa_keys = {
+            "v1": write_rsa_pair(self.directory, "v1", self.first_key),
+            "v2": write_rsa_pair(self.directory, "v2", self.second_key),
+        }
+        with override_settings(RSA_KEYS=rsa_keys, RSA_ACTIVE_KEY_ID="v1"):
+            wrapped = ring.encrypt(b"client key")
+        with override_settings(RSA_KEYS=rsa_keys, RSA_ACTIVE_KEY_ID="v2"):
+            self.assertEqual(ring.decrypt(wrapped, "v1"), b"client key")
+            self.assertEqual(ring.decrypt(ring.encrypt(b"client key"), "v2"), b"client key")
+            with self.assertRaises(KeyError):
+                ring.decrypt(wrapped, "v3")
+
+
+class RSAKeyRotationTests(FileAPITestCase):
+    def test_files_keep_the_key_they_were_wrapped_with(self):
+        old_file = self.upload(b"old")
+        self.assertEqual(old_file.server_key_id, settings.RSA_ACTIVE_KEY_ID)
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        rsa_keys = {**settings.RSA_KEYS, "rotated": write_rsa_pair(directory, "rotated", RSA.generate(2048))}
+        with override_settings(RSA_KEYS=rsa_keys, RSA_ACTIVE_KEY_ID="rotated"):
+            new_file = self.upload(b"new")
+            self.assertEqual(new_file.server_key_id, "rotated")
+            for file in (old_file, new_file):
+                response = self.client.get(f"/files/{file.id}/download/")
+                self.assertEqual(response.status_code, 200, response.content)
+
+    def test_active_key_must_be_listed(self):
+        with override_settings(RSA_ACTIVE_KEY_ID="v2"):
+            with self.assertRaisesMessage(ImproperlyConfigured, "RSA_ACTIVE_KEY_ID 'v2' is not one of RSA_KEYS"):
+                RSAKeyRing().active_key_id
+
+
+@override_settings(CLIENT_KEY_CACHE={"ENABLED": True, "TTL": 60, "MAX_ENTRIES": 100})
+class ClientKeyCacheTests(FileAPITestCase):
+    def setUp(self):
+        super().setUp()
+        client_key_cache.clear()
+        self.addCleanup(client_key_cache.clear)
+
+    def unwraps(self, file, client=None):
+        """Number of RSA unwraps a download of file takes."""
+        with mock.patch("files.utils.decrypt_with_private_key", wraps=decrypt_with_private_key) as unwrap:
+            response = (client or self.client).get(f"/files/{file.id}/download/")
+        self.assertEqual(response.status_code, 200, response.content)
+        return unwrap.call_count
+
+    def test_unwrapped_keys_are_reused(self):
+        file = self.upload(os.urandom(100))
+        self.assertEqual(self.unwraps(file), 1)
+        self.assertEqual(self.unwraps(file), 0)
+        with override_settings(CLIENT_KEY_CACHE={"ENABLED": False, "TTL": 60, "MAX_ENTRIES": 100}):
+            self.assertEqual(self.unwraps(file), 1)
+
+    def test_a_changed_wrapped_key_is_not_served_from_the_cache(self):
+        file = self.upload(os.urandom(100))
+        self.unwraps(file)
+        File.objects.filter(id=file.id).update(server_key=encrypt_with_public_key(b"k" * 32))
+        file.refresh_from_db()
+        response = self.client.get(f"/files/{file.id}/download/")
+        self.assertEqual(base64.b64decode(response.json()["client_key"]), b"k" * 32)
+
+    def test_delete_and_revoke_drop_the_entry(self):
+        file = self.upload(os.urandom(100))
+        self.unwraps(file)
+        response = self.client.post(f"/files/{file.id}/access/", {"username": "bob"}, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNotNone(client_key_cache.get(file.id))
+        response = self.client.delete(f"/files/{file.id}/access/", {"username": "bob"}, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(client_key_cache.get(file.id))
+
+        self.unwraps(file)
+        self.assertEqual(self.client.delete(f"/files/{file.id}/").status_code, 200)
+        self.assertIsNone(client_key_cache.get(file.id))
+
+
+async def collect(streaming_content):
+    return b"".join([chunk async for chunk in streaming_content])
+
+
+class AsyncViewTests(FileAPITestCase):
+    def async_request(self, method, path, user=None, **kwargs):
+        headers = {"Authorization": f"Bearer {RefreshToken.for_user(user or self.alice).access_token}"}
+        return async_to_sync(getattr(self.async_client, method))(path, headers={**headers, **kwargs.pop("headers", {})}, **kwargs)
+
+    def async_upload(self, data):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.async_request("post", "/files/async/upload/", data={
+                "file": SimpleUploadedFile("document.pdf", data),
+                "encrypted_key": os.urandom(32).hex(),
+                "iv": os.urandom(12).hex(),
+            })
+        self.assertEqual(response.status_code, 202, response.content)
+        return File.objects.get(id=response.json()["file_id"])
+
+    def test_upload_and_download(self):
+        data = os.urandom(200_000)
+        file = self.async_upload(data)
+        self.assertEqual(file.status, "Ready")
+        self.assertEqual(self.download(file), data)
+
+        response = self.async_request("get", f"/files/async/{file.id}/download/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(base64.b64decode(response.json()["encrypted_file"]), data)
+
+        response = self.async_request("get", f"/files/async/{file.id}/render/?mode=raw", headers={"Range": "bytes=100-1099"})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(async_to_sync(collect)(response.streaming_content), data[100:1100])
+
+    def test_staging_runs_on_the_transfer_executor(self):
+        threads = []
+
+        def stage_upload(*args):
+            threads.append(threading.current_thread().name)
+            return views.stage_upload(*args)
+
+        with mock.patch("files.async_views.stage_upload", stage_upload):
+            self.async_upload(os.urandom(100))
+        self.assertEqual(len(threads), 1)
+        self.assertTrue(threads[0].startswith("file-transfer"), threads)
+
+    def test_permissions(self):
+        file = self.upload(os.urandom(100))
+        self.assertEqual(async_to_sync(self.async_client.get)(f"/files/async/{file.id}/render/").status_code, 401)
+        self.assertEqual(self.async_request("get", f"/files/async/{file.id}/render/", user=self.bob).status_code, 403)
+
+        FileAccess.objects.create(file=file, user=self.bob, can_download=False)
+        self.assertEqual(self.async_request("get", f"/files/async/{file.id}/render/", user=self.bob).status_code, 200)
+        self.assertEqual(self.async_request("get", f"/files/async/{file.id}/download/", user=self.bob).status_code, 403)
+
+
+class FileListingTests(FileAPITestCase):
+    def list_page(self, **params):
+        return self.client.get("/files/", {"scope": "owned", **params})
+
+    def test_pages_cover_every_file_once(self):
+        sizes = [5, 1, 5, 3, 5, 2, 4]
+        ids = [self.upload(os.urandom(size)).id for size in sizes]
+        for sort, order in (("size", "asc"), ("size", "desc"), ("name", "asc"), ("date", "desc")):
+            seen, cursor = [], None
+            while True:
+                response = self.list_page(sort=sort, order=order, limit=2, **({"cursor": cursor} if cursor else {}))
+                self.assertEqual(response.status_code, 200, response.content)
+                seen += [entry["id"] for entry in response.json()["files"]]
+                cursor = response.json()["next_cursor"]
+                if cursor is None:
+                    break
+            self.assertEqual(sorted(seen), sorted(ids), sort)
+            if sort == "size":
+                expected = sorted(zip(sizes, ids), reverse=order == "desc")
+                self.assertEqual(seen, [file_id for _, file_id in expected])
+
+    def test_unscoped_listing_keeps_its_shape(self):
+        file = self.upload(b"data")
+        response = self.client.get("/files/")
+        self.assertEqual([entry["id"] for entry in response.json()["owned_files"]], [file.id])
+        self.assertEqual(response.json()["shared_files"], [])
+
+    def test_invalid_parameters(self):
+        self.upload(b"data")
+        for params in ({"sort": "owner"}, {"order": "up"}, {"limit": 0}, {"limit": "many"}, {"scope": "all"}):
+            self.assertEqual(self.list_page(**params).status_code, 400, params)
+        for cursor in (
+            "not base64!",
+            base64.urlsafe_b64encode(b"{}").decode(),
+            base64.urlsafe_b64encode(b"[1, 2, 3]").decode(),
+            encode_cursor("name", 1),
+            encode_cursor(5, "1"),
+            encode_cursor(True, 1),
+            encode_cursor([1], 1),
+        ):
+            self.assertEqual(self.list_page(sort="size", cursor=cursor).status_code, 400, cursor)
+        self.assertEqual(self.list_page(sort="date", cursor=encode_cursor("yesterday", 1)).status_code, 400)
+
+
+@override_settings(CACHES={"default": {
+    "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+    "LOCATION": os.path.join(tempfile.gettempdir(), "sfs-test-cache"),
+}})
+class AccessInvalidationTests(FileAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(shutil.rmtree, os.path.join(tempfile.gettempdir(), "sfs-test-cache"), ignore_errors=True)
+
+    def test_changes_are_seen_by_the_next_request(self):
+        file = self.upload(os.urandom(100))
+        bob = self.client_for(self.bob)
+        self.assertEqual(self.render_raw(file, client=bob).status_code, 403)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(f"/files/{file.id}/access/", {"username": "bob"}, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.render_raw(file, client=bob).status_code, 200)
+        self.assertEqual(self.render_raw(file, client=bob).status_code, 200)  # From the cache
+        self.assertEqual(bob.get(f"/files/{file.id}/download/").status_code, 403)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f"/files/{file.id}/access/", {"username": "bob", "can_download": True}, format="json")
+        self.assertEqual(bob.get(f"/files/{file.id}/download/").status_code, 200)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.delete(f"/files/{file.id}/access/", {"username": "bob"}, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.render_raw(file, client=bob).status_code, 403)
+        self.assertEqual(bob.get(f"/files/{file.id}/").status_code, 403)
+
+    def test_per_process_caches_are_not_used(self):
+        file = self.upload(os.urandom(100))
+        FileAccess.objects.create(file=file, user=self.bob)
+        with override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}), \
+                mock.patch("files.access.cache") as cache:
+            self.assertEqual(self.render_raw(file, client=self.client_for(self.bob)).status_code, 200)
+        self.assertEqual(cache.method_calls, [])
+
+
+@override_settings(CACHES={"default": {
+    "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+    "LOCATION": os.path.join(tempfile.gettempdir(), "sfs-test-cache"),
+}})
+class ShareableLinkTests(FileAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(shutil.rmtree, os.path.join(tempfile.gettempdir(), "sfs-test-cache"), ignore_errors=True)
+
+    def create_link(self, file):
+        response = self.client.post(f"/files/{file.id}/shareable-link/")
+        self.assertEqual(response.status_code, 201, response.content)
+        return response.json()["token"]
+
+    def test_warm_links_need_no_queries(self):
+        file = self.upload(os.urandom(100))
+        token = self.create_link(file)
+        bob = self.client_for(self.bob)
+        response = bob.get(f"/files/shared/{token}/")
+        self.assertEqual((response.status_code, response.json()["file_id"]), (200, file.id))
+        with self.assertNumQueries(0):
+            self.assertEqual(bob.get(f"/files/shared/{token}/").status_code, 200)
+
+    def test_entries_are_capped_and_kept_out_of_per_process_caches(self):
+        link = ShareableLink.objects.create(file=self.upload(os.urandom(100)), expires_at=now() + timedelta(days=7))
+        bob = self.client_for(self.bob)
+        with override_settings(SHARE_LINK_CACHE_TTL=30), mock.patch("files.links.cache.set") as cache_set:
+            self.assertEqual(bob.get(f"/files/shared/{link.token}/").status_code, 200)
+        self.assertEqual(cache_set.call_args.args[2], 30)
+
+        with override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}), \
+                mock.patch("files.links.cache") as cache:
+            self.assertEqual(bob.get(f"/files/shared/{link.token}/").status_code, 200)
+        self.assertEqual(cache.method_calls, [])
+
+    def test_deleted_and_regenerated_links_stop_resolving(self):
+        file = self.upload(os.urandom(100))
+        bob = self.client_for(self.bob)
+        first = self.create_link(file)
+        self.assertEqual(bob.get(f"/files/shared/{first}/").status_code, 200)
+
+        second = self.create_link(file)
+        self.assertEqual(bob.get(f"/files/shared/{first}/").status_code, 404)
+        self.assertEqual(bob.get(f"/files/shared/{second}/").status_code, 200)
+
+        self.client.delete(f"/files/{file.id}/shareable-link/", {"token": second}, format="json")
+        self.assertEqual(bob.get(f"/files/shared/{second}/").status_code, 404)
+
+    def test_expired_and_unknown_links(self):
+        file = self.upload(os.urandom(100))
+        link = ShareableLink.objects.create(file=file, expires_at=now() - timedelta(seconds=1))
+        bob = self.client_for(self.bob)
+        self.assertEqual(bob.get(f"/files/shared/{link.token}/").status_code, 403)
+        self.assertEqual(bob.get("/files/shared/00000000-0000-0000-0000-000000000000/").status_code, 404)
+
+
+class BulkFileAccessTests(FileAPITestCase):
+    def bulk(self, action, file_ids, usernames, **extra):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post("/files/access/bulk/", {
+                "action": action, "file_ids": file_ids, "usernames": usernames, **extra,
+            }, format="json")
+        self.assertEqual(response.status_code, 200, response.content)
+        return [(result["file_id"], result["username"], result["result"]) for result in response.json()["results"]]
+
+    def test_grant_and_revoke(self):
+        first, second = self.upload(os.urandom(10)), self.upload(os.urandom(10))
+        others = self.upload(os.urandom(10), client=self.client_for(self.bob))
+        carol = Users.objects.create_user("carol", email="carol@example.com", password="password")
+        FileAccess.objects.create(file=first, user=carol, can_download=False)
+
+        results = self.bulk("grant", [first.id, second.id, others.id], ["bob", "carol", "alice", "nobody"], can_download=True)
+        self.assertEqual(results, [
+            (first.id, "bob", "granted"), (first.id, "carol", "updated"),
+            (first.id, "alice", "is_owner"), (first.id, "nobody", "user_not_found"),
+            (second.id, "bob", "granted"), (second.id, "carol", "granted"),
+            (second.id, "alice", "is_owner"), (second.id, "nobody", "user_not_found"),
+            (others.id, "bob", "file_not_found"), (others.id, "carol", "file_not_found"),
+            (others.id, "alice", "file_not_found"), (others.id, "nobody", "file_not_found"),
+        ])
+        self.assertEqual(FileAccess.objects.filter(file__in=[first, second], can_download=True).count(), 4)
+        self.assertEqual(self.bulk("grant", [first.id], ["bob"], can_download=True), [(first.id, "bob", "unchanged")])
+
+        bob = self.client_for(self.bob)
+        self.assertEqual(bob.get(f"/files/{second.id}/download/").status_code, 200)
+        self.assertEqual(self.bulk("revoke", [first.id, second.id], ["bob"]), [
+            (first.id, "bob", "revoked"), (second.id, "bob", "revoked"),
+        ])
+        self.assertEqual(self.bulk("revoke", [first.id], ["bob"]), [(first.id, "bob", "not_shared")])
+        self.assertEqual(bob.get(f"/files/{second.id}/download/").status_code, 403)
+
+    def test_can_download_is_parsed_strictly(self):
+        file = self.upload(os.urandom(10))
+        self.bulk("grant", [file.id], ["bob"], can_download="false")
+        self.assertFalse(FileAccess.objects.get(file=file, user=self.bob).can_download)
+        self.bulk("grant", [file.id], ["bob"], can_download="true")
+        self.assertTrue(FileAccess.objects.get(file=file, user=self.bob).can_download)
+
+    def test_concurrently_created_pairs_are_updated(self):
+        file = self.upload(os.urandom(10))
+        FileAccess.objects.create(file=file, user=self.bob, can_download=False)
+        # As if the row was created after this request read the existing ones
+        with mock.patch.object(FileAccess.objects, "select_for_update", return_value=FileAccess.objects.none()):
+            self.assertEqual(self.bulk("grant", [file.id], ["bob"], can_download=True), [(file.id, "bob", "granted")])
+        self.assertTrue(FileAccess.objects.get(file=file, user=self.bob).can_download)
+
+    def test_invalid_requests(self):
+        file = self.upload(os.urandom(10))
+        for body in (
+            {"action": "share", "file_ids": [file.id], "usernames": ["bob"]},
+            {"action": "grant", "file_ids": [file.id], "usernames": ["bob"], "can_download": "maybe"},
+            {"action": "grant", "file_ids": str(file.id), "usernames": ["bob"]},
+            {"action": "grant", "file_ids": [file.id], "usernames": [1]},
+        ):
+            self.assertEqual(self.client.post("/files/access/bulk/", body, format="json").status_code, 400, body)
+        with override_settings(BULK_ACCESS_MAX_ITEMS=1):
+            response = self.client.post("/files/access/bulk/", {
+                "action": "grant", "file_ids": [file.id], "usernames": ["bob", "carol"],
+            }, format="json")
+        self.assertEqual(response.status_code, 400)
+
+
+class FileArchiveTests(FileAPITestCase):
+    def test_archive_holds_every_file_and_a_manifest(self):
+        contents = [os.urandom(200_000), b"", os.urandom(17)]
+        files = [self.upload(data, name=f"dir/file{index}.bin") for index, data in enumerate(contents)]
+        response = self.client.post("/files/archive/", {"file_ids": [file.id for file in files]}, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "application/zip")
+
+        with zipfile.ZipFile(io.BytesIO(b"".join(response.streaming_content))) as archive:
+            manifest = json.loads(archive.read("manifest.json"))["files"]
+            self.assertEqual([entry["file_id"] for entry in manifest], [file.id for file in files])
+            for index, (entry, file, data) in enumerate(zip(manifest, files, contents)):
+                self.assertEqual(entry["path"], f"{file.id}_file{index}.bin")
+                self.assertEqual(archive.read(entry["path"]), data)
+                self.assertEqual(base64.b64decode(entry["iv"]), bytes(file.iv))
+                self.assertEqual(entry["size"], len(data))
+
+    def test_every_file_is_checked_before_streaming(self):
+        mine = self.upload(os.urandom(10))
+        theirs = self.upload(os.urandom(10), client=self.client_for(self.bob))
+        FileAccess.objects.create(file=theirs, user=self.alice, can_download=False)
+        for file_ids, status_code in (([mine.id, 999], 404), ([mine.id, theirs.id], 403), ([], 400), ("1", 400)):
+            response = self.client.post("/files/archive/", {"file_ids": file_ids}, format="json")
+            self.assertEqual(response.status_code, status_code, file_ids)
+
+        File.objects.filter(id=mine.id).update(status="Pending")
+        self.assertEqual(self.client.post("/files/archive/", {"file_ids": [mine.id]}, format="json").status_code, 409)
+
+
+class ConditionalRequestTests(FileAPITestCase):
+    def test_etag_revalidation(self):
+        file = self.upload(os.urandom(100))
+        response = self.render_raw(file)
+        self.assertEqual(response.status_code, 200)
+        etag = response["ETag"]
+        self.assertEqual(etag, f'"{file.sha256}-raw"')
+        self.assertIn("private", response["Cache-Control"])
+
+        with mock.patch("files.views.unwrap_client_key") as unwrap_client_key:
+            response = self.render_raw(file, If_None_Match=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+        unwrap_client_key.assert_not_called()
+
+        # The JSON representation has its own validator
+        response = self.client.get(f"/files/{file.id}/render/", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["ETag"], f'"{file.sha256}-json"')
+
+    def test_revalidation_still_checks_access(self):
+        file = self.upload(os.urandom(100))
+        etag = self.render_raw(file)["ETag"]
+        response = self.render_raw(file, client=self.client_for(self.bob), If_None_Match=etag)
+        self.assertEqual(response.status_code, 403)
+
+    def test_detail_etag_follows_sharing(self):
+        file = self.upload(os.urandom(100))
+        etag = self.client.get(f"/files/{file.id}/")["ETag"]
+        self.assertEqual(self.client.get(f"/files/{file.id}/", headers={"If-None-Match": etag}).status_code, 304)
+        FileAccess.objects.create(file=file, user=self.bob)
+        self.assertEqual(self.client.get(f"/files/{file.id}/", headers={"If-None-Match": etag}).status_code, 200)
+
+
+class LoadBenchmarkTests(SimpleTestCase):
+    def result(self, requests_per_s=100.0, p95_ms=10.0, queries_per_request=3.0):
+        return {
+            "scenario": "render", "size": 1024 ** 2, "concurrency": 4,
+            "requests_per_s": requests_per_s, "p95_ms": p95_ms, "queries_per_request": queries_per_request,
+        }
+
+    def test_sizes(self):
+        self.assertEqual([load.parse_size(text) for text in ("1KB", "64mb", "1GB", "512", "1.5KB")],
+                         [1024, 64 * 1024 ** 2, 1024 ** 3, 512, 1536])
+        self.assertEqual([load.format_size(size) for size in (1024, 64 * 1024 ** 2, 1024 ** 3, 1536)],
+                         ["1KB", "64MB", "1GB", "1536B"])
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual([load.percentile(values, fraction) for fraction in (0.5, 0.95, 0.99)], [50, 95, 99])
+        self.assertEqual(load.percentile([7], 0.99), 7)
+
+    def test_regressions_are_reported_against_the_baseline(self):
+        baseline = {"results": [self.result()]}
+        self.assertEqual(load.compare([self.result(requests_per_s=95.0, p95_ms=10.5)], baseline, 0.1), [])
+        regressions = load.compare([self.result(requests_per_s=50.0, p95_ms=20.0, queries_per_request=4.0)], baseline, 0.1)
+        self.assertEqual(len(regressions), 3)
+        self.assertTrue(all(line.startswith("render 1MB x4:") for line in regressions))
+        self.assertEqual(load.compare([{**self.result(), "concurrency": 16}], baseline, 0.1), [])
+
+
+class MetricsTests(FileAPITestCase):
+    def test_exposition_format(self):
+        counter = metrics.Counter("test_bytes_total", "Bytes.", ("operation",))
+        histogram = metrics.Histogram("test_seconds", "Time.", ("view",), buckets=(0.1, 1))
+        self.addCleanup(metrics.registry.remove, counter)
+        self.addCleanup(metrics.registry.remove, histogram)
+        counter.inc(5, operation='read "a"')
+        histogram.observe(0.05, view="x")
+        histogram.observe(2, view="x")
+
+        text = metrics.render()
+        self.assertIn('# TYPE test_bytes_total counter\ntest_bytes_total{operation="read \\"a\\""} 5\n', text)
+        self.assertIn("\n".join([
+            "# TYPE test_seconds histogram",
+            'test_seconds_bucket{view="x",le="0.1"} 1',
+            'test_seconds_bucket{view="x",le="1.0"} 1',
+            'test_seconds_bucket{view="x",le="+Inf"} 2',
+            'test_seconds_sum{view="x"} 2.05',
+            'test_seconds_count{view="x"} 2',
+        ]), text)
+
+    @override_settings(METRICS_TOKEN="scrape-secret")
+    def test_transfers_are_recorded(self):
+        self.download(self.upload(os.urandom(1000)))
+        text = self.client.get("/metrics/", headers={"Authorization": "Bearer scrape-secret"}).content.decode()
+        for line in (
+            'sfs_aes_bytes_total{operation="encrypt"}',
+            'sfs_rsa_seconds_count{operation="decrypt"}',
+            'sfs_http_request_duration_seconds_count{view="file-download",method="GET",status="200"}',
+            'sfs_db_queries_per_request_count{view="file-download"}',
+        ):
+            self.assertIn(line, text)
+
+    @override_settings(METRICS_TOKEN="scrape-secret")
+    def test_bearer_token(self):
+        self.assertEqual(self.client.get("/metrics/").status_code, 401)
+        self.assertEqual(self.client.get("/metrics/", headers={"Authorization": "Bearer wrong"}).status_code, 401)
+        response = self.client.get("/metrics/", headers={"Authorization": "Bearer scrape-secret"})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain; version=0.0.4"))
+        self.assertIn("# TYPE sfs_http_request_duration_seconds histogram", response.content.decode())
+
+    @override_settings(METRICS_TOKEN="")
+    def test_no_token_outside_debug(self):
+        self.assertEqual(self.client.get("/metrics/").status_code, 404)
+        with override_settings(DEBUG=True):
+            response = self.client.get("/metrics/")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("# TYPE sfs_aes_bytes_total counter", response.content.decode())
+
+
+@override_settings(CACHES={"default": {
+    "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+    "LOCATION": os.path.join(tempfile.gettempdir(), "sfs-test-cache"),
+}})
+class RequestProfilerTests(FileAPITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.admin = Users.objects.create_user("admin", email="admin@example.com", password="password", role="Admin")
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(shutil.rmtree, os.path.join(tempfile.gettempdir(), "sfs-test-cache"), ignore_errors=True)
+
+    def jwt_client(self, user):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f"Bearer {RefreshToken.for_user(user).access_token}")
+        return client
+
+    def test_admins_can_profile_a_request(self):
+        admin = self.jwt_client(self.admin)
+        file = self.upload(os.urandom(200_000), client=admin)
+        response = admin.get(f"/files/{file.id}/render/?mode=raw", headers={"X-Profile": "1"})
+        self.assertEqual(response.status_code, 200)
+        b"".join(response.streaming_content)  # The profile is saved once the stream ends
+        profile_id = response["X-Profile-Id"]
+
+        profile = admin.get(f"/profiles/{profile_id}/").json()
+        self.assertEqual((profile["path"], profile["status"], profile["user"]), (f"/files/{file.id}/render/?mode=raw", 200, "admin"))
+        self.assertGreater(profile["query_count"], 0)
+        self.assertGreaterEqual(profile["stages"]["aes.decrypt"]["bytes"], 200_000)
+        self.assertIn("rsa.decrypt", profile["stages"])
+        self.assertEqual(admin.get("/profiles/").json()["profiles"][0]["id"], profile_id)
+
+    def test_other_requests_are_not_profiled(self):
+        file = self.upload(os.urandom(100))
+        self.assertNotIn("X-Profile-Id", self.render_raw(file, X_Profile="1"))
+        self.assertNotIn("X-Profile-Id", self.jwt_client(self.alice).get(f"/files/{file.id}/", headers={"X-Profile": "1"}))
+        self.assertNotIn("X-Profile-Id", self.jwt_client(self.admin).get("/profiles/"))
+        self.assertEqual(self.jwt_client(self.alice).get("/profiles/").status_code, 403)
+        self.assertEqual(self.jwt_client(self.admin).get("/profiles/unknown/").status_code, 404)
+
+    def test_profiles_are_listed_newest_first(self):
+        admin = self.jwt_client(self.admin)
+        ids = [admin.get(f"/files/?page={page}", headers={"X-Profile": "1"})["X-Profile-Id"] for page in (1, 2, 3)]
+        with override_settings(PROFILER_MAX_RESULTS=2):
+            listed = admin.get("/profiles/").json()["profiles"]
+        self.assertEqual([profile["id"] for profile in listed], ids[:0:-1])
+        self.assertTrue(all(profile["complete"] for profile in listed))
+        self.assertEqual(admin.get(f"/profiles/{ids[0]}/").json()["path"], "/files/?page=1")
+
+    @contextmanager
+    def profiler_busy(self):
+        """Hold the profiler on another thread, as a concurrent flagged request would."""
+        running, release = threading.Event(), threading.Event()
+
+        def profile_elsewhere():
+            with profiling.RequestProfile(RequestFactory().get("/elsewhere/"), self.admin).active() as profiled:
+                self.assertTrue(profiled)
+                running.set()
+                release.wait(5)
+
+        thread = threading.Thread(target=profile_elsewhere)
+        thread.start()
+        try:
+            self.assertTrue(running.wait(5))
+            yield
+        finally:
+            release.set()
+            thread.join()
+
+    def test_one_profile_at_a_time(self):
+        admin = self.jwt_client(self.admin)
+        file = self.upload(os.urandom(1000), client=admin)
+        with self.profiler_busy():
+            response = admin.get(f"/files/{file.id}/", headers={"X-Profile": "1"})
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn("X-Profile-Id", response)
+            self.assertIsNone(profiling.current_profile())
+
+        response = admin.get(f"/files/{file.id}/render/?mode=raw", headers={"X-Profile": "1"})
+        with self.profiler_busy():
+            b"".join(response.streaming_content)
+        profile = admin.get(f"/profiles/{response['X-Profile-Id']}/").json()
+        self.assertFalse(profile["complete"])
+
+    def test_setup_failures_release_the_profiler(self):
+        profile = profiling.RequestProfile(RequestFactory().get("/"), self.admin)
+        with mock.patch.object(profile, "_profiler") as profiler:
+            profiler.enable.side_effect = ValueError("Another profiling tool is already active")
+            with self.assertRaises(ValueError):
+                with profile.active():
+                    pass
+        self.assertNotIn(profile._capture_query, connection.execute_wrappers)
+        self.assertIsNone(profiling.current_profile())
+        with profiling.RequestProfile(RequestFactory().get("/"), self.admin).active() as profiled:
+            self.assertTrue(profiled)
+
+    def test_per_process_caches_are_not_used(self):
+        admin = self.jwt_client(self.admin)
+        with override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}):
+            response = admin.get("/files/", headers={"X-Profile": "1"})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("X-Profile-Id", response)
+
+
+class SegmentedLRUCacheTests(SimpleTestCase):
+    def test_size_is_bounded(self):
+        cache = SegmentedLRUCache(max_bytes=100, max_item_bytes=60)
+        cache.set("big", b"x" * 61)
+        self.assertIsNone(cache.get("big"))
+        for key in "abcd":
+            cache.set(key, b"x" * 30)
+        self.assertLessEqual(cache.size_bytes, 100)
+        self.assertEqual(cache.evictions, 1)
+        self.assertIsNone(cache.get("a"))
+        cache.set("b", b"y" * 10)
+        self.assertEqual(cache.get("b"), b"y" * 10)
+        self.assertEqual(cache.size_bytes, 70)
+
+    def test_hot_entries_survive_a_scan(self):
+        cache = SegmentedLRUCache(max_bytes=100, max_item_bytes=20)
+        cache.set("hot", b"h" * 20)
+        self.assertEqual(cache.get("hot"), b"h" * 20)
+        for index in range(20):
+            cache.set(f"cold-{index}", b"c" * 20)
+        self.assertEqual(cache.get("hot"), b"h" * 20)
+        self.assertEqual(cache.hits, 2)
+        self.assertEqual(cache.misses, 0)
+        cache.clear()
+        self.assertEqual((len(cache), cache.size_bytes), (0, 0))
+
+
+@override_settings(PAYLOAD_CACHE={"ENABLED": True, "MAX_BYTES": 1024 ** 2, "MAX_ITEM_BYTES": 1024 ** 2})
+class PayloadCacheTests(FileAPITestCase):
+    def setUp(self):
+        super().setUp()
+        payload_cache.clear()
+        self.addCleanup(payload_cache.clear)
+
+    def test_hot_files_are_served_from_memory(self):
+        data = os.urandom(5000)
+        file = self.upload(data)
+        self.assertEqual(self.download(file), data)
+        with mock.patch("files.encrypt.aes_encryption.decrypt_stream") as decrypt_stream:
+            self.assertEqual(self.download(file), data)
+            response = self.render_raw(file, Range="bytes=10-19")
+            self.assertEqual((response.status_code, b"".join(response.streaming_content)), (206, data[10:20]))
+        decrypt_stream.assert_not_called()
+        self.assertEqual(len(payload_cache), 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.client.delete(f"/files/{file.id}/").status_code, 200)
+        self.assertEqual(len(payload_cache), 0)
+
+
+class SingleFlightTests(SimpleTestCase):
+    def test_concurrent_calls_share_one_run(self):
+        flight, started, release = SingleFlight(), threading.Event(), threading.Event()
+        calls, results = [], []
+
+        def load():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return "value"
+
+        leader = threading.Thread(target=lambda: results.append(flight.do("key", load)))
+        leader.start()
+        started.wait(5)
+        waiters = [threading.Thread(target=lambda: results.append(flight.do("key", load))) for _ in range(4)]
+        for waiter in waiters:
+            waiter.start()
+        release.set()
+        for thread in [leader, *waiters]:
+            thread.join(5)
+
+        self.assertEqual(calls, [1])
+        self.assertEqual(results, ["value"] * 5)
+        self.assertEqual(flight.in_flight(), 0)
+        self.assertEqual(flight.do("key", lambda: "again"), "again")
+
+    def test_waiters_share_the_error_or_time_out(self):
+        flight, started, release = SingleFlight(), threading.Event(), threading.Event()
+        errors = []
+
+        def fail():
+            started.set()
+            release.wait(5)
+            raise KeyError("missing")
+
+        def call(timeout=None):
+            try:
+                flight.do("key", fail, timeout)
+            except Exception as e:
+                errors.append(type(e))
+
+        leader = threading.Thread(target=call)
+        leader.start()
+        started.wait(5)
+        call(timeout=0.01)
+        waiter = threading.Thread(target=call)
+        waiter.start()
+        release.set()
+        leader.join(5)
+        waiter.join(5)
+        self.assertEqual(sorted(errors, key=lambda error: error.__name__), [KeyError, KeyError, TimeoutError])
+
+
+class BlobReferenceTests(FileAPITestCase):
+    def test_identical_uploads_share_a_blob(self):
+        data = os.urandom(5000)
+        first, second = self.upload(data), self.upload(data, name="copy.pdf")
+        self.assertEqual(first.blob_id, second.blob_id)
+        blob = Blob.objects.get(id=first.blob_id)
+        self.assertEqual(blob.ref_count, 2)
+        self.assertEqual(blob.sha256, hashlib.sha256(data).hexdigest())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        blob.refresh_from_db()
+        self.assertEqual(blob.ref_count, 1)
+        self.assertTrue(default_storage.exists(blob.encrypted_file.name))
+        self.assertEqual(b"".join(self.render_raw(second).streaming_content), data)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(Blob.objects.filter(id=blob.id).exists())
+        self.assertFalse(default_storage.exists(blob.encrypted_file.name))
+
+    def test_release_blob_waits_for_commit(self):
+        file = self.upload(os.urandom(100))
+        name = file.blob.encrypted_file.name
+        with self.captureOnCommitCallbacks() as callbacks:
+            file.delete()
+        self.assertTrue(default_storage.exists(name))
+        for callback in callbacks:
+            callback()
+        self.assertFalse(default_storage.exists(name))
+
+
+class BlobLayoutMigrationTests(FileAPITestCase):
+    def legacy_file(self, data):
+        """A Ready file stored before blobs existed, without a recorded hash."""
+        name = default_storage.save("encrypted_files/legacy.bin", ContentFile(legacy_cbc_blob(data)))
+        return File.objects.create(
+            name="legacy.bin", encrypted_file=name, owner=self.alice, size=len(data), iv=os.urandom(12),
+            server_key=encrypt_with_public_key(os.urandom(32)), server_key_id=key_ring.active_key_id,
+        )
+
+    def migrate(self):
+        output = io.StringIO()
+        call_command("migrate_blob_layout", batch_size=2, workers=2, delete_delay=0, stdout=output, stderr=io.StringIO())
+        return output.getvalue()
+
+    def test_content_is_moved_into_the_sharded_layout(self):
+        data = os.urandom(1000)
+        uploaded = self.upload(data)
+        self.assertRegex(uploaded.encrypted_file.name, r"^blobs/[0-9a-f]{2}/[0-9a-f]{2}/")
+
+        # A blob in the flat layout
+        flat = self.upload(os.urandom(500))
+        flat_name = default_storage.save("blobs/flat.bin", default_storage.open(flat.encrypted_file.name))
+        default_storage.delete(flat.encrypted_file.name)
+        Blob.objects.filter(id=flat.blob_id).update(encrypted_file=flat_name)
+        File.objects.filter(id=flat.id).update(encrypted_file=flat_name)
+
+        # Two legacy files with the same content end up sharing one blob
+        legacy = [self.legacy_file(data), self.legacy_file(data)]
+        legacy_names = [file.encrypted_file.name for file in legacy]
+
+        self.assertIn("Blob layout migration finished: 3 moved, 0 skipped, 0 failed", self.migrate())
+        self.assertFalse(Blob.objects.exclude(encrypted_file__regex=r"^blobs/[0-9a-f]{2}/[0-9a-f]{2}/").exists())
+        self.assertFalse(any(default_storage.exists(name) for name in [flat_name, *legacy_names]))
+        for file in legacy:
+            file.refresh_from_db()
+            self.assertEqual(file.blob_id, uploaded.blob_id)
+            self.assertEqual(b"".join(self.render_raw(file).streaming_content), data)
+        self.assertEqual(Blob.objects.get(id=uploaded.blob_id).ref_count, 3)
+        flat.refresh_from_db()
+        self.assertEqual(flat.encrypted_file.name, Blob.objects.get(id=flat.blob_id).encrypted_file.name)
+        self.assertEqual(self.render_raw(flat).status_code, 200)
+
+        self.assertIn("0 moved, 0 skipped, 0 failed", self.migrate())
+
+    def test_superseded_copies_outlive_open_downloads(self):
+        data = os.urandom(1000)
+        file = self.legacy_file(data)
+        old_name = file.encrypted_file.name
+        clock, waits = [1000.0], []
+
+        def sleep(seconds):
+            # Waiting out the delay: the row has moved, the old copy is still readable
+            file.refresh_from_db()
+            waits.append((seconds, file.encrypted_file.name != old_name, default_storage.exists(old_name)))
+            clock[0] += seconds
+
+        with mock.patch("files.management.commands.migrate_blob_layout.time") as fake_time:
+            fake_time.monotonic.side_effect = lambda: clock[0]
+            fake_time.sleep.side_effect = sleep
+            call_command("migrate_blob_layout", delete_delay=30, stdout=io.StringIO())
+        self.assertEqual(waits, [(30, True, True)])
+        self.assertFalse(default_storage.exists(old_name))
+        self.assertEqual(b"".join(self.render_raw(file).streaming_content), data)
+
+
+class StubS3Handler(BaseHTTPRequestHandler):
+    """
+    Path-style S3 endpoint holding objects in memory on its server. Checks
+    the SigV4 signature and payload hash of every request; supports the
+    calls S3Client makes, including multipart uploads and ranged GETs.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle_request(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        url = urlsplit(self.path)
+        params = dict(parse_qsl(url.query, keep_blank_values=True))
+        if not self.signature_valid(url.path, params, body):
+            return self.reply(403, b"<Error><Code>SignatureDoesNotMatch</Code></Error>")
+
+        server, key = self.server, unquote(url.path).split("/", 2)[2]
+        server.requests.append((self.command, key, params.get("partNumber")))
+        with server.lock:
+            if self.command == "POST" and "uploads" in params:
+                upload_id = uuid.uuid4().hex
+                server.uploads[upload_id] = {}
+                return self.reply(200, f"<Result><UploadId>{upload_id}</UploadId></Result>".encode())
+            if self.command == "PUT" and "uploadId" in params:
+                server.uploads[params["uploadId"]][int(params["partNumber"])] = body
+                return self.reply(200, headers={"ETag": f'"{hashlib.md5(body).hexdigest()}"'})
+            if self.command == "POST":
+                parts = server.uploads.pop(params["uploadId"])
+                numbers = [int(number) for number in re.findall(rb"<PartNumber>(\d+)</PartNumber>", body)]
+                server.objects[key] = b"".join(parts[number] for number in numbers)
+                return self.reply(200, b"<CompleteMultipartUploadResult/>")
+            if self.command == "PUT":
+                server.objects[key] = body
+                return self.reply(200)
+            if self.command == "DELETE":
+                if "uploadId" in params:
+                    server.uploads.pop(params["uploadId"], None)
+                else:
+                    server.objects.pop(key, None)
+                return self.reply(204)
+
+            data = server.objects.get(key)
+            if data is None:
+                return self.reply(404, b"<Error><Code>NoSuchKey</Code></Error>")
+            if self.command == "HEAD":
+                return self.reply(200, headers={"Content-Length": str(len(data))})
+            byte_range = self.headers.get("Range")
+            if byte_range is None or server.ignore_range:
+                return self.reply(200, data)
+            start, end = map(int, byte_range[len("bytes="):].split("-"))
+            chunk = data[start:end + 1]
+            return self.reply(206, chunk, {"Content-Range": f"bytes {start}-{start + len(chunk) - 1}/{len(data)}"})
+
+    do_GET = do_HEAD = do_PUT = do_POST = do_DELETE = handle_request
+
+    def signature_valid(self, path, params, body):
+        authorization = self.headers.get("Authorization", "")
+        match = re.match(
+            r"AWS4-HMAC-SHA256 Credential=([^/]+)/\d{8}/([^/]+)/s3/aws4_request, SignedHeaders=([^,]+), Signature=\w+$",
+            authorization,
+        )
+        if match is None or self.headers["x-amz-content-sha256"] != hashlib.sha256(body).hexdigest():
+            return False
+        access_key, region, signed = match.groups()
+        secret_key = self.server.credentials.get(access_key)
+        if secret_key is None:
+            return False
+        headers = {name: self.headers[name] for name in signed.split(";")}
+        expected = authorization_header(
+            self.command, path, params, headers, self.headers["x-amz-content-sha256"], access_key, secret_key, region
+        )
+        return hmac.compare_digest(expected, authorization)
+
+    def reply(self, status, body=b"", headers=None):
+        headers = {"Content-Length": str(len(body)), **(headers or {})}
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+
+def start_stub_s3():
+    """Serve StubS3Handler on a free local port; returns the server."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubS3Handler)
+    server.credentials = {"test-access-key": "test-secret-key"}
+    server.objects, server.uploads, server.requests = {}, {}, []
+    server.ignore_range = False  # Answer ranged GETs with the whole object, as some proxies do
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class S3TestMixin:
+    @classmethod
+    def setUpClass(cls):
+        cls.s3 = start_stub_s3()
+        cls.addClassCleanup(cls.s3.server_close)
+        cls.addClassCleanup(cls.s3.shutdown)
+        cls.s3_settings = {
+            "S3_ENDPOINT_URL": f"http://127.0.0.1:{cls.s3.server_address[1]}",
+            "S3_BUCKET": "sfs-test",
+            "S3_ACCESS_KEY_ID": "test-access-key",
+            "S3_SECRET_ACCESS_KEY": "test-secret-key",
+            "S3_REGION": "eu-test-1",
+            "S3_PART_SIZE": 1024,
+            "S3_READ_BUFFER": 256,
+        }
+        super().setUpClass()
+
+    def setUp(self):
+        super().setUp()
+        self.s3.objects.clear()
+        self.s3.uploads.clear()
+        self.s3.requests.clear()
+        self.s3.ignore_range = False
+
+
+class S3StorageTests(S3TestMixin, SimpleTestCase):
+    def storage(self, **overrides):
+        with override_settings(**{**self.s3_settings, **overrides}):
+            return S3Storage()
+
+    def requests(self, method):
+        return [request for request in self.s3.requests if request[0] == method]
+
+    def test_small_object(self):
+        storage = self.storage()
+        name = storage.save("blobs/small", ContentFile(b"hello"))
+        self.assertEqual(self.s3.objects[name], b"hello")
+        self.assertEqual(self.requests("POST"), [])
+        self.assertTrue(storage.exists(name))
+        self.assertEqual(storage.size(name), 5)
+        with storage.open(name) as stored:
+            self.assertEqual(stored.read(), b"hello")
+        storage.delete(name)
+        self.assertFalse(storage.exists(name))
+
+    def test_multipart_upload_and_ranged_reads(self):
+        storage, data = self.storage(), os.urandom(5000)
+        name = storage.save("blobs/large", ContentFile(data))
+        self.assertEqual(self.s3.objects[name], data)
+        self.assertEqual([part for _, _, part in self.requests("PUT")], ["1", "2", "3", "4", "5"])
+        self.assertEqual(self.s3.uploads, {})
+
+        self.s3.requests.clear()
+        with storage.open(name) as stored:
+            stored.seek(4000)
+            self.assertEqual(stored.read(100), data[4000:4100])
+            stored.seek(-10, os.SEEK_END)
+            self.assertEqual(stored.read(), data[-10:])
+        self.assertEqual(len(self.requests("GET")), 2)
+
+    def test_ignored_range_is_refused(self):
+        storage, data = self.storage(), os.urandom(1000)
+        name = storage.save("blobs/ranged", ContentFile(data))
+        self.s3.ignore_range = True
+        with storage.open(name) as stored:
+            stored.seek(500)
+            with self.assertRaises(S3Error) as raised:
+                stored.read(100)
+        self.assertEqual(raised.exception.status, 200)
+
+    def test_failed_multipart_upload_is_aborted(self):
+        storage = self.storage()
+        with mock.patch.object(storage.client, "complete_multipart_upload", side_effect=S3Error("POST", "key", 500, b"")):
+            with self.assertRaises(S3Error):
+                storage.save("blobs/failed", ContentFile(os.urandom(3000)))
+        self.assertEqual(self.s3.uploads, {})
+        self.assertNotIn("blobs/failed", self.s3.objects)
+
+    def test_errors(self):
+        storage = self.storage()
+        with self.assertRaises(FileNotFoundError):
+            storage.size("missing")
+        with self.assertRaises(FileNotFoundError):
+            storage.client.get_range("missing", 0, 10)
+        with self.assertRaises(S3Error) as raised:
+            self.storage(S3_SECRET_ACCESS_KEY="wrong").save("blobs/denied", ContentFile(b"data"))
+        self.assertEqual(raised.exception.status, 403)
+
+
+class S3BackedUploadTests(S3TestMixin, FileAPITestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        settings_override = override_settings(
+            STORAGES={**settings.STORAGES, "default": {"BACKEND": "files.storage.MeteredS3Storage"}},
+            **cls.s3_settings,
+        )
+        settings_override.enable()
+        cls.addClassCleanup(settings_override.disable)
+
+    def test_blobs_live_in_the_bucket(self):
+        data = os.urandom(5000)
+        file = self.upload(data)
+        self.assertEqual(file.status, "Ready")
+        name = file.encrypted_file.name
+        self.assertEqual(sorted(self.s3.objects), [name])  # The staged copy is gone
+
+        response = self.render_raw(file, Range="bytes=3000-3099")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b"".join(response.streaming_content), data[3000:3100])
+        self.assertEqual(b"".join(self.render_raw(file).streaming_content), data)
+
+        duplicate = self.upload(data, name="copy.pdf")
+        self.assertEqual(duplicate.encrypted_file.name, name)
+        with self.captureOnCommitCallbacks(execute=True):
+            file.delete()
+        self.assertIn(name, self.s3.objects)
+        with self.captureOnCommitCallbacks(execute=True):
+            duplicate.delete()
+        self.assertEqual(self.s3.objects, {})
+
+
+class KeyProvisioningTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.rsa_key = RSA.generate(2048)
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def key_settings(self, mode=GENERATE, fingerprint="", **overrides):
+        return override_settings(**{
+            "KEY_PROVISIONING": mode,
+            "KEY_FINGERPRINT": fingerprint,
+            "AES_KEYS": {"v1": {"path": self.path("aes_v1.key")}},
+            "AES_ACTIVE_KEY_ID": "v1",
+            "RSA_KEYS": {"v1": {"private": self.path("private.pem"), "public": self.path("public.pem")}},
+            "RSA_ACTIVE_KEY_ID": "v1",
+            **overrides,
+        })
+
+    def test_generate_creates_missing_keys_once(self):
+        with self.key_settings():
+            generated = check_keys()
+            self.assertEqual(check_keys(), generated)
+        for name in ("aes_v1.key", "private.pem", "public.pem"):
+            self.assertEqual(os.stat(self.path(name)).st_mode & 0o777, 0o600, name)
+        self.assertEqual(sorted(os.listdir(self.directory)), ["aes_v1.key", "private.pem", "public.pem"])
+
+    def test_strict_requires_provisioned_keys(self):
+        with self.key_settings(STRICT, fingerprint="0" * 16):
+            with self.assertRaisesMessage(ImproperlyConfigured, "RSA key pair 'v1' not found"):
+                check_keys()
+        self.assertEqual(os.listdir(self.directory), [])
+
+        with self.key_settings(STRICT, fingerprint="0" * 16, RSA_KEYS={"v1": {"pem": self.rsa_key.export_key()}}):
+            with self.assertRaisesMessage(ImproperlyConfigured, "Server AES key 'v1' not found"):
+                check_keys()
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_strict_checks_the_fingerprint(self):
+        aes_key = os.urandom(32)
+        expected = fingerprint({"v1": aes_key}, {"v1": self.rsa_key.publickey()})
+        provisioned = {
+            "AES_KEYS": {"v1": {"key": base64.b64encode(aes_key).decode()}},
+            "RSA_KEYS": {"v1": {"pem": self.rsa_key.export_key()}},
+        }
+        with self.key_settings(STRICT, **provisioned):
+            with self.assertRaisesMessage(ImproperlyConfigured, f"fingerprint {expected}"):
+                check_keys()
+        with self.key_settings(STRICT, fingerprint=expected, **provisioned):
+            self.assertEqual(check_keys(), expected)
+
+        other_key = {"AES_KEYS": {"v1": {"key": base64.b64encode(os.urandom(32)).decode()}}}
+        with self.key_settings(STRICT, fingerprint=expected, **{**provisioned, **other_key}):
+            with self.assertRaisesMessage(ImproperlyConfigured, "do not match KEY_FINGERPRINT"):
+                check_keys()
+
+    def test_active_key_must_be_configured(self):
+        with self.key_settings(AES_ACTIVE_KEY_ID="v2"):
+            with self.assertRaisesMessage(ImproperlyConfigured, "AES_ACTIVE_KEY_ID 'v2'"):
+                check_keys()
+        with self.key_settings(RSA_ACTIVE_KEY_ID="v2"):
+            with self.assertRaisesMessage(ImproperlyConfigured, "RSA_ACTIVE_KEY_ID 'v2'"):
+                check_keys()
+            with self.assertRaisesMessage(ImproperlyConfigured, "RSA_ACTIVE_KEY_ID 'v2'"):
+                RSAKeyRing().active_key_id
+
+    def test_rotated_rsa_keys_still_unwrap(self):
+        ring = RSAKeyRing()
+        rsa_keys = {
+            "v1": {"pem": self.rsa_key.export_key()},
+            "v2": {"private": self.path("v2_private.pem"), "public": self.path("v2_public.pem")},
+        }
+        with self.key_settings(RSA_KEYS=rsa_keys):
+            ensure_rsa_keys()
+            wrapped = ring.encrypt(b"client key")
+        with self.key_settings(RSA_KEYS=rsa_keys, RSA_ACTIVE_KEY_ID="v2"):
+            self.assertEqual(ring.decrypt(wrapped, "v1"), b"client key")
+            self.assertEqual(ring.decrypt(ring.encrypt(b"client key"), "v2"), b"client key")
+        with self.key_settings(RSA_KEYS={"v2": rsa_keys["v2"]}, RSA_ACTIVE_KEY_ID="v2"):
+            with self.assertRaises(KeyError):
+                ring.decrypt(wrapped, "v1")
+
+    def test_racing_processes_create_one_key(self):
+        path, candidates = self.path("aes_v1.key"), [os.urandom(32) for _ in range(8)]
+        with ProcessPoolExecutor(max_workers=8, mp_context=multiprocessing.get_context("spawn")) as pool:
+            list(pool.map(create_exclusive, [path] * len(candidates), candidates))
+        with open(path, "rb") as key_file:
+            self.assertIn(key_file.read(), candidates)
+        self.assertEqual(os.listdir(self.directory), ["aes_v1.key"])
+
+    def test_node_with_other_keys_refuses_to_start(self):
+        aes_key = os.urandom(32)
+        node_environment = {
+            **os.environ,
+            "KEY_PROVISIONING": STRICT,
+            "SERVER_AES_KEY": base64.b64encode(aes_key).decode(),
+            "SERVER_RSA_PRIVATE_KEY": self.rsa_key.export_key().decode(),
+            "KEY_FINGERPRINT": fingerprint({"v1": aes_key}, {"v1": self.rsa_key.publickey()}),
+        }
+
+        def start_node(**environment):
+            return subprocess.run(
+                [sys.executable, "manage.py", "check"], cwd=settings.BASE_DIR,
+                env={**node_environment, **environment}, capture_output=True, text=True,
+            )
+
+        node = start_node()
+        self.assertEqual(node.returncode, 0, node.stderr)
+        node = start_node(SERVER_AES_KEY=base64.b64encode(os.urandom(32)).decode())
+        self.assertNotEqual(node.returncode, 0)
+        self.assertIn("do not match KEY_FINGERPRINT", node.stderr)
+
+
+class KeyRotationTests(FileAPITestCase):
+    def test_blobs_are_moved_to_the_active_key(self):
+        contents = [os.urandom(3000), os.urandom(100), b""]
+        files = [self.upload(data) for data in contents]
+        old_names = [file.encrypted_file.name for file in files]
+
+        keys = {**aes_encryption.keys, "v2": os.urandom(32)}
+        with mock.patch.object(aes_encryption, "keys", keys), mock.patch.object(aes_encryption, "active_key_id", "v2"), \
+                mock.patch(
+                    "files.management.commands.rotate_blob_key.ProcessPoolExecutor",
+                    lambda max_workers, **kwargs: ThreadPoolExecutor(max_workers),
+                ):
+            output = io.StringIO()
+            call_command("rotate_blob_key", processes=2, batch_size=2, delete_delay=0, stdout=output)
+            self.assertIn("Key rotation finished: 3 rotated, 0 skipped, 0 failed", output.getvalue())
+            self.assertIn("older keys can be retired", output.getvalue())
+
+            for file, data, old_name in zip(files, contents, old_names):
+                file.refresh_from_db()
+                self.assertEqual(file.blob.aes_key_id, "v2")
+                self.assertNotEqual(file.encrypted_file.name, old_name)
+                self.assertFalse(default_storage.exists(old_name))
+                with default_storage.open(file.encrypted_file.name) as stored:
+                    self.assertEqual(unpack_segment_header(stored.read(SEGMENT_HEADER.size + 16))[4], "v2")
+                self.assertEqual(b"".join(self.render_raw(file).streaming_content), data)
+
+            output = io.StringIO()
+            call_command("rotate_blob_key", stdout=output)
+            self.assertIn("0 blobs", output.getvalue())
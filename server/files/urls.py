@@ -1,16 +1,28 @@
 from django.urls import path
-from . import views
+from . import views, async_views
 
 urlpatterns = [
     # File Management
     path('upload/', views.FileUploadView.as_view(), name='file-upload'),  # File Upload
+    path('uploads/', views.UploadSessionView.as_view(), name='upload-session'),  # Start Resumable Upload
+    path('uploads/<uuid:session_id>/', views.UploadSessionDetailView.as_view(), name='upload-session-detail'),
+    path('uploads/<uuid:session_id>/chunks/<int:index>/', views.UploadChunkView.as_view(), name='upload-chunk'),
+    path('uploads/<uuid:session_id>/finalize/', views.UploadSessionFinalizeView.as_view(), name='upload-session-finalize'),
     path('', views.ListUserFilesView.as_view(), name='list-user-files'),  # List User Files
     path('<int:file_id>/download/', views.FileDownloadView.as_view(), name='file-download'),  # File Download
     path('<int:file_id>/render/', views.FileRenderView.as_view(), name='file-render'),
+    path('archive/', views.FileArchiveView.as_view(), name='file-archive'),  # Multi-file ZIP Download
+    path('<int:file_id>/status/', views.FileStatusView.as_view(), name='file-status'),  # Upload Processing Status
     path('<int:file_id>/', views.FileView.as_view(), name='file'),  
 
+    # Async transfer endpoints (served under ASGI)
+    path('async/upload/', async_views.AsyncFileUploadView.as_view(), name='async-file-upload'),
+    path('async/<int:file_id>/download/', async_views.AsyncFileDownloadView.as_view(), name='async-file-download'),
+    path('async/<int:file_id>/render/', async_views.AsyncFileRenderView.as_view(), name='async-file-render'),
+
     # File Access Control
     path('<int:file_id>/access/', views.FileAccessView.as_view(), name='file-access'),  # Grant/Revoke Access
+    path('access/bulk/', views.BulkFileAccessView.as_view(), name='bulk-file-access'),  # Bulk Grant/Revoke Access
 
     # Secure File Sharing
     path('<int:file_id>/shareable-link/', views.GenerateShareableLinkView.as_view(), name='generate-shareable-link'),  # Generate Shareable Link
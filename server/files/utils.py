@@ -1,8 +1,11 @@
 from Crypto.PublicKey import RSA
 import os
+import threading
+import time
 from Crypto.Cipher import PKCS1_OAEP
 from Crypto.PublicKey import RSA
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from cryptography.hazmat.backends import default_backend
@@ -10,44 +13,190 @@ from cryptography.hazmat.backends import default_backend
 # from cryptography.hazmat.primitives.asymmetric import rsa, padding
 # from cryptography.hazmat.primitives import hashes
 from django.conf import settings
+from core.metrics import CallbackMetric, RSA_SECONDS
+from core.profiling import current_profile, record_stage
+from .cache import SegmentedLRUCache, TTLCache
+from .keys import generate_rsa_keys, load_rsa_pair  # noqa: F401  generate_rsa_keys is re-exported
+from .singleflight import SingleFlight
 
-def get_private_key():
+class RSAKeyRing:
     """
-    Load the private key from the specified path.
+    Server RSA key pairs loaded once per process, together with their
+    PKCS1_OAEP ciphers. Each pair has a key ID (stored on File.server_key_id)
+    so older pairs can still unwrap existing keys after a new one becomes
+    active. PEM files are re-read when their modification time changes,
+    checked at most every RSA_KEY_RELOAD_INTERVAL seconds.
     """
-    with open(settings.PRIVATE_KEY_PATH, "rb") as priv_file:
-        return RSA.import_key(priv_file.read())
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = {}  # key_id -> (mtimes, private_key, public_key, private_cipher, public_cipher)
+        self._checked_at = 0.0
 
-def get_public_key():
+    @property
+    def active_key_id(self):
+        key_id = settings.RSA_ACTIVE_KEY_ID
+        if key_id not in settings.RSA_KEYS:
+            raise ImproperlyConfigured(f"RSA_ACTIVE_KEY_ID {key_id!r} is not one of RSA_KEYS")
+        return key_id
+
+    def _mtimes(self, source):
+        if "pem" in source:
+            return ()  # Given in the environment; fixed for the life of the process
+        return tuple(os.stat(path).st_mtime_ns for path in (source["private"], source["public"]))
+
+    def _load(self, key_id):
+        source = settings.RSA_KEYS[key_id]
+        mtimes = self._mtimes(source)
+        private_key, public_key = load_rsa_pair(source)
+        return mtimes, private_key, public_key, PKCS1_OAEP.new(private_key), PKCS1_OAEP.new(public_key)
+
+    def _get(self, key_id):
+        key_id = key_id or self.active_key_id
+        if key_id not in settings.RSA_KEYS:
+            raise KeyError(f"Unknown RSA key ID: {key_id}")
+
+        entry = self._keys.get(key_id)
+        stale = time.monotonic() - self._checked_at >= settings.RSA_KEY_RELOAD_INTERVAL
+        if entry is not None and not stale:
+            return entry
+
+        with self._lock:
+            if stale:
+                self._checked_at = time.monotonic()
+                # Drop pairs whose PEM files changed on disk
+                for cached_id, cached in list(self._keys.items()):
+                    if cached_id not in settings.RSA_KEYS or cached[0] != self._mtimes(settings.RSA_KEYS[cached_id]):
+                        del self._keys[cached_id]
+            entry = self._keys.get(key_id)
+            if entry is None:
+                entry = self._keys[key_id] = self._load(key_id)
+            return entry
+
+    def private_key(self, key_id=None):
+        return self._get(key_id)[1]
+
+    def public_key(self, key_id=None):
+        return self._get(key_id)[2]
+
+    def encrypt(self, data, key_id=None):
+        return self._timed("encrypt", self._get(key_id)[4].encrypt, data)
+
+    def decrypt(self, data, key_id=None):
+        return self._timed("decrypt", self._get(key_id)[3].decrypt, data)
+
+    def _timed(self, operation, fn, data):
+        started = time.perf_counter()
+        result = fn(data)
+        elapsed = time.perf_counter() - started
+        RSA_SECONDS.observe(elapsed, operation=operation)
+        record_stage(current_profile(), f"rsa.{operation}", elapsed, len(data))
+        return result
+
+
+key_ring = RSAKeyRing()
+
+
+def get_private_key(key_id=None):
+    """
+    Return the private key for key_id (the active key by default).
+    """
+    return key_ring.private_key(key_id)
+
+def get_public_key(key_id=None):
     """
-    Load the public key from the specified path.
+    Return the public key for key_id (the active key by default).
     """
-    with open(settings.PUBLIC_KEY_PATH, "rb") as pub_file:
-        return RSA.import_key(pub_file.read())
+    return key_ring.public_key(key_id)
 
-def encrypt_with_public_key(data):
+def encrypt_with_public_key(data, key_id=None):
     """
     Encrypt data using the public key.
     """
-    public_key = get_public_key()
-    cipher = PKCS1_OAEP.new(public_key)
-    return cipher.encrypt(data)
+    return key_ring.encrypt(data, key_id)
 
-def decrypt_with_private_key(data):
+def decrypt_with_private_key(data, key_id=None):
     """
     Decrypt data using the private key.
     """
-    private_key = get_private_key()
-    cipher = PKCS1_OAEP.new(private_key)
-    return cipher.decrypt(data)
+    return key_ring.decrypt(bytes(data), key_id)
 
-def generate_rsa_keys(private_key_path, public_key_path):
+# Concurrent identical key unwraps and payload loads run once (SingleFlight)
+in_flight = SingleFlight()
+
+def coalesce(key, fn):
+    """fn() shared with concurrent callers using the same key."""
+    return in_flight.do(key, fn, timeout=settings.SINGLE_FLIGHT_TIMEOUT)
+
+client_key_cache = TTLCache(
+    ttl=settings.CLIENT_KEY_CACHE["TTL"],
+    max_entries=settings.CLIENT_KEY_CACHE["MAX_ENTRIES"],
+)
+
+def unwrap_client_key(file):
     """
-    Generate RSA public and private keys if they do not exist.
+    Decrypt a file's client key, reusing a recently unwrapped copy when
+    CLIENT_KEY_CACHE is enabled. Entries remember the wrapped key they came
+    from, so a reused file ID can never be served a stale key. Concurrent
+    unwraps of the same key share one RSA operation.
+    """
+    server_key = bytes(file.server_key)
+
+    def unwrap():
+        return decrypt_with_private_key(server_key, file.server_key_id)
+
+    if not settings.CLIENT_KEY_CACHE["ENABLED"]:
+        return coalesce(("client-key", file.id, server_key), unwrap)
+
+    cached = client_key_cache.get(file.id)
+    if cached is not None and cached[0] == server_key:
+        return cached[1]
+
+    client_key = coalesce(("client-key", file.id, server_key), unwrap)
+    client_key_cache.set(file.id, (server_key, client_key))
+    return client_key
+
+def invalidate_client_key(file_id):
     """
-    if not os.path.exists(private_key_path) or not os.path.exists(public_key_path):
-        key = RSA.generate(2048)
-        with open(private_key_path, "wb") as priv_file:
-            priv_file.write(key.export_key())
-        with open(public_key_path, "wb") as pub_file:
-            pub_file.write(key.publickey().export_key())
+    Forget the cached client key of a file, e.g. when it is deleted or
+    access to it is revoked.
+    """
+    client_key_cache.delete(file_id)
+
+# Optional cache of server-decrypted (still client-encrypted) payloads of
+# hot files, bounded by PAYLOAD_CACHE["MAX_BYTES"]
+payload_cache = SegmentedLRUCache(
+    max_bytes=settings.PAYLOAD_CACHE["MAX_BYTES"],
+    max_item_bytes=settings.PAYLOAD_CACHE["MAX_ITEM_BYTES"],
+)
+
+for name, documentation, kind, callback in (
+    ("sfs_payload_cache_hits_total", "Payload cache hits.", "counter", lambda: payload_cache.hits),
+    ("sfs_payload_cache_misses_total", "Payload cache misses.", "counter", lambda: payload_cache.misses),
+    ("sfs_payload_cache_evictions_total", "Payload cache evictions.", "counter", lambda: payload_cache.evictions),
+    ("sfs_payload_cache_bytes", "Bytes held in the payload cache.", "gauge", lambda: payload_cache.size_bytes),
+    ("sfs_payload_cache_entries", "Files held in the payload cache.", "gauge", lambda: len(payload_cache)),
+    ("sfs_in_flight_loads", "Key unwraps and payload loads currently being shared.", "gauge", in_flight.in_flight),
+):
+    CallbackMetric(name, documentation, kind, callback)
+
+def payload_cacheable(file):
+    return settings.PAYLOAD_CACHE["ENABLED"] and file.size <= payload_cache.max_item_bytes
+
+def cached_payload(file, read):
+    """
+    The client-encrypted bytes of a file, from the payload cache when
+    PAYLOAD_CACHE is enabled and the file fits; read(file) produces them
+    otherwise, once for all concurrent callers.
+    """
+    # The content hash in the key keeps a reused file ID from hitting old data
+    key = (file.id, file.sha256)
+    if not payload_cacheable(file):
+        return coalesce(("payload",) + key, lambda: read(file))
+    payload = payload_cache.get(key)
+    if payload is None:
+        payload = coalesce(("payload",) + key, lambda: read(file))
+        payload_cache.set(key, payload)
+    return payload
+
+def invalidate_payload(file):
+    payload_cache.delete((file.id, file.sha256))
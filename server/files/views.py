@@ -3,21 +3,202 @@ from django.conf import settings
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
-from rest_framework import status
-from django.http import JsonResponse, FileResponse
-from .models import File, FileAccess, ShareableLink
+from rest_framework import serializers, status
+from django.http import JsonResponse, FileResponse, StreamingHttpResponse
+from .models import File, FileAccess, ShareableLink, UploadSession, UploadChunk
 from Crypto.Cipher import AES
 from Crypto.Random import get_random_bytes
-from datetime import timedelta
+from datetime import datetime, timedelta
+from django.utils.dateparse import parse_datetime
 from django.utils.timezone import now
-from .utils import encrypt_with_public_key, decrypt_with_private_key
+from .utils import encrypt_with_public_key, key_ring, unwrap_client_key, invalidate_client_key, cached_payload, payload_cacheable
 import base64
 from users.models import Users
 import mimetypes
+from urllib.parse import quote
 from users.permissions import IsAdmin, IsRegularUser
+from .access import can_download, can_view, invalidate_file_access, resolve_access
+from .archive import stream_zip
 from .encrypt import aes_encryption
-import tempfile
-
+from .links import resolve_shared_link
+from .enums import FileStatusChoices
+from .tasks import process_upload, assemble_upload_session
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, transaction
+from django.db.models import OuterRef, Q, Subquery
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from collections import defaultdict
+import functools
+import hashlib
+import json
+import uuid
+
+
+def parse_range_header(range_header, size):
+    """
+    Parse a single "bytes=start-end" Range header against a payload size.
+    Returns (start, end) with end exclusive, None when the whole payload
+    should be sent, and raises ValueError when the range is unsatisfiable.
+    """
+    if not range_header or not range_header.startswith("bytes="):
+        return None
+    ranges = range_header[len("bytes="):].split(",")
+    if len(ranges) != 1:
+        return None  # Multiple ranges are not supported; send everything
+
+    first, separator, last = ranges[0].strip().partition("-")
+    if not separator or not (first or last) or not all(part.isdigit() for part in (first, last) if part):
+        return None  # Malformed ranges are ignored
+
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0 or size == 0:
+            raise ValueError("Unsatisfiable range")
+        return max(size - length, 0), size
+
+    start = int(first)
+    end = int(last) + 1 if last else size
+    if start >= size:
+        raise ValueError("Unsatisfiable range")
+    if end <= start:
+        return None
+    return start, min(end, size)
+
+
+def file_etag(file, representation):
+    """
+    Strong ETag of a stored file in one representation ("raw" or "json").
+    Blobs are immutable, so the SHA-256 recorded at upload identifies them;
+    files stored before hashes were recorded get no ETag.
+    """
+    if not file.sha256:
+        return None
+    return f'"{file.sha256}-{representation}"'
+
+
+def conditional_response(request, etag):
+    """304 Not Modified when If-None-Match matches etag, else None."""
+    if etag is None:
+        return None
+    response = get_conditional_response(request, etag=etag)
+    return set_cache_headers(response, etag) if response is not None else None
+
+
+def set_cache_headers(response, etag):
+    """Let the user's browser keep the payload, revalidating on every use."""
+    if etag is not None and response.status_code in (200, 206, 304):
+        response["ETag"] = etag
+    patch_cache_control(response, private=True, no_cache=True)
+    patch_vary_headers(response, ["Authorization"])
+    return response
+
+
+def read_client_encrypted(file):
+    """Decrypt the stored blob back to the client-encrypted bytes."""
+    with default_storage.open(file.encrypted_file.name, "rb") as encrypted_file:
+        return b"".join(aes_encryption.decrypt_stream(encrypted_file))
+
+
+def client_encrypted_payload(file):
+    """read_client_encrypted through the hot-file payload cache."""
+    return cached_payload(file, read_client_encrypted)
+
+
+def stream_file_response(request, file, decrypted_key):
+    """
+    Stream the client-encrypted bytes of a file as application/octet-stream.
+    The IV, client key, name and media type travel in response headers so the
+    payload is never buffered or base64-encoded. Range requests only decrypt
+    the segments they touch.
+    """
+    payload = client_encrypted_payload(file) if payload_cacheable(file) else None
+    if payload is not None:
+        size = len(payload)
+    else:
+        with default_storage.open(file.encrypted_file.name, "rb") as encrypted_file:
+            size = aes_encryption.decrypted_size(encrypted_file)
+
+    try:
+        byte_range = parse_range_header(request.headers.get("Range"), size)
+    except ValueError:
+        response = JsonResponse({"error": "Requested range not satisfiable"}, status=416)
+        response["Content-Range"] = f"bytes */{size}"
+        return response
+    start, end = byte_range or (0, size)
+
+    def client_encrypted_chunks():
+        if payload is not None:
+            chunk_size = aes_encryption.SEGMENT_SIZE
+            for offset in range(start, end, chunk_size):
+                yield payload[offset:min(offset + chunk_size, end)]
+            return
+        with default_storage.open(file.encrypted_file.name, "rb") as encrypted_file:
+            yield from aes_encryption.decrypt_stream(encrypted_file, start, end)
+
+    content_type, _ = mimetypes.guess_type(file.name)
+    if not content_type:
+        content_type = 'application/octet-stream'
+
+    response = StreamingHttpResponse(
+        client_encrypted_chunks(),
+        content_type='application/octet-stream',
+        status=206 if byte_range else 200,
+    )
+    response["Content-Length"] = end - start
+    response["Accept-Ranges"] = "bytes"
+    if byte_range:
+        response["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+    response["X-File-IV"] = base64.b64encode(file.iv).decode("utf-8")
+    response["X-Client-Key"] = base64.b64encode(decrypted_key).decode("utf-8")
+    response["X-File-Name"] = quote(file.name)
+    response["X-Media-Type"] = content_type
+    return response
+
+
+def stage_upload(file, encrypted_key):
+    """
+    Wrap the client key and stage the raw client-encrypted bytes in storage
+    (large uploads are moved there, not copied). Touches no database, so
+    async views can run it on the transfer executor.
+    Returns (server_key_id, server_encrypted_key, staged_name).
+    """
+    # Encrypt client key with server public key
+    server_key_id = key_ring.active_key_id
+    server_encrypted_key = encrypt_with_public_key(bytes.fromhex(encrypted_key), server_key_id)
+
+    staged_name = default_storage.save(f"upload_staging/{uuid.uuid4().hex}", file)
+    return server_key_id, server_encrypted_key, staged_name
+
+
+def record_upload(user, file, iv, staged):
+    """Create the Pending File for a staged upload and queue process_upload once it commits."""
+    server_key_id, server_encrypted_key, staged_name = staged
+    try:
+        uploaded_file = File.objects.create(
+            name=file.name,
+            encrypted_file=None,
+            server_key=server_encrypted_key,
+            server_key_id=server_key_id,
+            iv=bytes.fromhex(iv),
+            owner=user,
+            size=file.size,
+            status=FileStatusChoices.PENDING.value,
+        )
+    except BaseException:
+        default_storage.delete(staged_name)
+        raise
+    transaction.on_commit(lambda: process_upload.delay(uploaded_file.id, staged_name))
+    return uploaded_file
+
+
+def accept_upload(user, file, encrypted_key, iv):
+    """
+    Persist an upload and queue its server-side encryption; process_upload
+    finishes the work in a worker.
+    """
+    return record_upload(user, file, iv, stage_upload(file, encrypted_key))
 
 
 class FileUploadView(APIView):
@@ -32,41 +213,11 @@ class FileUploadView(APIView):
             if not file or not encrypted_key or not iv:
                 return JsonResponse({"error": "Missing required fields"}, status=400)
 
-            # Server-side AES encryption of the client-encrypted file
-            file_content = file.read()
-            server_encrypted_content = aes_encryption.encrypt_file(file_content)
-            
-            # Store encrypted content temporarily
-            with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-                temp_file.write(server_encrypted_content)
-                temp_path = temp_file.name
-
-            # Encrypt client key with server public key
-            server_encrypted_key = encrypt_with_public_key(bytes.fromhex(encrypted_key))
-
-            # Create file record
-            uploaded_file = File.objects.create(
-                name=file.name,
-                encrypted_file=None,
-                server_key=server_encrypted_key,
-                iv=bytes.fromhex(iv),
-                owner=request.user,
-                size=file.size,
-            )
-
-            # Save encrypted file
-            with open(temp_path, 'rb') as temp_file:
-                uploaded_file.encrypted_file.save(
-                    f"{uploaded_file.id}_{file.name}", 
-                    temp_file
-                )
-
-            # Cleanup
-            os.unlink(temp_path)
+            uploaded_file = accept_upload(request.user, file, encrypted_key, iv)
 
             return JsonResponse(
-                {"message": "File uploaded successfully", "file_id": uploaded_file.id},
-                status=201,
+                {"message": "File uploaded successfully", "file_id": uploaded_file.id, "status": uploaded_file.status},
+                status=202,
             )
         except KeyError:
             return JsonResponse({"error": "Invalid request format"}, status=400)
@@ -80,18 +231,28 @@ class FileDownloadView(APIView):
         try:
             file = File.objects.get(id=file_id)
 
-            if file.owner != request.user and not file.accesses.filter(user=request.user, can_download=True).exists():
+            if not can_download(request, file):
                 return JsonResponse({"error": "Access denied"}, status=403)
 
+            if file.status != FileStatusChoices.READY.value:
+                return JsonResponse({"error": "File is still being processed", "status": file.status}, status=409)
+
+            # Answer revalidations before any RSA or AES work
+            raw = request.query_params.get("mode") == "raw"
+            etag = file_etag(file, "raw" if raw else "json")
+            not_modified = conditional_response(request, etag)
+            if not_modified is not None:
+                return not_modified
+
             # Decrypt server key
-            decrypted_key = decrypt_with_private_key(file.server_key)
+            decrypted_key = unwrap_client_key(file)
 
-            # Read and decrypt with AES
-            with open(file.encrypted_file.path, "rb") as encrypted_file:
-                server_encrypted_data = encrypted_file.read()
-                
-            # Server-side AES decryption
-            client_encrypted_data = aes_encryption.decrypt_file(server_encrypted_data)
+            # ?mode=raw streams the bytes instead of base64 JSON
+            if raw:
+                return set_cache_headers(stream_file_response(request, file, decrypted_key), etag)
+
+            # Read and decrypt with AES, or reuse the cached payload of a hot file
+            client_encrypted_data = client_encrypted_payload(file)
 
             content_type, _ = mimetypes.guess_type(file.name)
             if not content_type:
@@ -104,7 +265,7 @@ class FileDownloadView(APIView):
                 "original_name": file.name,
                 "media_type": content_type,
             }
-            return JsonResponse(response_data, status=200)
+            return set_cache_headers(JsonResponse(response_data, status=200), etag)
         except File.DoesNotExist:
             return JsonResponse({"error": "File not found"}, status=404)
         except Exception as e:
@@ -117,18 +278,28 @@ class FileRenderView(FileDownloadView):
         try:
             file = File.objects.get(id=file_id)
 
-            if file.owner != request.user and not file.accesses.filter(user=request.user).exists():
+            if not can_view(request, file):
                 return JsonResponse({"error": "Access denied"}, status=403)
 
+            if file.status != FileStatusChoices.READY.value:
+                return JsonResponse({"error": "File is still being processed", "status": file.status}, status=409)
+
+            # Answer revalidations before any RSA or AES work
+            raw = request.query_params.get("mode") == "raw"
+            etag = file_etag(file, "raw" if raw else "json")
+            not_modified = conditional_response(request, etag)
+            if not_modified is not None:
+                return not_modified
+
             # Decrypt server key
-            decrypted_key = decrypt_with_private_key(file.server_key)
+            decrypted_key = unwrap_client_key(file)
+
+            # ?mode=raw streams the bytes instead of base64 JSON
+            if raw:
+                return set_cache_headers(stream_file_response(request, file, decrypted_key), etag)
 
-            # Read and decrypt with AES
-            with open(file.encrypted_file.path, "rb") as encrypted_file:
-                server_encrypted_data = encrypted_file.read()
-                
-            # Server-side AES decryption
-            client_encrypted_data = aes_encryption.decrypt_file(server_encrypted_data)
+            # Read and decrypt with AES, or reuse the cached payload of a hot file
+            client_encrypted_data = client_encrypted_payload(file)
 
             content_type, _ = mimetypes.guess_type(file.name)
             if not content_type:
@@ -141,13 +312,273 @@ class FileRenderView(FileDownloadView):
                 "original_name": file.name,
                 "media_type": content_type,
             }
-            return JsonResponse(response_data, status=200)
+            return set_cache_headers(JsonResponse(response_data, status=200), etag)
         except File.DoesNotExist:
             return JsonResponse({"error": "File not found"}, status=404)
         except Exception as e:
             return JsonResponse({"error": str(e)}, status=400)
 
 
+class FileStatusView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, file_id):
+        """Processing status of an upload, for clients polling after a 202."""
+        try:
+            file = File.objects.get(id=file_id)
+
+            if not can_view(request, file):
+                return JsonResponse({"error": "Access denied"}, status=403)
+
+            return JsonResponse({
+                "file_id": file.id,
+                "status": file.status,
+                "sha256": file.sha256 or None,
+                "error": file.processing_error or None,
+            }, status=200)
+        except File.DoesNotExist:
+            return JsonResponse({"error": "File not found"}, status=404)
+
+
+class FileArchiveView(APIView):
+    """
+    Stream several files as one ZIP. Each entry holds the client-encrypted
+    bytes; manifest.json (written last) has the IV and client key of each.
+    Body: {"file_ids": [...]}.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        file_ids = request.data.get("file_ids")
+        if not isinstance(file_ids, list) or not file_ids or not all(isinstance(file_id, int) for file_id in file_ids):
+            return JsonResponse({"error": "Invalid request format"}, status=400)
+        file_ids = list(dict.fromkeys(file_ids))
+        if len(file_ids) > settings.FILE_ARCHIVE_MAX_FILES:
+            return JsonResponse({"error": f"At most {settings.FILE_ARCHIVE_MAX_FILES} files per archive"}, status=400)
+
+        files = File.objects.in_bulk(file_ids)
+        missing = [file_id for file_id in file_ids if file_id not in files]
+        if missing:
+            return JsonResponse({"error": "File not found", "file_ids": missing}, status=404)
+        denied = [file_id for file_id in file_ids if not can_download(request, files[file_id])]
+        if denied:
+            return JsonResponse({"error": "Access denied", "file_ids": denied}, status=403)
+        pending = [file_id for file_id in file_ids if files[file_id].status != FileStatusChoices.READY.value]
+        if pending:
+            return JsonResponse({"error": "File is still being processed", "file_ids": pending}, status=409)
+
+        response = StreamingHttpResponse(
+            stream_zip(self.archive_entries([files[file_id] for file_id in file_ids])),
+            content_type="application/zip",
+        )
+        response["Content-Disposition"] = 'attachment; filename="files.zip"'
+        return response
+
+    def archive_entries(self, files):
+        manifest = []
+        for file in files:
+            base_name = os.path.basename(file.name.replace('\\', '/'))
+            path = f"{file.id}_{base_name}"
+            content_type, _ = mimetypes.guess_type(file.name)
+            manifest.append({
+                "file_id": file.id,
+                "path": path,
+                "original_name": file.name,
+                "size": file.size,
+                "media_type": content_type or 'application/octet-stream',
+                "iv": base64.b64encode(file.iv).decode("utf-8"),
+                "client_key": base64.b64encode(unwrap_client_key(file)).decode("utf-8"),
+            })
+            yield path, self.client_encrypted_chunks(file)
+        yield "manifest.json", [json.dumps({"files": manifest}, indent=2).encode()]
+
+    def client_encrypted_chunks(self, file):
+        with default_storage.open(file.encrypted_file.name, "rb") as encrypted_file:
+            yield from aes_encryption.decrypt_stream(encrypted_file)
+
+
+def upload_session_details(session):
+    """Progress of a resumable upload, as returned by every session endpoint."""
+    received = list(session.chunks.order_by("index").values_list("index", flat=True))
+    received_set = set(received)
+    return {
+        "session_id": str(session.id),
+        "name": session.name,
+        "size": session.size,
+        "chunk_size": session.chunk_size,
+        "total_chunks": session.total_chunks,
+        "received_chunks": received,
+        "missing_chunks": [index for index in range(session.total_chunks) if index not in received_set],
+        "expires_at": session.expires_at,
+        "file_id": session.file_id,
+    }
+
+
+class UploadSessionView(APIView):
+    permission_classes = [IsAuthenticated, IsRegularUser]
+
+    def post(self, request):
+        """
+        Start a resumable upload. The client then PUTs chunks of `chunk_size`
+        bytes and finalizes the session. Retries carrying the same
+        Idempotency-Key header get the existing session back.
+        """
+        try:
+            name = request.data["name"]
+            size = int(request.data["size"])
+            encrypted_key = request.data["encrypted_key"]
+            iv = request.data["iv"]
+
+            if not name or size < 0 or not encrypted_key or not iv:
+                return JsonResponse({"error": "Missing required fields"}, status=400)
+
+            idempotency_key = request.headers.get("Idempotency-Key")
+            if idempotency_key:
+                session = UploadSession.objects.filter(owner=request.user, idempotency_key=idempotency_key).first()
+                if session and not session.is_expired():
+                    return JsonResponse(upload_session_details(session), status=200)
+                if session and session.is_assembling():
+                    return JsonResponse({"error": "Upload session is being assembled"}, status=409)
+                if session:
+                    session.discard()
+
+            try:
+                session = UploadSession.objects.create(
+                    owner=request.user,
+                    name=name,
+                    size=size,
+                    chunk_size=aes_encryption.SEGMENT_SIZE,
+                    server_key=encrypt_with_public_key(bytes.fromhex(encrypted_key), key_ring.active_key_id),
+                    server_key_id=key_ring.active_key_id,
+                    aes_key_id=aes_encryption.active_key_id,
+                    iv=bytes.fromhex(iv),
+                    idempotency_key=idempotency_key,
+                    expires_at=now() + settings.UPLOAD_SESSION_TTL,
+                )
+            except IntegrityError:
+                # A concurrent retry with the same key won the race
+                session = UploadSession.objects.get(owner=request.user, idempotency_key=idempotency_key)
+                return JsonResponse(upload_session_details(session), status=200)
+
+            return JsonResponse(upload_session_details(session), status=201)
+        except (KeyError, ValueError):
+            return JsonResponse({"error": "Invalid request format"}, status=400)
+        except Exception as e:
+            return JsonResponse({"error": str(e)}, status=400)
+
+
+class UploadSessionDetailView(APIView):
+    permission_classes = [IsAuthenticated, IsRegularUser]
+
+    def get(self, request, session_id):
+        try:
+            session = UploadSession.objects.get(id=session_id, owner=request.user)
+            if session.is_expired():
+                return JsonResponse({"error": "Upload session expired"}, status=410)
+            return JsonResponse(upload_session_details(session), status=200)
+        except UploadSession.DoesNotExist:
+            return JsonResponse({"error": "Upload session not found"}, status=404)
+
+    def delete(self, request, session_id):
+        try:
+            session = UploadSession.objects.get(id=session_id, owner=request.user)
+            if session.is_assembling():
+                return JsonResponse({"error": "Upload session is being assembled"}, status=409)
+            session.discard()
+            return JsonResponse({}, status=status.HTTP_204_NO_CONTENT)
+        except UploadSession.DoesNotExist:
+            return JsonResponse({"error": "Upload session not found"}, status=404)
+
+
+class UploadChunkView(APIView):
+    permission_classes = [IsAuthenticated, IsRegularUser]
+
+    def put(self, request, session_id, index):
+        """
+        Receive one chunk as the raw request body. It is encrypted as its
+        segment of the final container and staged right away, so a dropped
+        connection only costs the chunk in flight. Re-sending a chunk
+        replaces it.
+        """
+        try:
+            session = UploadSession.objects.get(id=session_id, owner=request.user)
+            if session.file_id:
+                return JsonResponse({"error": "Upload session already finalized"}, status=409)
+            if session.is_expired():
+                return JsonResponse({"error": "Upload session expired"}, status=410)
+            if index >= session.total_chunks:
+                return JsonResponse({"error": "Chunk index out of range"}, status=400)
+
+            expected = session.chunk_length(index)
+            data = request.stream.read(expected + 1) if request.stream else b""
+            if len(data) != expected:
+                return JsonResponse({"error": f"Chunk {index} must be {expected} bytes"}, status=400)
+
+            header = aes_encryption.session_header(session)
+            nonce, encrypted_segment = aes_encryption.encrypt_segment(header, index, data)
+
+            chunk_path = session.chunk_path(index)
+            default_storage.delete(chunk_path)
+            default_storage.save(chunk_path, ContentFile(encrypted_segment))
+            UploadChunk.objects.update_or_create(session=session, index=index, defaults={"nonce": nonce})
+
+            session.expires_at = now() + settings.UPLOAD_SESSION_TTL
+            session.save(update_fields=["expires_at"])
+
+            return JsonResponse({"index": index, "received": session.chunks.count()}, status=200)
+        except UploadSession.DoesNotExist:
+            return JsonResponse({"error": "Upload session not found"}, status=404)
+        except Exception as e:
+            return JsonResponse({"error": str(e)}, status=400)
+
+
+class UploadSessionFinalizeView(APIView):
+    permission_classes = [IsAuthenticated, IsRegularUser]
+
+    def post(self, request, session_id):
+        """
+        Create the File and queue assembly of the staged segments into its
+        blob. Segments were encrypted on arrival, so the worker only copies
+        bytes. Finalizing twice returns the same file.
+        """
+        try:
+            session = UploadSession.objects.get(id=session_id, owner=request.user)
+            if session.file_id:
+                return JsonResponse(
+                    {"message": "File uploaded successfully", "file_id": session.file_id, "status": session.file.status},
+                    status=200,
+                )
+            if session.is_expired():
+                return JsonResponse({"error": "Upload session expired"}, status=410)
+
+            if session.chunks.count() != session.total_chunks:
+                return JsonResponse({"error": "Upload incomplete", **upload_session_details(session)}, status=409)
+
+            with transaction.atomic():
+                uploaded_file = File.objects.create(
+                    name=session.name,
+                    encrypted_file=None,
+                    server_key=session.server_key,
+                    server_key_id=session.server_key_id,
+                    iv=session.iv,
+                    owner=request.user,
+                    size=session.size,
+                    status=FileStatusChoices.PENDING.value,
+                )
+                session.file = uploaded_file
+                session.save(update_fields=["file"])
+                transaction.on_commit(lambda: assemble_upload_session.delay(uploaded_file.id, str(session.id)))
+
+            return JsonResponse(
+                {"message": "File uploaded successfully", "file_id": uploaded_file.id, "status": uploaded_file.status},
+                status=202,
+            )
+        except UploadSession.DoesNotExist:
+            return JsonResponse({"error": "Upload session not found"}, status=404)
+        except Exception as e:
+            return JsonResponse({"error": str(e)}, status=400)
+
+
 # class FileUploadView(APIView):
 #     permission_classes = [IsAuthenticated, IsRegularUser]
 
@@ -197,7 +628,7 @@ class FileRenderView(FileDownloadView):
 #             if not content_type:
 #                 content_type = 'application/octet-stream'
 
-#             with open(file.encrypted_file.path, "rb") as encrypted_file:
+#             with default_storage.open(file.encrypted_file.name, "rb") as encrypted_file:
 #                 encrypted_data = encrypted_file.read()
 
 #             response_data = {
@@ -233,7 +664,7 @@ class FileRenderView(FileDownloadView):
 #                 content_type = 'application/octet-stream'
 
 #             # Read the encrypted file
-#             with open(file.encrypted_file.path, "rb") as encrypted_file:
+#             with default_storage.open(file.encrypted_file.name, "rb") as encrypted_file:
 #                 encrypted_data = encrypted_file.read()
 
 #             # Send metadata and encrypted file for client-side decryption
@@ -253,57 +684,130 @@ class FileRenderView(FileDownloadView):
 
 
 
+FILE_LIST_SORT_FIELDS = {"name": "name", "size": "size", "date": "uploaded_at"}
+
+
+def with_active_link(queryset):
+    """
+    Annotate each file with the token and expiry of its valid shareable link
+    (if any), so the listing is a single query instead of two per file.
+    """
+    active_links = ShareableLink.objects.filter(
+        file=OuterRef("pk"), expires_at__gt=now()
+    ).order_by("id")
+    return queryset.annotate(
+        active_link_token=Subquery(active_links.values("token")[:1]),
+        active_link_expires_at=Subquery(active_links.values("expires_at")[:1]),
+    )
+
+
+def file_list_entry(file):
+    return {
+        "id": file.id,
+        "name": file.name,
+        "size": file.size,
+        "uploaded_at": file.uploaded_at,
+        "status": file.status,
+        "shareable_link": str(file.active_link_token) if file.active_link_token else None,
+        "expires_at": file.active_link_expires_at,
+    }
+
+
+def encode_cursor(value, file_id):
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    return base64.urlsafe_b64encode(json.dumps([value, file_id]).encode()).decode()
+
+
+# JSON type of the sort value encode_cursor writes for each field
+CURSOR_VALUE_TYPES = {"name": str, "size": int, "uploaded_at": str}
+
+
+def decode_cursor(cursor, field):
+    """Return the (sort value, id) of the last row of the previous page."""
+    decoded = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    if not isinstance(decoded, list) or len(decoded) != 2:
+        raise ValueError("Invalid cursor")
+    value, file_id = decoded
+    for item, expected in ((value, CURSOR_VALUE_TYPES[field]), (file_id, int)):
+        if not isinstance(item, expected) or isinstance(item, bool):
+            raise ValueError("Invalid cursor")
+    if field == "uploaded_at":
+        value = parse_datetime(value)
+        if value is None:
+            raise ValueError("Invalid cursor")
+    return value, file_id
+
+
+def keyset_page(queryset, field, descending, cursor, limit):
+    """
+    One page of queryset ordered by (field, id), starting after cursor. The
+    seek condition lets the (owner, field, id) indexes serve every page in
+    the same time, however deep. Returns (rows, next_cursor).
+    """
+    if cursor:
+        value, file_id = decode_cursor(cursor, field)
+        after = "lt" if descending else "gt"
+        queryset = queryset.filter(
+            Q(**{f"{field}__{after}": value}) | Q(**{field: value, f"id__{after}": file_id})
+        )
+    prefix = "-" if descending else ""
+    rows = list(queryset.order_by(f"{prefix}{field}", f"{prefix}id")[:limit + 1])
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(getattr(rows[-1], field), rows[-1].id)
+
+
 class ListUserFilesView(APIView):
+    """
+    Without parameters, returns all owned and shared files (two queries).
+    With ?scope=owned|shared, returns one page of that scope:
+    ?sort=name|size|date&order=asc|desc&limit=N&cursor=<next_cursor>.
+    """
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
-        owned_files = File.objects.filter(owner=request.user)
+        owned_files = with_active_link(File.objects.filter(owner=request.user))
 
-        shared_files = File.objects.filter(
+        # unique_together (file, user) means the join yields no duplicates
+        shared_files = with_active_link(File.objects.filter(
             accesses__user=request.user,
             accesses__can_view=True
-        ).distinct()
+        ))
 
-        owned_files_data = [
-            {
-                "id": file.id,
-                "name": file.name,
-                "size": file.size,
-                "uploaded_at": file.uploaded_at,
-                "shareable_link": self.get_valid_shareable_link(file),
-                "expires_at": self.get_shareable_link_expiry(file),
-            }
-            for file in owned_files
-        ]
+        scope = request.query_params.get("scope")
+        if scope is None:
+            return Response({
+                "owned_files": [file_list_entry(file) for file in owned_files],
+                "shared_files": [file_list_entry(file) for file in shared_files]
+            })
 
-        # Prepare data for shared files
-        shared_files_data = [
-            {
-                "id": file.id,
-                "name": file.name,
-                "size": file.size,
-                "uploaded_at": file.uploaded_at,
-                "shareable_link": self.get_valid_shareable_link(file),
-                "expires_at": self.get_shareable_link_expiry(file),
-            }
-            for file in shared_files 
-        ]
+        try:
+            queryset = {"owned": owned_files, "shared": shared_files}[scope]
+            field = FILE_LIST_SORT_FIELDS[request.query_params.get("sort", "date")]
+            order = request.query_params.get("order", "desc")
+            if order not in ("asc", "desc"):
+                raise ValueError("Invalid order")
+            limit = int(request.query_params.get("limit", settings.FILE_LIST_PAGE_SIZE))
+            if limit < 1:
+                raise ValueError("Invalid limit")
+            limit = min(limit, settings.FILE_LIST_MAX_PAGE_SIZE)
+        except (KeyError, ValueError):
+            return Response({"error": "Invalid listing parameters"}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            files, next_cursor = keyset_page(
+                queryset, field, order == "desc", request.query_params.get("cursor"), limit
+            )
+        except (ValueError, TypeError):
+            return Response({"error": "Invalid cursor"}, status=status.HTTP_400_BAD_REQUEST)
 
         return Response({
-            "owned_files": owned_files_data,
-            "shared_files": shared_files_data
+            "files": [file_list_entry(file) for file in files],
+            "next_cursor": next_cursor,
         })
 
-    def get_valid_shareable_link(self, file):
-        """Returns the valid shareable link token if it exists."""
-        link = file.shared_links.filter(expires_at__gt=now()).first()
-        return str(link.token) if link else None
-
-    def get_shareable_link_expiry(self, file):
-        """Returns the expiration timestamp of a valid shareable link."""
-        link = file.shared_links.filter(expires_at__gt=now()).first()
-        return link.expires_at if link else None
-
 # Delete File View
 class FileView(APIView):
     permission_classes = [IsAuthenticated]
@@ -312,24 +816,24 @@ class FileView(APIView):
         try:
             file = File.objects.get(id=file_id)
             
-            is_owner = True if request.user.id == file.owner.id else False
+            access = resolve_access(request, file)
+            if not access.can_view:
+                return JsonResponse({"error": "Access denied"}, status=403)
+            is_owner = access.is_owner
             guest_user = True if request.user.role == 'Guest' else False
-            can_download = True
-            if not is_owner:
-                access = FileAccess.objects.filter(file=file, user=request.user).values("can_download")
-                can_download = access[0]['can_download']
             file_details = {
                 "is_owner": is_owner,
                 "name": file.name,
                 "size": file.size,
                 "owner": file.owner.username,
                 "uploaded_at": file.uploaded_at,
-                "can_download": can_download,
+                "status": file.status,
+                "can_download": access.can_download,
                 "guest_user": guest_user,
             }
 
             # Check if the requesting user is the owner
-            if file.owner == request.user and not guest_user:
+            if is_owner and not guest_user:
                 # Get shared users and permissions
                 shared_with = FileAccess.objects.filter(file=file).values(
                     "id","user__username", "can_view", "can_download"
@@ -356,7 +860,14 @@ class FileView(APIView):
                 ]
                 file_details["shareable_links"] = links_details
 
-            return JsonResponse(file_details, status=200)
+            # Metadata changes with sharing, so its ETag hashes the body;
+            # a match still saves re-sending it
+            response = JsonResponse(file_details, status=200)
+            etag = f'"{hashlib.sha256(response.content).hexdigest()}"'
+            not_modified = conditional_response(request, etag)
+            if not_modified is not None:
+                return not_modified
+            return set_cache_headers(response, etag)
 
         except File.DoesNotExist:
             return JsonResponse({"error": "File not found or unauthorized"}, status=404)
@@ -365,10 +876,11 @@ class FileView(APIView):
     def delete(self, request, file_id):
         try:
             file = File.objects.get(id=file_id, owner=request.user)
-            file_path = os.path.join(settings.MEDIA_ROOT, file.encrypted_file.name)
-            if os.path.exists(file_path):
-                os.remove(file_path)
-            file.delete()
+            invalidate_client_key(file.id)
+            # Releases the file's blob reference; the content is removed
+            # with the last one (see signals.file_deleted)
+            with transaction.atomic():
+                file.delete()
             return JsonResponse({"message": "File deleted successfully"}, status=200)
         except File.DoesNotExist:
             return JsonResponse({"error": "File not found or unauthorized"}, status=404)
@@ -407,12 +919,109 @@ class FileAccessView(APIView):
             file = File.objects.get(id=file_id, owner=request.user)
             file_acess = FileAccess.objects.filter(user=user, file=file)
             file_acess.delete()
+            invalidate_client_key(file.id)
             return JsonResponse({"message": "Access revoked successfully"}, status=200)
         except File.DoesNotExist:
             return JsonResponse({"error": "File not found or unauthorized"}, status=404)
         except Exception as e:
             return JsonResponse({"error": "An error occured"}, status=500)
 
+class BulkFileAccessView(APIView):
+    """
+    Grant or revoke access for many files and users at once.
+    Body: {"action": "grant"|"revoke", "file_ids": [...], "usernames": [...],
+    "can_download": bool}. Returns one result per (file, user) pair.
+    """
+    permission_classes = [IsAuthenticated, IsRegularUser]
+
+    def post(self, request):
+        action = request.data.get("action")
+        file_ids = request.data.get("file_ids")
+        usernames = request.data.get("usernames")
+        try:
+            # Form and multipart bodies carry booleans as strings such as "false"
+            can_download = serializers.BooleanField().to_internal_value(request.data.get("can_download", False))
+        except serializers.ValidationError:
+            return JsonResponse({"error": "Invalid request format"}, status=400)
+
+        if (
+            action not in ("grant", "revoke")
+            or not isinstance(file_ids, list) or not all(isinstance(file_id, int) for file_id in file_ids)
+            or not isinstance(usernames, list) or not all(isinstance(username, str) for username in usernames)
+        ):
+            return JsonResponse({"error": "Invalid request format"}, status=400)
+        file_ids = list(dict.fromkeys(file_ids))
+        usernames = list(dict.fromkeys(usernames))
+        if len(file_ids) * len(usernames) > settings.BULK_ACCESS_MAX_ITEMS:
+            return JsonResponse({"error": f"At most {settings.BULK_ACCESS_MAX_ITEMS} file/user pairs per request"}, status=400)
+
+        users = dict(Users.objects.filter(username__in=usernames).values_list("username", "id"))
+        owned = set(File.objects.filter(id__in=file_ids, owner=request.user).values_list("id", flat=True))
+        user_ids = [user_id for user_id in users.values() if user_id != request.user.id]
+
+        with transaction.atomic():
+            existing = {
+                (access.file_id, access.user_id): access
+                for access in FileAccess.objects.select_for_update().filter(file_id__in=owned, user_id__in=user_ids)
+            }
+            if action == "grant":
+                outcomes = self.grant(owned, user_ids, existing, can_download)
+            else:
+                outcomes = self.revoke(existing)
+
+            for file_id in owned:
+                transaction.on_commit(functools.partial(invalidate_file_access, file_id))
+                if action == "revoke":
+                    transaction.on_commit(functools.partial(invalidate_client_key, file_id))
+
+        results = []
+        for file_id in file_ids:
+            for username in usernames:
+                user_id = users.get(username)
+                if file_id not in owned:
+                    result = "file_not_found"
+                elif user_id is None:
+                    result = "user_not_found"
+                elif user_id == request.user.id:
+                    result = "is_owner"
+                else:
+                    result = outcomes[(file_id, user_id)]
+                results.append({"file_id": file_id, "username": username, "result": result})
+
+        return JsonResponse({"action": action, "results": results}, status=200)
+
+    def grant(self, file_ids, user_ids, existing, can_download):
+        outcomes, created, updated = {}, [], []
+        for file_id in file_ids:
+            for user_id in user_ids:
+                access = existing.get((file_id, user_id))
+                if access is None:
+                    created.append(FileAccess(file_id=file_id, user_id=user_id, can_download=can_download))
+                    outcomes[(file_id, user_id)] = "granted"
+                elif access.can_download != can_download or not access.can_view:
+                    access.can_download = can_download
+                    access.can_view = True
+                    updated.append(access)
+                    outcomes[(file_id, user_id)] = "updated"
+                else:
+                    outcomes[(file_id, user_id)] = "unchanged"
+        # A concurrent grant may have created some of these pairs since they
+        # were read; skip them on insert and bring them to the requested state
+        FileAccess.objects.bulk_create(created, ignore_conflicts=True)
+        if created:
+            FileAccess.objects.filter(
+                file_id__in={access.file_id for access in created},
+                user_id__in={access.user_id for access in created},
+            ).exclude(can_view=True, can_download=can_download).update(can_view=True, can_download=can_download)
+        FileAccess.objects.bulk_update(updated, ["can_view", "can_download"])
+        return outcomes
+
+    def revoke(self, existing):
+        FileAccess.objects.filter(id__in=[access.id for access in existing.values()]).delete()
+        outcomes = defaultdict(lambda: "not_shared")
+        outcomes.update({pair: "revoked" for pair in existing})
+        return outcomes
+
 # Generate Shareable Link View
 class GenerateShareableLinkView(APIView):
     permission_classes = [IsAuthenticated, IsRegularUser]
@@ -422,7 +1031,7 @@ class GenerateShareableLinkView(APIView):
             file = File.objects.get(id=file_id)
 
             # Ensure only the owner can generate shareable links
-            if file.owner != request.user:
+            if not resolve_access(request, file).is_owner:
                 return JsonResponse({"error": "Access denied"}, status=403)
 
             ShareableLink.objects.filter(file=file).delete()
@@ -448,32 +1057,31 @@ class AccessSharedFileView(APIView):
     permission_classes = [IsAuthenticated]
     def get(self, request, token):
         try:
-            link = ShareableLink.objects.get(token=token)
-            if not link.is_valid():
+            link = resolve_shared_link(token)
+            if link is None:
+                raise ShareableLink.DoesNotExist
+            if link["expires_at"] <= now():
                 return JsonResponse({"error": "Link expired or invalid"}, status=403)
 
-            # Retrieve the file owned by the requesting user
-            file = link.file
-            
-            is_owner = True if request.user.id == file.owner.id else False
+            is_owner = request.user.id == link["owner_id"]
             guest_user = True if request.user.role == 'Guest' else False
             can_download = True
 
             file_details = {
                 "is_owner": is_owner,
-                "name": file.name,
-                "size": file.size,
-                "owner": file.owner.username,
-                "uploaded_at": file.uploaded_at,
+                "name": link["name"],
+                "size": link["size"],
+                "owner": link["owner_username"],
+                "uploaded_at": link["uploaded_at"],
                 "can_download": can_download,
                 "guest_user": guest_user,
-                "file_id": file.id,
+                "file_id": link["file_id"],
             }
 
             # Check if the requesting user is the owner
-            if file.owner == request.user and not guest_user:
+            if is_owner and not guest_user:
                 # Get shared users and permissions
-                shared_with = FileAccess.objects.filter(file=file).values(
+                shared_with = FileAccess.objects.filter(file_id=link["file_id"]).values(
                     "id","user__username", "can_view", "can_download"
                 )
                 shared_with_details = [
@@ -488,7 +1096,7 @@ class AccessSharedFileView(APIView):
                 file_details["shared_with"] = shared_with_details
 
                 # Get shareable link details
-                shareable_links = ShareableLink.objects.filter(file=file)
+                shareable_links = ShareableLink.objects.filter(file_id=link["file_id"])
                 links_details = [
                     {
                         "token": link.token,
@@ -501,7 +1109,7 @@ class AccessSharedFileView(APIView):
 
             return JsonResponse(file_details, status=200)
 
-        except File.DoesNotExist:
+        except (File.DoesNotExist, ShareableLink.DoesNotExist):
             return JsonResponse({"error": "File not found or unauthorized"}, status=404)
         except Exception as e:
             return JsonResponse({"error": str(e)}, status=400)